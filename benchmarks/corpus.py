@@ -0,0 +1,186 @@
+"""Natural programs of the benchmark scenarios, with the completions the mock
+language model serves for them."""
+from dataclasses import dataclass
+
+
+@dataclass
+class Step:
+    """An instruction of a scenario."""
+    instruction: list[str]
+    constraint: list[str]
+    completions: list[str]
+    """Completions served for the instruction. Some of them are wrong, like
+    the ones of a real language model."""
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    steps: list[Step]
+
+
+def get_long_session_steps(instruction_n: int) -> list[Step]:
+    """A session with many short instructions, which stresses the cost of
+    keeping the session state."""
+    steps = [
+        Step(
+            instruction=["Set the variable 'v0' to zero"],
+            constraint=["assert v0 == 0"],
+            completions=["v0 = 0", "v0 = 1"],
+        ),
+    ]
+    for i in range(1, instruction_n):
+        steps.append(Step(
+            instruction=[f"Set the variable 'v{i}' to 'v{i-1}' plus {i}"],
+            constraint=[f"assert v{i} == {i*(i+1)//2}"],
+            completions=[
+                f"v{i} = v{i-1} + {i}\nprint(v{i})",
+                f"v{i} = v{i-1} - {i}",
+                f"v{i} = v{i-1} +",
+                f"v{i} = v{i-1}  +  {i}\nprint(v{i})",
+            ],
+        ))
+    return steps
+
+
+scenarios = [
+    Scenario(
+        name='list_building',
+        description="Build and transform lists.",
+        steps=[
+            Step(
+                instruction=["Create a list with the days of the week, call it 'days'"],
+                constraint=["assert days[0] == 'Sunday'"],
+                completions=[
+                    "days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']",
+                    "days = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']",
+                    "days = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday'",
+                    "days = [\n    'Sunday',\n    'Monday',\n    'Tuesday',\n    'Wednesday',\n    'Thursday',\n    'Friday',\n    'Saturday',\n]",
+                ],
+            ),
+            Step(
+                instruction=["Keep the days that start with 'T' in a list called 't_days'"],
+                constraint=["assert t_days == ['Tuesday', 'Thursday']"],
+                completions=[
+                    "t_days = [d for d in days if d.startswith('T')]",
+                    "t_days = [d for d in days if 'T' in d]",
+                    "t_days = filter(lambda d: d[0] == 'T', days)",
+                    "t_days = [d for d in days if d[0] == 'T']",
+                ],
+            ),
+            Step(
+                instruction=["Sort the days by length, call the result 'by_length'"],
+                constraint=["assert by_length[0] == 'Sunday' and by_length[-1] == 'Wednesday'"],
+                completions=[
+                    "by_length = sorted(days, key=len)",
+                    "by_length = days.sort(key=len)",
+                    "by_length = sorted(days)",
+                ],
+            ),
+        ],
+    ),
+    Scenario(
+        name='string_parsing',
+        description="Parse and format strings.",
+        steps=[
+            Step(
+                instruction=["Parse the date '2023-02-20' into the integers 'year', 'month' and 'day'"],
+                constraint=["assert (year, month, day) == (2023, 2, 20)"],
+                completions=[
+                    "year, month, day = '2023-02-20'.split('-')",
+                    "year, month, day = map(int, '2023-02-20'.split('-'))",
+                    "import datetime\nd = datetime.date.fromisoformat('2023-02-20')\nyear, month, day = d.year, d.month, d.day",
+                ],
+            ),
+            Step(
+                instruction=["Count the words of the sentence 'the quick brown fox jumps', call it 'word_n'"],
+                constraint=["assert word_n == 5"],
+                completions=[
+                    "word_n = len('the quick brown fox jumps')",
+                    "word_n = len('the quick brown fox jumps'.split())",
+                    "word_n = 'the quick brown fox jumps'.count(' ')",
+                ],
+            ),
+            Step(
+                instruction=["Parse the CSV line 'a,1,2.5' into a tuple 'row' of a string, an integer and a float"],
+                constraint=["assert row == ('a', 1, 2.5)"],
+                completions=[
+                    "row = tuple('a,1,2.5'.split(','))",
+                    "fields = 'a,1,2.5'.split(',')\nrow = (fields[0], int(fields[1]), float(fields[2]))",
+                    "row = ('a', int('1'), float('2.5')",
+                ],
+            ),
+        ],
+    ),
+    Scenario(
+        name='numeric',
+        description="Numeric computations, some of them expensive.",
+        steps=[
+            Step(
+                instruction=["Compute the 20th Fibonacci number, call it 'fib'"],
+                constraint=["assert fib == 6765"],
+                completions=[
+                    "def f(n):\n    return n if n < 2 else f(n-1) + f(n-2)\nfib = f(19)",
+                    "def f(n):\n    return n if n < 2 else f(n-1) + f(n-2)\nfib = f(20)",
+                    "a, b = 0, 1\nfor _ in range(20):\n    a, b = b, a + b\nfib = a",
+                ],
+            ),
+            Step(
+                instruction=["Find the primes below 10000, call the list 'primes'"],
+                constraint=["assert len(primes) == 1229"],
+                completions=[
+                    "primes = [n for n in range(2, 10000) if all(n % d for d in range(2, n))]",
+                    "primes = [n for n in range(10000) if all(n % d for d in range(2, int(n**0.5)+1))]",
+                    "primes = [n for n in range(2, 10000) if all(n % d for d in range(2, int(n**0.5)+1))]",
+                ],
+            ),
+            Step(
+                instruction=["Compute the mean of 'primes', call it 'mean_prime'"],
+                constraint=["assert round(mean_prime) == 4668"],
+                completions=[
+                    "import statistics\nmean_prime = statistics.mean(primes)",
+                    "mean_prime = sum(primes) / len(primes)",
+                ],
+            ),
+        ],
+    ),
+    Scenario(
+        name='long_session',
+        description="A session of 60 short instructions.",
+        steps=get_long_session_steps(60),
+    ),
+    Scenario(
+        name='large_output',
+        description="Instructions that print large tables, which stresses the capture of the output.",
+        steps=[
+            Step(
+                instruction=["Print a table of the squares of the numbers below 200000"],
+                constraint=[],
+                completions=[
+                    "for n in range(200000):\n    print(n, n**2",
+                    "for n in range(200000):\n    print(f'{n:>8} {n**2:>14}')",
+                ],
+            ),
+            Step(
+                instruction=["Print a table of the cubes of the numbers below 200000, call the last one 'last_cube'"],
+                constraint=["assert last_cube == 199999**3"],
+                completions=[
+                    "for n in range(200000):\n    print(f'{n:>8} {n**3:>20}')",
+                    "for n in range(200000):\n    last_cube = n**3\n    print(f'{n:>8} {last_cube:>20}')",
+                ],
+            ),
+            Step(
+                instruction=["Print the sum of the numbers below 200000"],
+                constraint=[],
+                completions=["print(sum(range(200000)))"],
+            ),
+            Step(
+                instruction=["Print the sum of the squares of the numbers below 200000"],
+                constraint=[],
+                completions=["print(sum(n**2 for n in range(200000)))"],
+            ),
+        ],
+    ),
+]
+"""Scenarios of the benchmark."""
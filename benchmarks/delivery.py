@@ -0,0 +1,97 @@
+"""Benchmark of the ways candidates are delivered to Python interpreters.
+
+Validates the same candidates on top of a session with a replay worker whose
+code is piped to the interpreters through their stdin, with one that writes
+it to source files, and with a long-lived interpreter, and reports the
+candidates validated per second of each. It also checks that no source file
+is left behind.
+
+Usage: python benchmarks/delivery.py [--candidates 200] [--session-lines 200]
+"""
+from pathlib import Path
+import argparse
+import tempfile
+import time
+import sys
+
+repository_dir = Path(__file__).parent.parent
+sys.path.insert(0, str(repository_dir))
+
+from natural_python import worker
+
+
+def get_session(line_n: int) -> list[str]:
+    """Session code with `line_n` lines of assignments."""
+    return [f"v{i} = {i} * 2" for i in range(line_n)]
+
+
+def get_candidates(candidate_n: int, line_n: int) -> list[list[str]]:
+    """Candidates that succeed and fail, in turns."""
+    return [
+        [f"result = v{i % line_n} + {i}", f"assert result % 2 == {i % 2}"]
+        for i in range(candidate_n)
+    ]
+
+
+def get_worker(path: str, python_shell: str, parallel: int) -> worker.Worker:
+    if path == 'resident':
+        return worker.PythonWorker(python_shell, parallel=parallel)
+    return worker.ReplayWorker(
+        python_shell,
+        parallel=parallel,
+        source_files=path == 'file',
+    )
+
+
+def validate(python_worker: worker.Worker, session: list[str], candidates: list[list[str]]) -> float:
+    """Validate the candidates on top of the session, discarding every one of
+    them, and return the seconds it took."""
+    python_worker.sync(session)
+    start = time.perf_counter()
+    for i in range(0, len(candidates), python_worker.parallel):
+        executions = [python_worker.submit(c) for c in candidates[i:i+python_worker.parallel]]
+        for execution in executions:
+            try:
+                execution.future.result()
+            except worker.PythonInterpreterError:
+                pass
+            python_worker.discard(execution)
+    return time.perf_counter()-start
+
+
+def get_source_files() -> set[str]:
+    return {p.name for p in Path(tempfile.gettempdir()).rglob('natural-python*.py')}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--candidates', type=int, default=200)
+    parser.add_argument('--session-lines', type=int, default=200)
+    parser.add_argument('--validate-workers', type=int, default=1)
+    parser.add_argument(
+        '--path',
+        help="Delivery paths to measure. All of them by default.",
+        choices=['stdin', 'file', 'resident'],
+        action='append',
+    )
+    parser.add_argument('--python-shell', default=sys.executable)
+    args = parser.parse_args()
+
+    session = get_session(args.session_lines)
+    candidates = get_candidates(args.candidates, args.session_lines)
+    source_files = get_source_files()
+    for path in args.path or ['stdin', 'file', 'resident']:
+        with get_worker(path, args.python_shell, args.validate_workers) as python_worker:
+            seconds = validate(python_worker, session, candidates)
+        print(f"{path}: {len(candidates)/seconds:.1f} candidates/s ({seconds:.2f}s for {len(candidates)} candidates)")
+    left_behind = get_source_files()-source_files
+    print(f"Source files left behind: {len(left_behind)}")
+    if len(left_behind) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""Local stand-in for an OpenAI-compatible completions API.
+
+Completions are served from a table that maps instructions to completions.
+The server finds the instruction of a prompt by its last comment lines, and
+samples completions of it with a seeded random generator, so runs are
+reproducible. Like the legacy completions endpoint, a request can have a list
+of prompts, which is answered with `n` choices for each of them. Requests can be slowed down and can fail at random, to simulate
+a real API."""
+from typing import Optional
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import threading
+import random
+import json
+import time
+
+
+class MockCompletionServer(ThreadingHTTPServer):
+    """Serves completions of the instructions in `completions`, keyed by the
+    instruction as it is written in prompts.
+
+    Every request waits `latency` seconds, plus `token_latency` seconds for
+    each completion token when streaming. A fraction `failure_rate` of the
+    requests fails with a retryable error."""
+    daemon_threads = True
+
+    def __init__(
+            self,
+            completions: dict[str, list[str]],
+            engine_id: str = 'mock',
+            latency: float = 0.0,
+            token_latency: float = 0.0,
+            failure_rate: float = 0.0,
+            seed: int = 0,
+            port: int = 0,
+            ):
+        super().__init__(('127.0.0.1', port), MockCompletionHandler)
+        self.completions = completions
+        self.engine_id = engine_id
+        self.latency = latency
+        self.token_latency = token_latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def api_base(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}/v1'
+
+    def get_completions(self, prompt: str, n: int) -> list[str]:
+        """Sample `n` completions for the instruction that ends the prompt."""
+        candidates = ['pass']
+        for instruction, instruction_completions in self.completions.items():
+            if prompt.rstrip().endswith(instruction):
+                candidates = instruction_completions
+                break
+        with self.lock:
+            # The first samples follow the order of the table, like the most
+            # likely completions of a language model
+            return [
+                candidates[i] if i < len(candidates) else self.random.choice(candidates)
+                for i in range(n)
+            ]
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            fail = self.random.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+        return fail
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+class MockCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: MockCompletionServer
+
+    def log_message(self, *_):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # Clients close the connection of a stream once they have a winner
+            pass
+
+    def send_json(self, status: int, data: object, headers: Optional[dict] = None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, data: str):
+        """Send a server-sent event as a chunk of the response."""
+        event = f'data: {data}\n\n'.encode('utf-8')
+        self.wfile.write(f'{len(event):x}\r\n'.encode('ascii')+event+b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/v1/engines':
+            self.send_json(404, dict(error="Not found"))
+            return
+        self.send_json(200, dict(data=[dict(id=self.server.engine_id)]))
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path != f'/v1/engines/{self.server.engine_id}/completions':
+            self.send_json(404, dict(error="Not found"))
+            return
+        time.sleep(self.server.latency)
+        if self.server.should_fail():
+            self.send_json(503, dict(error="Overloaded"), {'retry-after': '0.01'})
+            return
+
+        prompts = body['prompt'] if isinstance(body['prompt'], list) else [body['prompt']]
+        texts = [
+            text
+            for prompt in prompts
+            for text in self.server.get_completions(prompt, body['n'])
+        ]
+        # Completions end with a stop sequence, which is not returned
+        texts = [t+'\n' for t in texts]
+        if not body.get('stream'):
+            self.send_json(200, dict(
+                choices=[
+                    dict(text=text, index=i, finish_reason='stop', logprobs=None)
+                    for i, text in enumerate(texts)
+                ],
+                usage=dict(
+                    prompt_tokens=sum(len(prompt.split()) for prompt in prompts),
+                    completion_tokens=sum(len(t.split()) for t in texts),
+                ),
+            ))
+            return
+
+        # Stream the completions word by word, interleaving the choices
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        tokens = [text.split(' ') for text in texts]
+        for token_i in range(max(len(t) for t in tokens)):
+            time.sleep(self.server.token_latency)
+            for i, choice_tokens in enumerate(tokens):
+                if token_i >= len(choice_tokens):
+                    continue
+                last = token_i == len(choice_tokens)-1
+                text = choice_tokens[token_i] + ('' if last else ' ')
+                self.send_event(json.dumps(dict(choices=[dict(
+                    text=text,
+                    index=i,
+                    finish_reason='stop' if last else None,
+                    logprobs=None,
+                )])))
+        self.send_event('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
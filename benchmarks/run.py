@@ -0,0 +1,355 @@
+"""End-to-end benchmark of the interpreter.
+
+Executes the natural programs of the scenarios in `corpus.py` against a local
+mock completion server, so it runs offline and reproducibly. For each scenario
+it reports the wall-clock time, the Python interpreters launched, the
+candidates sampled and validated, and the peak memory of this process and of
+its children.
+
+With --lockstep, the scenarios (and --copies of them) run as independent
+sessions at the same time, like a bulk regeneration of scripts: the n-th
+instructions of every session are executed together, either one after the
+other (loop) or with their prompts packed into batched requests (batch).
+
+Usage: python benchmarks/run.py [--scenario NAME] [--worker fork] [--lockstep batch] [--json results.json]
+"""
+from typing import Optional
+from pathlib import Path
+import argparse
+import subprocess
+import resource
+import time
+import json
+import sys
+
+repository_dir = Path(__file__).parent.parent
+sys.path.insert(0, str(repository_dir))
+
+from natural_python import backends
+from natural_python import context
+from natural_python import interpreter
+from natural_python import search
+from natural_python import worker
+from corpus import Scenario
+from corpus import scenarios
+from mock_server import MockCompletionServer
+
+
+class CountingPopen(subprocess.Popen):
+    """`subprocess.Popen` that counts the processes it launches."""
+    launched = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingPopen.launched += 1
+        super().__init__(*args, **kwargs)
+
+
+def get_worker(kind: str, python_shell: str, parallel: int, output_limit: Optional[int]) -> worker.Worker:
+    if kind == 'replay':
+        python_worker: worker.Worker = worker.ReplayWorker(python_shell, parallel=parallel)
+    else:
+        python_worker = worker.PythonWorker(
+            python_shell,
+            fork=kind == 'fork',
+            parallel=parallel,
+        )
+    python_worker.limits.output = output_limit
+    return python_worker
+
+
+def run_scenario(scenario: Scenario, args: argparse.Namespace) -> dict:
+    """Execute the instructions of a scenario and return its measurements."""
+    completions = {
+        "\n".join(['# '+l for l in step.instruction]): step.completions
+        for step in scenario.steps
+    }
+    server = MockCompletionServer(
+        completions,
+        latency=args.latency,
+        token_latency=args.token_latency,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    statistics = search.SearchStatistics()
+    failed_instructions = 0
+    launched = CountingPopen.launched
+    with server:
+        backend = backends.HTTPBackend(
+            api_base=server.api_base,
+            api_key='mock',
+            engine_id=server.engine_id,
+            pool_size=args.sample_concurrency,
+        )
+        python_worker = get_worker(args.worker, args.python_shell, args.validate_workers, args.output_limit)
+        prompt_context = context.PromptContext(args.max_prompt_tokens)
+        start = time.perf_counter()
+        with backend, python_worker:
+            current_code: list[str] = list()
+            for step in scenario.steps:
+                program = interpreter.NaturalProgram(
+                    instruction=step.instruction,
+                    constraint=step.constraint,
+                )
+                try:
+                    new_code, _ = interpreter.execute_natural_program(
+                        program=program,
+                        current_python_code=current_code,
+                        sample_n=args.sample_n,
+                        python_worker=python_worker,
+                        backend=backend,
+                        max_sample_tokens=100,
+                        sample_temperature=0.2,
+                        stream=args.stream,
+                        sample_concurrency=args.sample_concurrency,
+                        statistics=statistics,
+                        ranking=args.ranking,
+                        prompt_context=prompt_context,
+                    )
+                except (interpreter.NaturalInterpreterError, backends.LanguageModelAPIError):
+                    failed_instructions += 1
+                    continue
+                current_code.extend([
+                    *interpreter.get_commented_instruction(program),
+                    *new_code,
+                ])
+        seconds = time.perf_counter()-start
+        requests = server.requests
+        failed_requests = server.failures
+
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    return dict(
+        scenario=scenario.name,
+        instructions=len(scenario.steps),
+        failed_instructions=failed_instructions,
+        seconds=seconds,
+        interpreter_launches=CountingPopen.launched-launched,
+        requests=requests,
+        failed_requests=failed_requests,
+        sampled=statistics.sampled,
+        pruned=statistics.duplicates+statistics.syntax_errors,
+        validated=statistics.validated,
+        # Linux reports the maximum resident set size in kilobytes
+        peak_memory_mb=self_usage.ru_maxrss/1024,
+        peak_children_memory_mb=children_usage.ru_maxrss/1024,
+    )
+
+
+def run_lockstep(selected: list[Scenario], args: argparse.Namespace) -> dict:
+    """Execute the scenarios as independent sessions whose instructions run
+    together, and return the measurements of the whole run."""
+    sessions = [scenario for scenario in selected for _ in range(args.copies)]
+    completions = {
+        "\n".join(['# '+l for l in step.instruction]): step.completions
+        for scenario in selected
+        for step in scenario.steps
+    }
+    server = MockCompletionServer(
+        completions,
+        latency=args.latency,
+        token_latency=args.token_latency,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    statistics = search.SearchStatistics()
+    instruction_n = sum(len(scenario.steps) for scenario in sessions)
+    failed_instructions = 0
+    launched = CountingPopen.launched
+    with server:
+        backend = backends.HTTPBackend(
+            api_base=server.api_base,
+            api_key='mock',
+            engine_id=server.engine_id,
+            pool_size=args.sample_concurrency,
+        )
+        python_workers = [
+            get_worker(args.worker, args.python_shell, args.validate_workers, args.output_limit)
+            for _ in sessions
+        ]
+        prompt_contexts = [context.PromptContext(args.max_prompt_tokens) for _ in sessions]
+        codes: list[list[str]] = [list() for _ in sessions]
+        start = time.perf_counter()
+        with backend:
+            for step_i in range(max(len(scenario.steps) for scenario in sessions)):
+                jobs = [
+                    interpreter.NaturalJob(
+                        program=interpreter.NaturalProgram(
+                            instruction=scenario.steps[step_i].instruction,
+                            constraint=scenario.steps[step_i].constraint,
+                        ),
+                        current_python_code=codes[session_i],
+                        python_worker=python_workers[session_i],
+                        prompt_context=prompt_contexts[session_i],
+                        statistics=statistics if args.lockstep == 'loop' else search.SearchStatistics(),
+                    )
+                    for session_i, scenario in enumerate(sessions)
+                    if step_i < len(scenario.steps)
+                ]
+                if args.lockstep == 'batch':
+                    results = interpreter.execute_natural_programs(
+                        jobs=jobs,
+                        sample_n=args.sample_n,
+                        backend=backend,
+                        max_sample_tokens=100,
+                        sample_temperature=0.2,
+                        sample_concurrency=args.sample_concurrency,
+                        ranking=args.ranking,
+                    )
+                else:
+                    results = list()
+                    for job in jobs:
+                        try:
+                            results.append(interpreter.execute_natural_program(
+                                program=job.program,
+                                current_python_code=job.current_python_code,
+                                sample_n=args.sample_n,
+                                python_worker=job.python_worker,
+                                backend=backend,
+                                max_sample_tokens=100,
+                                sample_temperature=0.2,
+                                stream=args.stream,
+                                sample_concurrency=args.sample_concurrency,
+                                statistics=job.statistics,
+                                ranking=args.ranking,
+                                prompt_context=job.prompt_context,
+                            ))
+                        except (interpreter.NaturalInterpreterError, backends.LanguageModelAPIError) as e:
+                            results.append(e)
+                for job, result in zip(jobs, results):
+                    if job.statistics is not statistics:
+                        statistics.sampled += job.statistics.sampled
+                        statistics.duplicates += job.statistics.duplicates
+                        statistics.syntax_errors += job.statistics.syntax_errors
+                        statistics.validated += job.statistics.validated
+                    if isinstance(result, Exception):
+                        failed_instructions += 1
+                        continue
+                    job.current_python_code.extend([
+                        *interpreter.get_commented_instruction(job.program),
+                        *result[0],
+                    ])
+        seconds = time.perf_counter()-start
+        for python_worker in python_workers:
+            python_worker.close()
+        requests = server.requests
+        failed_requests = server.failures
+
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    return dict(
+        scenario=f"{args.lockstep} of {len(sessions)} sessions",
+        instructions=instruction_n,
+        failed_instructions=failed_instructions,
+        seconds=seconds,
+        interpreter_launches=CountingPopen.launched-launched,
+        requests=requests,
+        failed_requests=failed_requests,
+        sampled=statistics.sampled,
+        pruned=statistics.duplicates+statistics.syntax_errors,
+        validated=statistics.validated,
+        peak_memory_mb=self_usage.ru_maxrss/1024,
+        peak_children_memory_mb=children_usage.ru_maxrss/1024,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--scenario',
+        help="Scenarios to run. All of them by default.",
+        choices=[s.name for s in scenarios],
+        action='append',
+    )
+    parser.add_argument(
+        '--worker',
+        help="How candidates are executed, see the --replay and --no-fork options of the interpreter.",
+        choices=['fork', 'namespace', 'replay'],
+        default='fork' if worker.fork_available else 'namespace',
+    )
+    parser.add_argument('--validate-workers', type=int, default=1)
+    parser.add_argument('--sample-n', type=search.parse_sample_schedule, default='4')
+    parser.add_argument('--sample-concurrency', type=int, default=4)
+    parser.add_argument('--ranking', choices=search.rankings, default='none')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument(
+        '--max-prompt-tokens',
+        help="Token budget of the prompts, 'none' sends the whole session.",
+        type=lambda t: None if t.lower() == 'none' else int(t),
+        default='1024',
+    )
+    parser.add_argument(
+        '--output-limit',
+        help="Bytes of stdout, and of stderr, kept of each candidate, 'none' keeps everything.",
+        type=lambda t: None if t.lower() == 'none' else int(t),
+        default=str(2**20),
+    )
+    parser.add_argument(
+        '--latency',
+        help="Seconds the mock server waits before answering a request.",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        '--token-latency',
+        help="Seconds the mock server waits for each streamed token.",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        '--failure-rate',
+        help="Fraction of the requests that the mock server fails with a retryable error.",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        '--lockstep',
+        help="Run the scenarios as independent sessions at the same time, executing the instructions of each step one after the other (loop) or with batched sampling (batch).",
+        choices=['loop', 'batch'],
+        default=None,
+    )
+    parser.add_argument(
+        '--copies',
+        help="Sessions of each scenario run with --lockstep.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--python-shell', default=sys.executable)
+    parser.add_argument(
+        '--json',
+        help="File to write the results to.",
+        type=Path,
+        default=None,
+    )
+    args = parser.parse_args()
+
+    # Count the interpreters launched by the workers
+    subprocess.Popen = CountingPopen  # type: ignore
+
+    selected = [s for s in scenarios if args.scenario is None or s.name in args.scenario]
+    results = list()
+    if args.lockstep is not None:
+        runs = [lambda: run_lockstep(selected, args)]
+    else:
+        runs = [lambda scenario=scenario: run_scenario(scenario, args) for scenario in selected]
+    for run in runs:
+        result = run()
+        results.append(result)
+        print(
+            f"{result['scenario']}: {result['seconds']:.2f}s, "
+            f"{result['instructions']-result['failed_instructions']}/{result['instructions']} instructions, "
+            f"{result['interpreter_launches']} interpreter launches, "
+            f"{result['sampled']} sampled, {result['pruned']} pruned, {result['validated']} validated, "
+            f"{result['requests']} requests ({result['failed_requests']} failed), "
+            f"peak memory {result['peak_memory_mb']:.1f} MB (children {result['peak_children_memory_mb']:.1f} MB)"
+        )
+    if args.json is not None:
+        with open(args.json, "wt") as fp:
+            json.dump(dict(arguments=vars(args) | dict(json=str(args.json)), results=results), fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
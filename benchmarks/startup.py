@@ -0,0 +1,120 @@
+"""Benchmark of the startup time of the interpreter.
+
+Measures how long it takes to import the console and to print the help of the
+command line interface, and checks that modules that are slow to import and
+only needed later, like the HTTP client of the language model, are not
+imported at startup. Exits with error status if the median time of a command
+exceeds `--max-seconds`.
+
+Usage: python benchmarks/startup.py [--runs 10] [--max-seconds 1.0]
+"""
+from pathlib import Path
+import argparse
+import statistics
+import subprocess
+import time
+import sys
+import os
+
+
+repository_dir = Path(__file__).parent.parent
+
+commands = dict(
+    import_console=[sys.executable, '-c', 'import natural_python.console'],
+    help=[sys.executable, '-m', 'natural_python', '--help'],
+)
+"""Commands whose time is measured."""
+
+heavy_modules = [
+    'asyncio',
+    'http.client',
+    'natural_python.backends',
+    'platform',
+    'sqlite3',
+]
+"""Modules that must not be imported at startup."""
+
+
+def get_environment() -> dict[str, str]:
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join([
+        str(repository_dir),
+        *environment.get('PYTHONPATH', '').split(os.pathsep),
+    ])
+    return environment
+
+
+def time_command(command: list[str], runs: int) -> list[float]:
+    """Return the wall-clock seconds of each run of the command."""
+    seconds = list()
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env=get_environment(),
+            check=True,
+        )
+        seconds.append(time.perf_counter()-start)
+    return seconds
+
+
+def get_imported_heavy_modules() -> list[str]:
+    """Return the heavy modules that are imported with the console."""
+    code = "\n".join([
+        "import sys",
+        "import natural_python.console",
+        f"print(' '.join(m for m in {heavy_modules!r} if m in sys.modules))",
+    ])
+    output = subprocess.run(
+        [sys.executable, '-c', code],
+        capture_output=True,
+        text=True,
+        env=get_environment(),
+        check=True,
+    ).stdout
+    return output.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--runs',
+        help="Number of times each command is run.",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        '--max-seconds',
+        help="Maximum median seconds of each command.",
+        type=float,
+        default=None,
+    )
+    args = parser.parse_args()
+
+    ok = True
+    # The first run warms up the bytecode cache
+    for name, command in commands.items():
+        time_command(command, 1)
+        seconds = time_command(command, args.runs)
+        median = statistics.median(seconds)
+        print(f"{name}: median {median:.3f}s, min {min(seconds):.3f}s, max {max(seconds):.3f}s over {args.runs} runs")
+        if args.max_seconds is not None and median > args.max_seconds:
+            print(f"{name}: median exceeds {args.max_seconds:.3f}s")
+            ok = False
+
+    imported = get_imported_heavy_modules()
+    print(f"Heavy modules imported at startup: {', '.join(imported) if len(imported) > 0 else 'none'}")
+    if len(imported) > 0:
+        ok = False
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+"""Implementations of language model backends."""
+from typing import Any
+from typing import Callable
+from typing import Generator
+from typing import Optional
+from urllib.parse import urlsplit
+from natural_python.language_model_api import Backend
+from natural_python.language_model_api import Completion
+from natural_python.language_model_api import LanguageModelAPIError
+from natural_python.language_model_api import get_mean
+from natural_python.language_model_api import get_token_logprobs
+from natural_python.language_model_api import parse_candidate
+from natural_python.language_model_api import stream_candidates
+import http.client
+import threading
+import queue
+import json
+import time
+
+
+retry_statuses = [429, 503]
+"""HTTP statuses of requests that are retried: the API is rate limited or
+temporarily unavailable."""
+
+
+class ConnectionPool:
+    """Keep-alive HTTP connections to a host, reused across requests and
+    threads. Up to `size` idle connections are kept open."""
+    def __init__(self, scheme: str, netloc: str, size: int, timeout: float):
+        if scheme == 'https':
+            self.connection_class: Any = http.client.HTTPSConnection
+        elif scheme == 'http':
+            self.connection_class = http.client.HTTPConnection
+        else:
+            raise ValueError(f"Unsupported scheme {scheme}")
+        self.netloc = netloc
+        self.timeout = timeout
+        self.idle: queue.LifoQueue = queue.LifoQueue(maxsize=size)
+
+    def acquire(self) -> tuple[http.client.HTTPConnection, bool]:
+        """Return a connection, and whether it was used before."""
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self.connection_class(self.netloc, timeout=self.timeout), False
+
+    def release(self, connection: http.client.HTTPConnection):
+        """Return a connection whose response was read completely."""
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class HTTPBackend(Backend):
+    """OpenAI-compatible completions API (e.g. GooseAI), accessed over a pool
+    of keep-alive connections. Every backend has its own endpoint and key, so
+    sessions can use different endpoints in the same process.
+
+    Requests that are rate limited or hit an unavailable API are retried with
+    exponential backoff, up to `max_retries` times. Backends of the same
+    endpoint can share a `pool` of connections, which is then not closed with
+    the backend."""
+    def __init__(
+            self,
+            api_base: str,
+            api_key: str,
+            engine_id: str,
+            pool_size: int = 8,
+            timeout: float = 60.0,
+            max_retries: int = 5,
+            pool: Optional[ConnectionPool] = None,
+            ):
+        super().__init__(engine_id)
+        url = urlsplit(api_base)
+        self.api_base = api_base
+        self.base_path = url.path.rstrip('/')
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.owns_pool = pool is None
+        self.pool = pool or ConnectionPool(url.scheme, url.netloc, pool_size, timeout)
+
+    def send(
+            self,
+            method: str,
+            path: str,
+            body: Optional[dict] = None,
+            ) -> tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        """Send a request and return the connection and its response. The
+        response has to be read before releasing the connection to the pool."""
+        headers = {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json',
+        }
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        delay = 1.0
+        for retry_i in range(self.max_retries+1):
+            connection, reused = self.pool.acquire()
+            try:
+                connection.request(method, self.base_path+path, body=data, headers=headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                # The server closed an idle connection, use a new one
+                if reused:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if response.status < 400:
+                return connection, response
+
+            # Read the error so the connection can be reused
+            message = response.read().decode('utf-8', errors='replace')
+            self.pool.release(connection)
+            if response.status not in retry_statuses or retry_i == self.max_retries:
+                raise LanguageModelAPIError(response.status, message)
+            # Honor the delay requested by the API, if any
+            retry_after = response.getheader('retry-after')
+            try:
+                time.sleep(float(retry_after) if retry_after is not None else delay)
+            except ValueError:
+                time.sleep(delay)
+            delay *= 2
+        raise LanguageModelAPIError(0, "Could not connect to the API")
+
+    def request(self, method: str, path: str, body: Optional[dict] = None) -> Any:
+        """Send a request and return its decoded JSON response."""
+        connection, response = self.send(method, path, body)
+        try:
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+        self.pool.release(connection)
+        return json.loads(data)
+
+    def get_events(
+            self,
+            connection: http.client.HTTPConnection,
+            response: http.client.HTTPResponse,
+            cancelled: Optional[threading.Event] = None,
+            ) -> Generator[Any, None, None]:
+        """Return the data of the server-sent events of a streamed
+        response, until `cancelled` is set."""
+        done = False
+        try:
+            for line in response:
+                if cancelled is not None and cancelled.is_set():
+                    return
+                line = line.strip()
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[len(b'data:'):].strip()
+                if data == b'[DONE]':
+                    break
+                yield json.loads(data)
+            # Drain the rest of the response so the connection can be reused
+            response.read()
+            done = True
+        finally:
+            if done:
+                self.pool.release(connection)
+            else:
+                # The stream was abandoned
+                connection.close()
+
+    def complete(
+            self,
+            prompt: str,
+            n: int,
+            max_tokens: int,
+            temperature: float,
+            stop: list[str],
+            stream: bool = False,
+            logprobs: bool = False,
+            on_usage: Optional[Callable[[Any], None]] = None,
+            cancelled: Optional[threading.Event] = None,
+            ) -> Generator[Completion, None, None]:
+        body = dict(
+            prompt=prompt,
+            n=n,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stop=stop,
+            stream=stream,
+        )
+        if logprobs:
+            body['logprobs'] = 1
+        path = f'/engines/{self.engine_id}/completions'
+        if stream:
+            connection, response = self.send('POST', path, body)
+            yield from stream_candidates(self.get_events(connection, response, cancelled), stop)
+            return
+
+        completions = self.request('POST', path, body)
+        usage = completions.get("usage")
+        if on_usage is not None and usage is not None:
+            on_usage(usage)
+        candidates = [
+            Completion(
+                code=parse_candidate(c["text"], stop),
+                mean_logprob=get_mean(get_token_logprobs(c)),
+            )
+            for c in completions["choices"]
+        ]
+        yield from candidates
+
+    def complete_many(
+            self,
+            prompts: list[str],
+            n: int,
+            max_tokens: int,
+            temperature: float,
+            stop: list[str],
+            logprobs: bool = False,
+            on_usage: Optional[Callable[[Any], None]] = None,
+            ) -> list[list[Completion]]:
+        body = dict(
+            prompt=prompts,
+            n=n,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stop=stop,
+        )
+        if logprobs:
+            body['logprobs'] = 1
+        completions = self.request('POST', f'/engines/{self.engine_id}/completions', body)
+        usage = completions.get("usage")
+        if on_usage is not None and usage is not None:
+            on_usage(usage)
+        # The choices of the prompt with index i have indices i*n to i*n+n-1
+        candidates: list[list[Completion]] = [list() for _ in prompts]
+        for c in completions["choices"]:
+            candidates[c["index"]//n].append(Completion(
+                code=parse_candidate(c["text"], stop),
+                mean_logprob=get_mean(get_token_logprobs(c)),
+            ))
+        return candidates
+
+    def get_engines(self) -> Any:
+        return self.request('GET', '/engines')
+
+    def get_engine_ids(self) -> list[str]:
+        return [
+            str(engine['id'])
+            for engine in self.get_engines()['data']
+        ]
+
+    def get_endpoint(self) -> str:
+        return f"{type(self).__name__} {self.api_base}"
+
+    def copy(self) -> 'HTTPBackend':
+        return HTTPBackend(
+            api_base=self.api_base,
+            api_key=self.api_key,
+            engine_id=self.engine_id,
+            max_retries=self.max_retries,
+            pool=self.pool,
+        )
+
+    def close(self):
+        if self.owns_pool:
+            self.pool.close()
+
+
+class FakeBackend(Backend):
+    """Deterministic local backend that serves scripted completions, for
+    trying the interpreter offline. Completions are served in the order of
+    `script`, starting over once it is exhausted, after waiting `latency`
+    seconds for each one. Token usage is estimated by counting words."""
+    def __init__(
+            self,
+            script: list[str],
+            engine_id: str = 'fake',
+            latency: float = 0.0,
+            ):
+        super().__init__(engine_id)
+        if len(script) == 0:
+            raise ValueError("The script of a fake backend can not be empty")
+        self.script = script
+        self.latency = latency
+        self.served_n = 0
+        self.lock = threading.Lock()
+
+    def get_texts(self, n: int) -> list[str]:
+        with self.lock:
+            texts = [
+                self.script[(self.served_n+i) % len(self.script)]
+                for i in range(n)
+            ]
+            self.served_n += n
+        return texts
+
+    def complete(
+            self,
+            prompt: str,
+            n: int,
+            max_tokens: int,
+            temperature: float,
+            stop: list[str],
+            stream: bool = False,
+            logprobs: bool = False,
+            on_usage: Optional[Callable[[Any], None]] = None,
+            cancelled: Optional[threading.Event] = None,
+            ) -> Generator[Completion, None, None]:
+        texts = self.get_texts(n)
+        if not stream:
+            time.sleep(self.latency*n)
+        if on_usage is not None:
+            on_usage(dict(
+                prompt_tokens=len(prompt.split()),
+                completion_tokens=sum(len(t.split()) for t in texts),
+            ))
+        for text in texts:
+            if stream:
+                time.sleep(self.latency)
+                if cancelled is not None and cancelled.is_set():
+                    return
+            # Cut the text at the first stop sequence, like the API does
+            stop_positions = [text.find(s) for s in stop if s in text]
+            if len(stop_positions) > 0:
+                text = text[:min(stop_positions)]
+            yield Completion(code=parse_candidate(text, stop))
+
+    def get_engines(self) -> Any:
+        return dict(data=[dict(id=self.engine_id)])
+
+    def get_engine_ids(self) -> list[str]:
+        return [self.engine_id]
+
+    def copy(self) -> 'FakeBackend':
+        return FakeBackend(self.script, self.engine_id, self.latency)
+
+
+def load_fake_script(path: str) -> list[str]:
+    """Load the completions of a fake backend from a JSON file with a list of
+    strings."""
+    with open(path, "rt") as fp:
+        script = json.load(fp)
+    if not isinstance(script, list) or not all(isinstance(t, str) for t in script):
+        raise ValueError(f"{path} is not a JSON list of strings")
+    return script
@@ -0,0 +1,326 @@
+"""Caches that let sessions skip work that was done before."""
+from typing import Callable
+from typing import Generator
+from typing import Iterable
+from typing import Optional
+from typing import TYPE_CHECKING
+from pathlib import Path
+from dataclasses import asdict
+from dataclasses import dataclass
+from collections import OrderedDict
+from natural_python.language_model_api import Completion
+import threading
+import hashlib
+import ast
+import json
+import time
+import os
+
+if TYPE_CHECKING:
+    import sqlite3
+
+
+class CompletionCache:
+    """On-disk cache of the completions sampled for a prompt with some sampling
+    parameters.
+
+    Entries are evicted in least-recently-used order once they take more than
+    `max_bytes`."""
+    def __init__(self, directory: Path, max_bytes: int):
+        self.path = directory/'completions.sqlite3'
+        self.max_bytes = max_bytes
+        self.hits = 0
+        """Lookups served without sampling the language model."""
+        self.partial_hits = 0
+        """Lookups served from the cache and topped up with new samples."""
+        self.misses = 0
+        """Lookups that had to sample the language model."""
+        directory.mkdir(parents=True, exist_ok=True)
+        with self.connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    candidates TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+
+    def connect(self) -> 'sqlite3.Connection':
+        # Completions are read from background threads, so every operation
+        # uses its own connection. sqlite3 is only imported once a cache is
+        # used, to keep startup fast
+        import sqlite3
+        return sqlite3.connect(self.path, timeout=10.0)
+
+    @staticmethod
+    def get_key(
+            endpoint: str,
+            engine_id: str,
+            prompt: str,
+            temperature: float,
+            max_tokens: int,
+            stop_sequences: list[str],
+            logprobs: bool,
+            ) -> str:
+        """Get the cache key of the completions sampled with the given
+        parameters, from the engine of an endpoint (see
+        `Backend.get_endpoint`)."""
+        parameters = json.dumps([
+            endpoint,
+            engine_id,
+            prompt,
+            temperature,
+            max_tokens,
+            stop_sequences,
+            logprobs,
+        ])
+        return hashlib.sha256(parameters.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> list[Completion]:
+        """Return the cached completions for the given key, which may be
+        empty."""
+        with self.connect() as db:
+            row = db.execute(
+                "SELECT candidates FROM completions WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return list()
+            db.execute(
+                "UPDATE completions SET last_used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        return [Completion(**c) for c in json.loads(row[0])]
+
+    def put(self, key: str, completions: list[Completion]):
+        """Store the completions for the given key, evicting the least recently
+        used entries if the cache gets too big."""
+        value = json.dumps([asdict(c) for c in completions])
+        with self.connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            total_size = db.execute("SELECT SUM(size) FROM completions").fetchone()[0]
+            entries = db.execute(
+                "SELECT key, size FROM completions ORDER BY last_used"
+            ).fetchall()
+            for evicted_key, size in entries:
+                if total_size <= self.max_bytes:
+                    break
+                db.execute("DELETE FROM completions WHERE key = ?", (evicted_key,))
+                total_size -= size
+
+
+def get_cached_completions(
+        cache: Optional[CompletionCache],
+        key: str,
+        sample_n: int,
+        temperature: float,
+        get_completions: Callable[[int], Iterable[Completion]],
+        ) -> Generator[Completion, None, None]:
+    """Return `sample_n` completions, taking as many as possible from the cache.
+    `get_completions(n)` samples `n` new completions, and the ones that are
+    read are added to the cache.
+
+    At temperature zero every sample is the same, so any cached completion is
+    enough."""
+    if cache is None:
+        yield from get_completions(sample_n)
+        return
+
+    cached = cache.get(key)
+    if len(cached) > 0 and (temperature == 0 or len(cached) >= sample_n):
+        cache.hits += 1
+        yield from cached[:sample_n]
+        return
+    if len(cached) > 0:
+        cache.partial_hits += 1
+    else:
+        cache.misses += 1
+    yield from cached
+
+    # Top up the cached completions with new samples. The completions might
+    # not be read to the end, so whatever was read is stored
+    new_completions = list()
+    try:
+        for completion in get_completions(sample_n-len(cached)):
+            new_completions.append(completion)
+            yield completion
+    finally:
+        if len(new_completions) > 0:
+            cache.put(key, [*cached, *new_completions])
+
+
+@dataclass
+class ValidationFailure:
+    """Failure of a candidate executed with a constraint."""
+    reason: str
+    """Last line of the error, e.g. the exception raised."""
+
+
+class ValidationCache:
+    """In-memory cache of the candidates that failed on top of some committed
+    code, so they are not executed again when an instruction is retried. Up
+    to `max_entries` failures are kept, evicting the least recently used
+    ones. Only failures that happen every time are stored, not e.g. running
+    out of wall-clock time.
+
+    Code is assumed to be deterministic: a candidate that failed once fails
+    again on top of the same code, with the same limits, and with any
+    constraint that adds statements after the ones it failed with."""
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.failures: OrderedDict[str, ValidationFailure] = OrderedDict()
+        self.lock = threading.Lock()
+        self.skipped = 0
+        """Candidates not executed because they are known to fail."""
+
+    @staticmethod
+    def get_key(
+            committed_key: str,
+            candidate: str,
+            constraint: list[str],
+            limits: dict,
+            ) -> str:
+        """Get the cache key of a `candidate`, as normalized code, executed
+        on top of the code with key `committed_key`."""
+        parameters = json.dumps([
+            committed_key,
+            candidate,
+            [l.rstrip() for l in constraint],
+            limits,
+        ])
+        return hashlib.sha256(parameters.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[ValidationFailure]:
+        with self.lock:
+            failure = self.failures.get(key)
+            if failure is not None:
+                self.failures.move_to_end(key)
+            return failure
+
+    def put(self, key: str, failure: ValidationFailure):
+        with self.lock:
+            self.failures[key] = failure
+            self.failures.move_to_end(key)
+            while len(self.failures) > self.max_entries:
+                self.failures.popitem(last=False)
+
+    def get_known_failure(
+            self,
+            committed_key: str,
+            candidate: str,
+            constraint: list[str],
+            limits: dict,
+            ) -> Optional[ValidationFailure]:
+        """Get the failure of the candidate with the constraint, or with a
+        constraint that the given one extends with more statements (e.g.
+        before an assertion was added to it), if it is known."""
+        for line_n in get_statement_boundaries(candidate, constraint):
+            failure = self.get(self.get_key(committed_key, candidate, constraint[:line_n], limits))
+            if failure is not None:
+                return failure
+        return None
+
+
+def get_statement_boundaries(candidate: str, constraint: list[str]) -> list[int]:
+    """Numbers of lines of the constraint after which a top-level statement
+    ends, so the lines before run the same with or without the lines after.
+
+    A prefix that ends inside a statement is not one: e.g. lines added to an
+    indented block, or an `else` clause, change how the lines before run. If
+    the candidate or the constraint do not parse on their own, only the whole
+    constraint is a boundary."""
+    try:
+        ast.parse(candidate)
+        statements = ast.parse("\n".join(constraint)).body
+    except (SyntaxError, ValueError):
+        return [len(constraint)]
+    boundaries = set(range(len(constraint)+1))
+    for statement in statements:
+        # Decorators come before the line of their function or class
+        first_line = min(
+            [statement.lineno, *(d.lineno for d in getattr(statement, 'decorator_list', []))]
+        )
+        boundaries -= set(range(first_line, statement.end_lineno))
+    return sorted(boundaries)
+
+
+class EngineCatalogue:
+    """Engine IDs available at an API endpoint, cached on disk so sessions do
+    not wait for the API to list them. Without a `directory`, the catalogue is
+    only kept in memory during the session.
+
+    A cached catalogue older than `ttl` seconds is still used, but refreshed in
+    the background. The API is only waited for when there is no cached
+    catalogue, or when an engine is not in it."""
+    def __init__(
+            self,
+            directory: Optional[Path],
+            api_base: str,
+            ttl: float,
+            get_engine_ids: Callable[[], list[str]],
+            ):
+        self.path = directory/'engines.json' if directory is not None else None
+        self.api_base = api_base
+        self.ttl = ttl
+        self.get_engine_ids = get_engine_ids
+        self.lock = threading.Lock()
+        self.refresher: Optional[threading.Thread] = None
+        self.catalogues: dict = dict()
+        """Catalogues of each endpoint, when they are not cached on disk."""
+        if directory is not None:
+            directory.mkdir(parents=True, exist_ok=True)
+
+    def read(self) -> dict:
+        if self.path is None:
+            return dict(self.catalogues)
+        try:
+            with open(self.path, "rt") as fp:
+                return json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return dict()
+
+    def refresh(self) -> list[str]:
+        """List the engines with the API and cache them."""
+        engine_ids = self.get_engine_ids()
+        with self.lock:
+            catalogues = self.read()
+            catalogues[self.api_base] = dict(
+                engine_ids=engine_ids,
+                time=time.time(),
+            )
+            if self.path is None:
+                self.catalogues = catalogues
+                return engine_ids
+            # Replace the file at once, so it is never read half-written
+            temporary_path = self.path.with_suffix('.tmp')
+            with open(temporary_path, "wt") as fp:
+                json.dump(catalogues, fp)
+            os.replace(temporary_path, self.path)
+        return engine_ids
+
+    def refresh_in_background(self):
+        if self.refresher is not None and self.refresher.is_alive():
+            return
+
+        def refresh():
+            # Failures are not a problem until the engines are needed
+            try:
+                self.refresh()
+            except Exception:
+                pass
+        self.refresher = threading.Thread(target=refresh, daemon=True)
+        self.refresher.start()
+
+    def is_available(self, engine_id: str) -> bool:
+        """Check whether the engine is available at the endpoint."""
+        catalogue = self.read().get(self.api_base)
+        if catalogue is not None and engine_id in catalogue['engine_ids']:
+            if time.time()-catalogue['time'] > self.ttl:
+                self.refresh_in_background()
+            return True
+        # The engine may be new
+        return engine_id in self.refresh()
@@ -0,0 +1,110 @@
+"""Checkpoints of sessions, so they can be resumed after the interpreter
+exits without replaying their code in every candidate."""
+from typing import Optional
+from pathlib import Path
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import field
+from natural_python.worker import Worker
+import json
+import os
+
+
+checkpoint_version = 1
+"""Version of the checkpoint format. Checkpoints of other versions can not be
+resumed."""
+
+
+@dataclass
+class CheckpointEntry:
+    """A block executed in a session: an instruction, or raw Python code."""
+    instruction: list[str]
+    constraint: list[str]
+    parameters: list[str]
+    """Lines of the form `PARAM = VALUE` that changed execution parameters
+    before the instruction was executed."""
+    code: list[str]
+    """Python code the block added to the session."""
+    output: Optional[str] = None
+    """Output of the code to stdout, if it was executed."""
+    ok: bool = True
+
+
+@dataclass
+class Checkpoint:
+    code: list[str]
+    """Python code of the session."""
+    entries: list[CheckpointEntry] = field(default_factory=list)
+    namespace: Optional[str] = None
+    """State of the interpreter serialized by `Worker.snapshot`, or None if it
+    could not be serialized."""
+    namespace_code_n: int = 0
+    """Lines of `code` whose execution resulted in `namespace`."""
+    version: int = checkpoint_version
+
+
+def save_checkpoint(path: Path, checkpoint: Checkpoint):
+    # Replace the file at once, so a crash never leaves it half-written
+    temporary_path = path.with_name(path.name+'.tmp')
+    with open(temporary_path, "wt") as fp:
+        json.dump(asdict(checkpoint), fp)
+    os.replace(temporary_path, path)
+
+
+def load_checkpoint(path: Path) -> Checkpoint:
+    """Read a checkpoint. Raises `ValueError` if it is not a valid checkpoint
+    of the current version."""
+    with open(path, "rt") as fp:
+        data = json.load(fp)
+    if not isinstance(data, dict) or data.get('version') != checkpoint_version:
+        raise ValueError(f"{path} is not a checkpoint of version {checkpoint_version}")
+    try:
+        return Checkpoint(
+            code=data['code'],
+            entries=[CheckpointEntry(**e) for e in data['entries']],
+            namespace=data['namespace'],
+            namespace_code_n=data['namespace_code_n'],
+        )
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid checkpoint {path}: {e}")
+
+
+def restore_checkpoint(checkpoint: Checkpoint, python_worker: Worker) -> bool:
+    """Load the interpreter state of a checkpoint into the worker. Returns
+    False if the state could not be loaded, in which case the code of the
+    session is replayed once, the next time the worker is synchronized."""
+    if checkpoint.namespace is None:
+        return False
+    return python_worker.restore(
+        checkpoint.code[:checkpoint.namespace_code_n],
+        checkpoint.namespace,
+    )
+
+
+class CheckpointWriter:
+    """Saves a checkpoint of a session to `path` after every block it
+    executes, starting from the `entries` of a resumed session."""
+    def __init__(
+            self,
+            path: Path,
+            python_worker: Worker,
+            entries: Optional[list[CheckpointEntry]] = None,
+            ):
+        self.path = path
+        self.python_worker = python_worker
+        self.entries: list[CheckpointEntry] = list(entries or [])
+
+    def record(self, entry: CheckpointEntry, current_code: list[str]):
+        self.entries.append(entry)
+        # The worker may be behind the session, e.g. raw code is only
+        # executed with the next instruction
+        committed_code = self.python_worker.committed_code
+        namespace = None
+        if current_code[:len(committed_code)] == committed_code:
+            namespace = self.python_worker.snapshot()
+        save_checkpoint(self.path, Checkpoint(
+            code=list(current_code),
+            entries=self.entries,
+            namespace=namespace,
+            namespace_code_n=len(committed_code) if namespace is not None else 0,
+        ))
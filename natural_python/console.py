@@ -1,24 +1,38 @@
-from importlib.metadata import version
-from platform import python_version
 from enum import Enum
 from enum import auto
+from dataclasses import dataclass
+from dataclasses import replace
 from pathlib import Path
+from typing import Iterable
 import argparse
 from natural_python import language_model_api
 from natural_python import interpreter
+from natural_python import worker
+from natural_python import cache
+from natural_python import checkpoint
+from natural_python import context
+from natural_python import search
+from natural_python import profiling
+from natural_python import rendering
 from pathlib import Path
 import shutil
 import json
-import os
 
 import tempfile
+import sys
+import os
 import re
 
 
 # Is this a security risk?
 api_file = Path(__file__).parent/'api.json'
 
+default_cache_dir = Path(os.environ.get('XDG_CACHE_HOME') or Path.home()/'.cache')/'natural-python'
+
 help_keyword = "help"
+stats_keyword = "stats"
+profile_keyword = "profile"
+redraw_keyword = "redraw"
 exit_keyword = "exit"
 constraint_keyword = "finally:"
 restart_keyword = "restart"
@@ -26,6 +40,9 @@ python_keyword = "python"
 parameter_keyword = 'with:'
 keywords = [
     help_keyword,
+    stats_keyword,
+    profile_keyword,
+    redraw_keyword,
     exit_keyword,
     constraint_keyword,
     restart_keyword,
@@ -39,20 +56,20 @@ dynamic_execution_parameters = [
     'max_sample_tokens',
     'sample_temperature',
     'engine_id',
+    'timeout',
+    'cpu_time',
+    'memory_limit',
+    'output_limit',
+    'max_prompt_tokens',
 ]
 """Parameters that can be changed on-the-fly in the REPL."""
 
-dynamic_execution_parameter_regex = r'\s*(\S+)\s*=\s*(\S+)'
+dynamic_execution_parameter_regex = r'\s*(\S+)\s*=\s*(.*\S)\s*'
 """Regex to parse dynamic execution parameters."""
 
 backspace_key_code = '\x7f'
 
 
-def clear_screen():
-    # https://stackoverflow.com/a/2084628
-    os.system('cls' if os.name == 'nt' else 'clear')
-
-
 def get_help_message() -> list[str]:
     help_message =\
         f"""DO NOT ATTEMPT, EVER, TO EXECUTE CODE THAT MODIFIES YOUR FILESYSTEM. INTERACTING WITH THIS TOOL IS EXTREMELY RISKY, DO SO AT YOUR OWN PERIL.
@@ -61,7 +78,7 @@ In Natural Python, you primarily express intent with natural language.
 
 - A block of commented lines represents your intent.
 - Everything in a block represents a single instruction.
-- You can change execution parameters by using '{parameter_keyword}', followed by one or more lines of the form 'PARAM = VALUE', where PARAM is any of {dynamic_execution_parameters}.
+- You can change execution parameters by using '{parameter_keyword}', followed by one or more lines of the form 'PARAM = VALUE', where PARAM is any of {dynamic_execution_parameters}. 'sample_n' and 'sample_temperature' accept comma-separated schedules, e.g. 'sample_n = 2,8,32'. Limits ('timeout' and 'cpu_time' in seconds, 'memory_limit' and 'output_limit' in megabytes) and 'max_prompt_tokens' can be disabled with 'none'.
 - You can constrain the execution by ending the comment block with '{constraint_keyword}', followed by a line break and Python code that has to run successfully after executing your instruction.
 
 Once you enter an empty line, your intent will be executed by the computer by finding Python code that runs without exceptions.
@@ -75,6 +92,70 @@ The following illustrates these concepts. Try it out!
 """
     return help_message.split('\n')
 
+def parse_limit(text: str) -> (None|float):
+    """Parse the value of an execution limit, which is disabled by `none`."""
+    if text.lower() == 'none':
+        return None
+    limit = float(text)
+    if limit <= 0:
+        raise ValueError(f"Invalid limit {text}")
+    return limit
+
+
+def parse_memory_limit(text: str) -> (None|int):
+    """Parse a limit in megabytes (e.g. of memory), returning it in bytes."""
+    limit = parse_limit(text)
+    if limit is None:
+        return None
+    return int(limit*2**20)
+
+
+def parse_count(text: str) -> int:
+    """Parse a positive number of things, e.g. of workers."""
+    count = int(text)
+    if count <= 0:
+        raise ValueError(f"Invalid count {text}")
+    return count
+
+
+def parse_token_budget(text: str) -> (None|int):
+    """Parse a budget of tokens, which is disabled by `none`."""
+    if text.lower() == 'none':
+        return None
+    budget = int(text)
+    if budget <= 0:
+        raise ValueError(f"Invalid token budget {text}")
+    return budget
+
+
+def get_statistics_message(
+        completion_cache: (None|cache.CompletionCache),
+        validation_cache: (None|cache.ValidationCache),
+        search_statistics: search.SearchStatistics,
+        ) -> list[str]:
+    statistics_message = [
+        f"Candidates: {search_statistics.sampled} sampled, {search_statistics.duplicates} duplicates pruned, {search_statistics.syntax_errors} syntax errors pruned, {search_statistics.validated} validated.",
+    ]
+    if search_statistics.successes > 0:
+        mean_tried = search_statistics.tried_before_success/search_statistics.successes
+        statistics_message.append(
+            f"Candidates tried before success: {mean_tried:.2f} on average over {search_statistics.successes} instructions.",
+        )
+    if completion_cache is None:
+        statistics_message.append("Completion cache disabled.")
+    else:
+        statistics_message.append(
+            f"Completion cache: {completion_cache.hits} hits, {completion_cache.partial_hits} partial hits, {completion_cache.misses} misses.",
+        )
+    if validation_cache is None:
+        statistics_message.append("Validation cache disabled.")
+    else:
+        statistics_message.append(
+            f"Validation cache: {validation_cache.skipped} candidates known to fail skipped.",
+        )
+    return statistics_message
+
+
 python_shell_candidates = [
     "python3",
     "python",
@@ -96,15 +177,129 @@ class ParseException(Exception):
         self.cause = cause
 
 
+@dataclass
+class SessionParameters:
+    """Parameters of the execution of the instructions of a session. The ones
+    in `dynamic_execution_parameters` can be changed during the session."""
+    backend: language_model_api.Backend
+    max_sample_tokens: int
+    sample_n: list[int]
+    sample_temperature: list[float]
+    python_worker: worker.Worker
+    engine_catalogue: cache.EngineCatalogue
+    stream: bool
+    sample_concurrency: int
+    completion_cache: (None|cache.CompletionCache)
+    ranking: str
+    validation_cache: (None|cache.ValidationCache)
+    prompt_context: context.PromptContext
+    speculate: bool
+    """Whether the REPL samples the completions of an instruction while its
+    constraint is typed."""
+
+
+def set_execution_parameter(parameters: SessionParameters, user_input: str):
+    """Change an execution parameter given a line of the form `PARAM = VALUE`."""
+    parameter_regex_match = re.match(
+        dynamic_execution_parameter_regex,
+        user_input
+    )
+    if parameter_regex_match is None:
+        raise ParseException("Parameter could not be parsed! It should be of the form PARAM = VALUE.")
+    parameter = parameter_regex_match.group(1)
+    value = parameter_regex_match.group(2)
+    if parameter == 'sample_n':
+        parameters.sample_n = search.parse_sample_schedule(value)
+    elif parameter == 'max_sample_tokens':
+        parameters.max_sample_tokens = int(value)
+    elif parameter == 'sample_temperature':
+        parameters.sample_temperature = search.parse_temperature_schedule(value)
+    elif parameter == 'engine_id':
+        if not parameters.engine_catalogue.is_available(value):
+            raise ParseException(f"Invalid engine ID: {value}!")
+        parameters.backend.engine_id = value
+    elif parameter == 'timeout':
+        parameters.python_worker.limits.timeout = parse_limit(value)
+    elif parameter == 'cpu_time':
+        parameters.python_worker.limits.cpu_time = parse_limit(value)
+    elif parameter == 'memory_limit':
+        parameters.python_worker.limits.memory = parse_memory_limit(value)
+    elif parameter == 'output_limit':
+        parameters.python_worker.limits.output = parse_memory_limit(value)
+    elif parameter == 'max_prompt_tokens':
+        parameters.prompt_context.max_tokens = parse_token_budget(value)
+    else:
+        raise ParseException(f'Parameter name {parameter} not recognized!')
+
+
+def execute_instruction(
+        program: interpreter.NaturalProgram,
+        current_python_code: list[str],
+        parameters: SessionParameters,
+        search_statistics: search.SearchStatistics,
+        trace: profiling.InstructionTrace,
+        speculation: (None|interpreter.SpeculativeBatch) = None,
+        ) -> tuple[list[str], str]:
+    """Execute a natural program with the parameters of the session, see
+    `interpreter.execute_natural_program`."""
+    return interpreter.execute_natural_program(
+        program=program,
+        current_python_code=current_python_code,
+        sample_n=parameters.sample_n,
+        python_worker=parameters.python_worker,
+        backend=parameters.backend,
+        max_sample_tokens=parameters.max_sample_tokens,
+        sample_temperature=parameters.sample_temperature,
+        stream=parameters.stream,
+        sample_concurrency=parameters.sample_concurrency,
+        completion_cache=parameters.completion_cache,
+        statistics=search_statistics,
+        ranking=parameters.ranking,
+        trace=trace,
+        prompt_context=parameters.prompt_context,
+        speculation=speculation,
+        validation_cache=parameters.validation_cache,
+    )
+
+
+def speculate_instruction(
+        instruction: list[str],
+        current_python_code: list[str],
+        parameters: SessionParameters,
+        ) -> interpreter.SpeculativeBatch:
+    """Start sampling completions of an instruction with the parameters of the
+    session, see `interpreter.speculate_natural_program`."""
+    return interpreter.speculate_natural_program(
+        instruction=instruction,
+        current_python_code=current_python_code,
+        sample_n=parameters.sample_n,
+        backend=parameters.backend,
+        max_sample_tokens=parameters.max_sample_tokens,
+        sample_temperature=parameters.sample_temperature,
+        stream=parameters.stream,
+        sample_concurrency=parameters.sample_concurrency,
+        completion_cache=parameters.completion_cache,
+        ranking=parameters.ranking,
+        prompt_context=parameters.prompt_context,
+    )
+
+
 def get_start_message(
         engine_id: str,
         ) -> list[str]:
+    # Reading the metadata of the package and of the platform takes a while,
+    # so it is only done when the REPL starts
+    from importlib.metadata import version
+    from platform import python_version
     start_message = [
         f"Natural Python {version('natural_python')} on Python {python_version()}",
         f"Language model engine ID: {engine_id}",
         f"Type {exit_keyword} to exit.",
         f"Type {restart_keyword} to erase your current instruction.",
         f"Type {python_keyword} to bypass the Natural Python interpreter and write raw Python to the stream.",
+        f"Type {stats_keyword} to display search statistics.",
+        f"Type {profile_keyword} to display where the time of the last instructions went.",
+        f"Type {redraw_keyword} to redraw the screen.",
         f"Type {help_keyword} for more information.",
         f"Run the interpreter with --help for more options.",
     ]
@@ -112,36 +307,45 @@ def get_start_message(
 
 
 def repl(
-        engine_id: str,
-        api_key: str,
-        api_base: str,
-        max_sample_tokens: int,
-        sample_n: int,
-        sample_temperature: float,
-        python_shell: str,
-        available_engine_ids: list[str],
+        parameters: SessionParameters,
+        profiler: (None|profiling.Profiler),
+        current_python_code: (None|list[str]) = None,
+        checkpoint_writer: (None|checkpoint.CheckpointWriter) = None,
+        start_message: (None|list[str]) = None,
         ) -> list[str]:
-    """Read-eval-print loop. Returns the executed python code."""
+    """Read-eval-print loop, continuing the session code
+    `current_python_code` if given. Returns the executed python code."""
     keep_interpreting = True
     current_instruction = list()
     current_constraint = list()
-    current_python_code = list()
+    current_parameters = list()
+    current_python_code = list(current_python_code or [])
+    search_statistics = search.SearchStatistics()
+    # Completions of the current instruction sampled while its constraint is
+    # typed
+    speculation: (None|interpreter.SpeculativeBatch) = None
 
     state = State.reading_instruction
 
-    ui_log_data = list()
-    ui_log_data.extend(get_start_message(
-        engine_id=engine_id,
+    renderer = rendering.Renderer()
+    renderer.redraw()
+    renderer.add(get_start_message(
+        engine_id=parameters.backend.engine_id,
     ))
+    if start_message is not None:
+        renderer.add(start_message)
 
     while keep_interpreting:
-        clear_screen()
-        print("\n".join(ui_log_data))
+        renderer.refresh()
 
         # State machine loop
         if state is State.restarting_instruction_reading:
             current_instruction = list()
             current_constraint = list()
+            current_parameters = list()
+            if speculation is not None:
+                speculation.cancel()
+                speculation = None
             state = State.reading_instruction
         elif state is State.ready_to_execute:
             program = interpreter.NaturalProgram(
@@ -149,35 +353,51 @@ def repl(
                 constraint=current_constraint,
             )
             # Execute natural program
+            trace = profiling.InstructionTrace()
+            initial_statistics = replace(search_statistics)
+
+            def get_progress_message() -> str:
+                received = search_statistics.sampled-initial_statistics.sampled
+                validated = search_statistics.validated-initial_statistics.validated
+                failed = search_statistics.failed-initial_statistics.failed
+                return f"Please wait... {received} candidates received, {validated} validated, {failed} failed."
             try:
-                print('Please wait...')
-                new_python_code, output = interpreter.execute_natural_program(
-                    program=program,
-                    current_python_code=current_python_code,
-                    sample_n=sample_n,
-                    python_shell=python_shell,
-                    engine_id=engine_id,
-                    api_key=api_key,
-                    api_base=api_base,
-                    max_sample_tokens=max_sample_tokens,
-                    sample_temperature=sample_temperature,
-                )
+                with renderer.progress(get_progress_message):
+                    new_python_code, output = execute_instruction(
+                        program=program,
+                        current_python_code=current_python_code,
+                        parameters=parameters,
+                        search_statistics=search_statistics,
+                        trace=trace,
+                        speculation=speculation,
+                    )
 
                 # Print executed code
-                ui_log_data.extend(['>>> '+l for l in new_python_code])
-                ui_log_data.append(output)
+                renderer.add(['>>> '+l for l in new_python_code])
+                renderer.add([output])
 
                 # Update current python code
-                commented_instructions = ['# '+l for l in program.instruction]
+                commented_instructions = interpreter.get_commented_instruction(program)
                 current_python_code.extend([
                     *commented_instructions,
                     *new_python_code,
                 ])
+                if checkpoint_writer is not None:
+                    checkpoint_writer.record(checkpoint.CheckpointEntry(
+                        instruction=current_instruction,
+                        constraint=current_constraint,
+                        parameters=current_parameters,
+                        code=[*commented_instructions, *new_python_code],
+                        output=output,
+                    ), current_python_code)
             except interpreter.NaturalInterpreterError as e:
-                ui_log_data.append("ERROR: Failed to execute code with budget. Maybe try more detailed instructions?")
+                renderer.add(["ERROR: Failed to execute code with budget. Maybe try more detailed instructions?"])
                 if e.first_code is not None:
-                    ui_log_data.append("This is the first code that was considered:")
-                    ui_log_data.extend(e.first_code)
+                    renderer.add(["This is the first code that was considered:"])
+                    renderer.add(e.first_code)
+            finally:
+                if profiler is not None:
+                    profiler.record(trace)
 
             state = State.restarting_instruction_reading
         else:
@@ -193,11 +413,9 @@ def repl(
 
             # Parse input
             try:
-                # Read input
-                # Hate to hack around a bit, but we need to render
-                # the UI and read user input simultaneously
+                # Read input. The terminal echoes it, so it is already
+                # displayed
                 user_input = str(input(prompt))
-                print(user_input)
 
                 # Sanitize user input
                 user_input = user_input.strip()
@@ -208,19 +426,44 @@ def repl(
                     # so we reprint the line as a comment...
                     # Except if the keyword is 'python', which is not displayed.
                     if user_input != python_keyword:
-                        ui_log_data.append(f">>> # {user_input}")
+                        renderer.add([f">>> # {user_input}"], shown=True)
                 else:
-                    ui_log_data.append(prompt+user_input)
+                    renderer.add([prompt+user_input], shown=True)
 
                 # Check if input is a keyword
                 if user_input in keywords:
                     # Decide how to proceed
                     if user_input == help_keyword:
                         # Help
-                        ui_log_data.extend(get_help_message())
+                        renderer.add(get_help_message())
+                    elif user_input == stats_keyword:
+                        renderer.add(get_statistics_message(
+                            parameters.completion_cache,
+                            parameters.validation_cache,
+                            search_statistics,
+                        ))
+                    elif user_input == profile_keyword:
+                        if profiler is None:
+                            renderer.add(["Profiling disabled, use --profile to enable it."])
+                        else:
+                            renderer.add(profiler.get_summary())
+                    elif user_input == redraw_keyword:
+                        renderer.redraw()
                     elif user_input == exit_keyword:
                         keep_interpreting = False
+                        if speculation is not None:
+                            speculation.cancel()
                     elif user_input == constraint_keyword:
+                        # The instruction and its parameters are complete,
+                        # and the prompt does not depend on the constraint,
+                        # so sampling can start
+                        reading_instruction = state in (State.reading_instruction, State.reading_execution_parameters)
+                        if parameters.speculate and reading_instruction and len(current_instruction) > 0 and speculation is None:
+                            speculation = speculate_instruction(
+                                current_instruction,
+                                current_python_code,
+                                parameters,
+                            )
                         # Start constraint reading
                         state = State.reading_constraint
                     elif user_input == restart_keyword:
@@ -250,85 +493,277 @@ def repl(
                     current_constraint.append(user_input)
                 elif state is State.reading_raw_code:
                     current_python_code.append(user_input)
+                    if checkpoint_writer is not None:
+                        checkpoint_writer.record(checkpoint.CheckpointEntry(
+                            instruction=list(),
+                            constraint=list(),
+                            parameters=list(),
+                            code=[user_input],
+                        ), current_python_code)
                 elif state is State.reading_execution_parameters:
                     # Parse parameter redefinition
-                    parameter_regex_match = re.match(
-                        dynamic_execution_parameter_regex,
-                        user_input
-                    )
-                    if parameter_regex_match is None:
-                        raise ParseException("Parameter could not be parsed! It should be of the form PARAM = VALUE.")
-                    parameter = parameter_regex_match.group(1)
-                    value = parameter_regex_match.group(2)
-                    if parameter == 'sample_n':
-                        sample_n = int(value)
-                    elif parameter == 'max_sample_tokens':
-                        max_sample_tokens = int(value)
-                    elif parameter == 'sample_temperature':
-                        sample_temperature = float(value)
-                    elif parameter == 'engine_id':
-                        if value not in available_engine_ids:
-                            raise ParseException(f"Invalid engine ID: {value}!")
-                        engine_id = value
-                    else:
-                        raise ParseException(f'Parameter name {parameter} not recognized!')
+                    set_execution_parameter(parameters, user_input)
+                    current_parameters.append(user_input)
                 else:
                     # This should never happen
                     raise ParseException("You did not format your input correctly... try again...")
             except EOFError:
                 keep_interpreting = False
+                if speculation is not None:
+                    speculation.cancel()
             except ParseException as e:
-                ui_log_data.append(e.cause)
-                ui_log_data.append("Please input your instruction again.")
+                renderer.add([e.cause, "Please input your instruction again."])
                 state = State.restarting_instruction_reading
             except Exception as e:
-                ui_log_data.append(e)
-                ui_log_data.append("Please input your instruction again.")
+                renderer.add([e, "Please input your instruction again."])
                 state = State.restarting_instruction_reading
     return current_python_code
 
 
-def main():
-    # Check if API key is present
+@dataclass
+class ScriptBlock:
+    """A block of a natural script: either an instruction, optionally with
+    parameter changes and a constraint, or raw Python code."""
+    line_n: int
+    """Line of the script where the block starts, counting from 1."""
+    instruction: list[str]
+    constraint: list[str]
+    parameters: list[str]
+    """Lines of the form `PARAM = VALUE` that change execution parameters
+    before the instruction is executed."""
+    python_code: list[str]
+
+
+def parse_natural_script(lines: Iterable[str]) -> list[ScriptBlock]:
+    """Parse a natural script, written as the input of the REPL: instructions
+    and keywords are comments, like they are displayed after the `>>> # `
+    prompt, while constraints, parameters and raw Python code are written as
+    they are. Blocks end with an empty line.
+
+    Unlike in the REPL, the indentation of code is kept."""
+    blocks: list[ScriptBlock] = list()
+    state = State.reading_instruction
+    block = None
+    for line_n, line in enumerate(lines, start=1):
+        line = line.rstrip('\r\n').rstrip()
+        stripped_line = line.strip()
+        if stripped_line.startswith('#'):
+            comment = stripped_line[1:].strip()
+        else:
+            comment = None
+        if block is None:
+            block = ScriptBlock(line_n, list(), list(), list(), list())
+
+        if comment in keywords:
+            if comment == exit_keyword:
+                break
+            elif comment == constraint_keyword:
+                state = State.reading_constraint
+            elif comment == restart_keyword:
+                block = None
+                state = State.reading_instruction
+            elif comment == python_keyword:
+                if len(block.instruction) != 0 or len(block.constraint) != 0:
+                    raise ParseException(f"Line {line_n}: you can only use '{python_keyword}' before providing any instructions or constraints!")
+                state = State.reading_raw_code
+            elif comment == parameter_keyword:
+                if state is not State.reading_instruction:
+                    raise ParseException(f"Line {line_n}: you can only use '{parameter_keyword}' after providing instructions and before adding constraints!")
+                state = State.reading_execution_parameters
+            # Other keywords only make sense in the REPL
+        elif len(stripped_line) == 0:
+            # Block end
+            if len(block.instruction) != 0 or len(block.constraint) != 0 or len(block.python_code) != 0:
+                blocks.append(block)
+            block = None
+            state = State.reading_instruction
+        elif state is State.reading_instruction:
+            if comment is None:
+                raise ParseException(f"Line {line_n}: instructions have to be comments!")
+            block.instruction.append(comment)
+        elif state is State.reading_constraint:
+            block.constraint.append(line)
+        elif state is State.reading_raw_code:
+            block.python_code.append(line)
+        else:  # state is State.reading_execution_parameters
+            block.parameters.append(stripped_line)
+
+    if block is not None and (len(block.instruction) != 0 or len(block.constraint) != 0 or len(block.python_code) != 0):
+        blocks.append(block)
+    return blocks
+
+
+def execute_block(
+        block: ScriptBlock,
+        current_python_code: list[str],
+        parameters: SessionParameters,
+        search_statistics: search.SearchStatistics,
+        profiler: (None|profiling.Profiler),
+        ) -> dict:
+    """Execute an instruction block like the REPL would, extending
+    `current_python_code` on success. Returns a report of the execution."""
+    result: dict = dict(instruction=block.instruction)
     try:
-        with open(api_file, "rt") as fp:
-            api_config = json.load(fp)
-    except FileNotFoundError:
-        print("Initial configuration. You will only have to do this once.")
-        print("Get an API key at https://goose.ai/dashboard/apikeys.")
-        api_base = input("API base (e.g. https://api.goose.ai/v1, https://api.openai.com/v1): ")
-        api_key = input("API key: ")
-        api_config = dict(
-            api_key=api_key,
-            api_base=api_base,
+        for parameter in block.parameters:
+            set_execution_parameter(parameters, parameter)
+    except (ParseException, ValueError) as e:
+        result.update(
+            ok=False,
+            error=e.cause if isinstance(e, ParseException) else str(e),
+            seconds=0.0,
+            validated=0,
+        )
+        return result
+    program = interpreter.NaturalProgram(
+        instruction=block.instruction,
+        constraint=block.constraint,
+    )
+    trace = profiling.InstructionTrace()
+    try:
+        new_python_code, output = execute_instruction(
+            program=program,
+            current_python_code=current_python_code,
+            parameters=parameters,
+            search_statistics=search_statistics,
+            trace=trace,
         )
-        with open(api_file, "wt") as fp:
-            json.dump(api_config, fp)
-        print(f"Wrote {api_file}")
+        current_python_code.extend([
+            *interpreter.get_commented_instruction(program),
+            *new_python_code,
+        ])
+        result.update(ok=True, code=new_python_code, output=output)
+    except interpreter.NaturalInterpreterError as e:
+        result.update(ok=False, first_code=e.first_code)
+    finally:
+        if profiler is not None:
+            profiler.record(trace)
+    result.update(
+        seconds=trace.seconds.get('total', 0.0),
+        validated=trace.validated,
+    )
+    return result
+
+
+def run_script(
+        blocks: list[ScriptBlock],
+        parameters: SessionParameters,
+        profiler: (None|profiling.Profiler),
+        current_python_code: (None|list[str]) = None,
+        checkpoint_writer: (None|checkpoint.CheckpointWriter) = None,
+        ) -> tuple[list[str], list[dict]]:
+    """Execute the blocks of a natural script in order without user
+    interaction, like the REPL would, continuing the session code
+    `current_python_code` if given. Returns the executed Python code and a
+    report of each instruction. Instructions fail if the language model or
+    the interpreter fails, and the script stops at the first instruction that
+    fails with an unexpected error."""
+    current_python_code = list(current_python_code or [])
+    search_statistics = search.SearchStatistics()
+    report = list()
+    for block in blocks:
+        if len(block.python_code) > 0:
+            current_python_code.extend(block.python_code)
+            if checkpoint_writer is not None:
+                checkpoint_writer.record(checkpoint.CheckpointEntry(
+                    instruction=list(),
+                    constraint=list(),
+                    parameters=list(),
+                    code=block.python_code,
+                ), current_python_code)
+            continue
+        code_n = len(current_python_code)
+        stop = False
+        try:
+            result = execute_block(
+                block=block,
+                current_python_code=current_python_code,
+                parameters=parameters,
+                search_statistics=search_statistics,
+                profiler=profiler,
+            )
+        except Exception as e:
+            result = dict(
+                instruction=block.instruction,
+                ok=False,
+                error=f"{type(e).__name__}: {e}",
+                seconds=0.0,
+                validated=0,
+            )
+            # The language model or the interpreter failed, rather than the
+            # instruction, so the script can go on. Unexpected errors stop it
+            stop = not isinstance(e, (language_model_api.LanguageModelAPIError, OSError, worker.PythonInterpreterError))
+        report.append(dict(line=block.line_n, **result))
+        if checkpoint_writer is not None:
+            checkpoint_writer.record(checkpoint.CheckpointEntry(
+                instruction=block.instruction,
+                constraint=block.constraint,
+                parameters=block.parameters,
+                code=current_python_code[code_n:],
+                output=result.get('output'),
+                ok=result['ok'],
+            ), current_python_code)
+        if stop:
+            break
+    return current_python_code, report
 
+
+def resume_session(resumed: checkpoint.Checkpoint, parameters: SessionParameters) -> bool:
+    """Apply the parameter changes of a checkpoint, and load its interpreter
+    state. Returns False if the state could not be loaded, so the session
+    code is replayed instead."""
+    for entry in resumed.entries:
+        for line in entry.parameters:
+            # Parameters that are not valid anymore (e.g. an engine that was
+            # removed) keep their current value
+            try:
+                set_execution_parameter(parameters, line)
+            except (ParseException, ValueError):
+                pass
+    return checkpoint.restore_checkpoint(resumed, parameters.python_worker)
+
+
+def main():
     # Parse arguments
     parser = argparse.ArgumentParser(
-            description='Natural Python interpreter.',
+            description='Natural Python interpreter. Without a command, an interactive session is started.',
             epilog=f'The API configuration file is {api_file}. Delete this file if you want to change keys',
             formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         )
+    parser.add_argument(
+        'command',
+        help="Use 'run' to execute the instructions of a natural script without user interaction, or 'serve' to host many sessions behind a local HTTP/JSON API.",
+        nargs='?',
+        choices=['run', 'serve'],
+    )
+    parser.add_argument(
+        'script',
+        help="Natural script executed by 'run', written like the input of the interactive session. '-' reads it from stdin.",
+        nargs='?',
+        default='-',
+    )
     parser.add_argument(
         '--engine-id',
         help="Language model engine used for sampling.",
         type=str,
         default="gpt-neo-125m",
     )
+    parser.add_argument(
+        '--fake-script',
+        help="JSON file with a list of completions, which are served in order by a local fake language model instead of the API. Useful to try the interpreter offline. Its completions are not cached.",
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         '--sample-n',
-        help="Number of samples drawn from the language model when executing an instruction.",
-        type=int,
-        default=10,
+        help="Number of samples drawn from the language model when executing an instruction. A comma-separated schedule (e.g. 2,8,32) draws each batch only if every sample of the previous ones failed.",
+        type=search.parse_sample_schedule,
+        default='10',
     )
     parser.add_argument(
         '--sample-temperature',
-        help="Sampling temperature.",
-        type=float,
-        default=0.2,
+        help="Sampling temperature. A comma-separated schedule (e.g. 0.2,0.5,0.8) sets the temperature of each batch of the sample schedule; the last one is used for the remaining batches.",
+        type=search.parse_temperature_schedule,
+        default='0.2',
     )
     parser.add_argument(
         '--max-sample-tokens',
@@ -336,11 +771,148 @@ def main():
         type=int,
         default=100,
     )
+    parser.add_argument(
+        '--max-prompt-tokens',
+        help="Estimated tokens of session code and instruction sent in each prompt. Longer sessions keep the imports, the definitions the instruction refers to and the most recent code, summarizing or eliding the rest. 'none' sends the whole session.",
+        type=parse_token_budget,
+        default='1024',
+    )
+    parser.add_argument(
+        '--stream',
+        help="Stream completions from the language model, so each one is validated as soon as it is generated instead of waiting for the whole batch.",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--no-speculation',
+        help=f"Wait for the end of an instruction block to sample completions, instead of sampling them while its constraint is typed after '{constraint_keyword}'. Speculative samples of instructions that are restarted are wasted.",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--sample-concurrency',
+        help="Maximum number of concurrent requests to the language model, when more samples than a single request allows are needed.",
+        type=parse_count,
+        default=4,
+    )
+    parser.add_argument(
+        '--ranking',
+        help="Order in which candidates are validated: as sampled (none), by mean token log-probability (likelihood), or by how many samples produced the same code (consensus). Ranking waits for every sample before validating.",
+        choices=search.rankings,
+        default='none',
+    )
     parser.add_argument(
         '--python-shell',
         help="Command used to spawn a Python interpreter. If None, a best guess will be made.",
         type=str,
     )
+    parser.add_argument(
+        '--validate-workers',
+        help="Number of candidates validated at the same time. The earliest successful candidate in sample order is executed. Only candidates executed in forked interpreters or replayed can be validated in parallel.",
+        type=parse_count,
+        default=1,
+    )
+    parser.add_argument(
+        '--replay',
+        help="Execute every candidate in a fresh Python interpreter by replaying the whole session script, instead of keeping a long-lived interpreter. Much slower, but candidates run exactly like the session script does when executed from scratch.",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--source-files',
+        help="With --replay, pass the code to the Python shell in files of a temporary directory of the session, instead of through its stdin, for shells that can not read programs from stdin.",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--no-fork',
+        help="Roll back failed candidates by restoring the bindings of the session namespace, instead of executing each candidate in a forked copy of the interpreter. Forking is only available on POSIX systems.",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--timeout',
+        help="Wall-clock seconds a candidate can run before it is considered a failure and killed. 'none' disables the limit.",
+        type=parse_limit,
+        default='30',
+    )
+    parser.add_argument(
+        '--cpu-time',
+        help="CPU seconds a candidate can use before it is considered a failure. 'none' disables the limit. Only enforced on platforms with the resource module.",
+        type=parse_limit,
+        default='none',
+    )
+    parser.add_argument(
+        '--memory-limit',
+        help="Megabytes of address space a candidate can use before its allocations fail. 'none' disables the limit. Only enforced on platforms with the resource module; in a long-lived interpreter it counts the memory of the whole session.",
+        type=parse_memory_limit,
+        default='none',
+    )
+    parser.add_argument(
+        '--output-limit',
+        help="Megabytes of stdout, and of stderr, kept of each candidate. The middle of longer outputs is left out. 'none' disables the limit.",
+        type=parse_memory_limit,
+        default='1',
+    )
+    parser.add_argument(
+        '--no-cache',
+        help="Always sample the language model, instead of reusing completions sampled for the same prompt and parameters, and keep the list of engines of the API in memory only.",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help="Directory of the completion cache and of the list of engines of the API.",
+        type=Path,
+        default=default_cache_dir,
+    )
+    parser.add_argument(
+        '--cache-size',
+        help="Maximum size of the completion cache, in megabytes. Least recently used completions are evicted first.",
+        type=int,
+        default=64,
+    )
+    parser.add_argument(
+        '--validation-cache-size',
+        help="Number of failed candidate validations remembered during the session, so the candidates are not executed again when an instruction is retried. Running out of wall-clock time is not remembered. 0 disables the cache.",
+        type=int,
+        default=4096,
+    )
+    parser.add_argument(
+        '--engine-ttl',
+        help="Seconds the list of engines of the API is cached for. An outdated list is refreshed in the background; the API is only waited for when the engine is not in the list.",
+        type=float,
+        default=24*60*60,
+    )
+    parser.add_argument(
+        '--profile',
+        help=f"Profile the execution of each instruction. Enter '{profile_keyword}' in the REPL to show a summary.",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--trace-file',
+        help="JSON-lines file the profile of each instruction is appended to. Implies --profile.",
+        type=Path,
+        default=None,
+    )
+    parser.add_argument(
+        '--host',
+        help="Address 'serve' listens on. Sessions execute arbitrary code, so only expose it to users you trust.",
+        type=str,
+        default='127.0.0.1',
+    )
+    parser.add_argument(
+        '--port',
+        help="Port 'serve' listens on.",
+        type=int,
+        default=8000,
+    )
+    parser.add_argument(
+        '--execution-slots',
+        help="Number of candidates the sessions of 'serve' can execute at the same time. Sessions waiting for a slot take turns.",
+        type=parse_count,
+        default=os.cpu_count() or 1,
+    )
+    parser.add_argument(
+        '--sampling-slots',
+        help="Number of requests to the language model the sessions of 'serve' can send at the same time. Sessions waiting for a slot take turns.",
+        type=parse_count,
+        default=8,
+    )
     parser.add_argument(
         '--show-engines',
         help="Display available language model engines.",
@@ -352,25 +924,97 @@ def main():
         type=Path,
         default=None,
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        '--report',
+        help="JSON file to write the result of each instruction executed by 'run'.",
+        type=Path,
+        default=None,
+    )
+    parser.add_argument(
+        '--checkpoint',
+        help="File to save the session to after every instruction, so it can be resumed with --resume. The interpreter state is saved too if it can be serialized with pickle, or with dill if it is installed in the Python shell.",
+        type=Path,
+        default=None,
+    )
+    parser.add_argument(
+        '--resume',
+        help="Continue the session saved in a checkpoint file, restoring the interpreter state instead of replaying the session code if it was saved. Checkpoints keep being saved to the same file, unless --checkpoint is given.",
+        type=Path,
+        default=None,
+    )
+    args = parser.parse_intermixed_args()
+    if args.command == 'serve' and (args.checkpoint is not None or args.resume is not None):
+        parser.error("Sessions of 'serve' can not be checkpointed")
 
-    # Handle arguments
-    api_key = api_config['api_key']
-    api_base = api_config['api_base']
-    if args.show_engines:
-        engines = language_model_api.get_engines(
-            api_key=api_key,
+    # Read the checkpoint before doing any work, so it fails early
+    resumed = None
+    if args.resume is not None:
+        try:
+            resumed = checkpoint.load_checkpoint(args.resume)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    checkpoint_file = args.checkpoint if args.checkpoint is not None else args.resume
+
+    # Read the natural script before doing any work, so it fails early
+    if args.command == 'run':
+        try:
+            if args.script == '-':
+                blocks = parse_natural_script(sys.stdin)
+            else:
+                with open(args.script, "rt") as fp:
+                    blocks = parse_natural_script(fp)
+        except ParseException as e:
+            parser.error(e.cause)
+
+    # Connect to the language model. The HTTP client takes a while to import,
+    # so it is only imported once it is needed
+    from natural_python import backends
+    engine_id = args.engine_id
+    if args.fake_script is not None:
+        backend: language_model_api.Backend = backends.FakeBackend(
+            backends.load_fake_script(args.fake_script),
+            engine_id=engine_id,
+        )
+        api_base = 'fake'
+    else:
+        # Check if API key is present
+        try:
+            with open(api_file, "rt") as fp:
+                api_config = json.load(fp)
+        except FileNotFoundError:
+            print("Initial configuration. You will only have to do this once.")
+            print("Get an API key at https://goose.ai/dashboard/apikeys.")
+            api_base = input("API base (e.g. https://api.goose.ai/v1, https://api.openai.com/v1): ")
+            api_key = input("API key: ")
+            api_config = dict(
+                api_key=api_key,
+                api_base=api_base,
+            )
+            with open(api_file, "wt") as fp:
+                json.dump(api_config, fp)
+            print(f"Wrote {api_file}")
+        api_base = api_config['api_base']
+        backend = backends.HTTPBackend(
             api_base=api_base,
+            api_key=api_config['api_key'],
+            engine_id=engine_id,
+            pool_size=args.sample_concurrency,
         )
-        print(engines)
+
+    # Handle arguments
+    if args.show_engines:
+        with backend:
+            print(backend.get_engines())
     else:
-        # Check that the engine is valid
-        engine_id = args.engine_id
-        available_engine_ids = language_model_api.get_engine_ids(
-            api_key,
-            api_base,
+        # Check that the engine is valid. The engines of the fake backend are
+        # known, so they are not cached
+        engine_catalogue = cache.EngineCatalogue(
+            args.cache_dir if not args.no_cache and args.fake_script is None else None,
+            api_base=api_base,
+            ttl=args.engine_ttl,
+            get_engine_ids=backend.get_engine_ids,
         )
-        if engine_id not in available_engine_ids:
+        if not engine_catalogue.is_available(engine_id):
             raise ValueError(f'Invalid engine ID: {engine_id}')
 
         # Decide a python shell
@@ -384,17 +1028,144 @@ def main():
         if python_shell is None or shutil.which(python_shell) is None:
             raise ValueError(f"Invalid Python shell {python_shell}")
 
-        # Run the REPL
-        code = repl(
-            engine_id=engine_id,
-            api_key=api_key,
-            sample_n=args.sample_n,
-            python_shell=python_shell,
-            api_base=api_base,
-            max_sample_tokens=args.max_sample_tokens,
-            sample_temperature=args.sample_temperature,
-            available_engine_ids=available_engine_ids,
-        )
+        # Spawn the Python interpreter of the session
+        def create_worker() -> worker.Worker:
+            assert python_shell is not None
+            if args.replay:
+                python_worker: worker.Worker = worker.ReplayWorker(
+                    python_shell,
+                    parallel=args.validate_workers,
+                    source_files=args.source_files,
+                )
+            else:
+                python_worker = worker.PythonWorker(
+                    python_shell,
+                    fork=worker.fork_available and not args.no_fork,
+                    parallel=args.validate_workers,
+                )
+            python_worker.limits = worker.ExecutionLimits(
+                timeout=args.timeout,
+                cpu_time=args.cpu_time,
+                memory=args.memory_limit,
+                output=args.output_limit,
+            )
+            return python_worker
+
+        # Open the completion cache. Completions of the fake backend are not
+        # the engine's, so they are not cached
+        if args.no_cache or args.fake_script is not None:
+            completion_cache = None
+        else:
+            completion_cache = cache.CompletionCache(
+                args.cache_dir,
+                max_bytes=args.cache_size*2**20,
+            )
+
+        # Profile instructions
+        if args.profile or args.trace_file is not None:
+            profiler = profiling.Profiler(args.trace_file)
+        else:
+            profiler = None
+
+        def get_parameters(python_worker: worker.Worker) -> SessionParameters:
+            # Every session has its own interpreter, validation cache and
+            # prompt context
+            return SessionParameters(
+                backend=backend,
+                max_sample_tokens=args.max_sample_tokens,
+                sample_n=args.sample_n,
+                sample_temperature=args.sample_temperature,
+                python_worker=python_worker,
+                engine_catalogue=engine_catalogue,
+                stream=args.stream,
+                sample_concurrency=args.sample_concurrency,
+                completion_cache=completion_cache,
+                ranking=args.ranking,
+                validation_cache=cache.ValidationCache(args.validation_cache_size) if args.validation_cache_size > 0 else None,
+                prompt_context=context.PromptContext(args.max_prompt_tokens),
+                speculate=not args.no_speculation,
+            )
+
+        if args.command == 'serve':
+            # Only the server needs these modules
+            from natural_python import scheduling
+            from natural_python import server
+            execution = scheduling.FairScheduler(args.execution_slots)
+            sampling = scheduling.FairScheduler(args.sampling_slots)
+
+            def create_parameters(session_id: str) -> SessionParameters:
+                # Every session also has its own engine, but they share the
+                # language model client and the slots
+                return replace(
+                    get_parameters(scheduling.ScheduledWorker(create_worker(), execution, session_id)),
+                    backend=scheduling.ScheduledBackend(backend.copy(), sampling, session_id),
+                    speculate=False,
+                )
+            session_server = server.SessionServer(
+                (args.host, args.port),
+                create_parameters=create_parameters,
+                execution=execution,
+                sampling=sampling,
+                profiler=profiler,
+            )
+            print(f"Serving sessions on http://{args.host}:{session_server.server_port}")
+            with backend, session_server:
+                try:
+                    session_server.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+            return
+
+        python_worker = create_worker()
+        parameters = get_parameters(python_worker)
+
+        # Save the session after every block
+        if checkpoint_file is not None:
+            checkpoint_writer: (None|checkpoint.CheckpointWriter) = checkpoint.CheckpointWriter(
+                checkpoint_file,
+                python_worker,
+                entries=resumed.entries if resumed is not None else None,
+            )
+        else:
+            checkpoint_writer = None
+
+        if args.command == 'run':
+            # Execute the natural script without user interaction
+            with backend, python_worker:
+                if resumed is not None:
+                    resume_session(resumed, parameters)
+                code, report = run_script(
+                    blocks=blocks,
+                    parameters=parameters,
+                    profiler=profiler,
+                    current_python_code=resumed.code if resumed is not None else None,
+                    checkpoint_writer=checkpoint_writer,
+                )
+            for result in report:
+                status = "OK" if result['ok'] else "FAILED"
+                print(f"{status} line {result['line']} in {result['seconds']:.2f}s: {' '.join(result['instruction'])}")
+                if 'error' in result:
+                    print(f"    {result['error']}")
+            if args.report is not None:
+                with open(args.report, "wt") as fp:
+                    json.dump(report, fp, indent=2)
+        else:
+            # Run the REPL
+            with backend, python_worker:
+                start_message = None
+                if resumed is not None:
+                    restored = resume_session(resumed, parameters)
+                    start_message = [
+                        f"Resumed {len(resumed.entries)} blocks from {args.resume}, "
+                        + ("restoring the interpreter state." if restored else "replaying the session code.")
+                    ]
+                code = repl(
+                    parameters=parameters,
+                    profiler=profiler,
+                    current_python_code=resumed.code if resumed is not None else None,
+                    checkpoint_writer=checkpoint_writer,
+                    start_message=start_message,
+                )
 
         # Write interaction if requested
         if args.output is not None:
@@ -409,3 +1180,7 @@ def main():
         with open(output_file, "wt") as fp:
             fp.write("\n".join(code))
         print(f"Session log script written to {output_file}")
+
+        # Let pipelines know whether every instruction succeeded
+        if args.command == 'run' and not all(result['ok'] for result in report):
+            sys.exit(1)
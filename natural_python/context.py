@@ -0,0 +1,268 @@
+"""Budgeting of the session code included in prompts."""
+from typing import Optional
+from dataclasses import dataclass
+import ast
+import re
+
+
+elision_marker = "# ..."
+"""Line that replaces session code left out of a prompt."""
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the tokens of a text without a tokenizer. The BPE tokenizers
+    of GPT-like models produce roughly a token every 4 characters of code or
+    English."""
+    return (len(text)+3)//4
+
+
+def get_identifiers(lines: list[str]) -> set[str]:
+    """Get the words of natural language that could be Python names."""
+    return set(re.findall(r'[A-Za-z_]\w*', "\n".join(lines)))
+
+
+@dataclass
+class ContextBlock:
+    """A top-level statement of the session code, with the comments (e.g. the
+    instruction) that precede it."""
+    text: str
+    tokens: int
+    is_import: bool
+    defined: set[str]
+    """Names bound by the statement."""
+    referenced: set[str]
+    """Names read by the statement."""
+    summary: Optional[str] = None
+    """The statement without the body of the functions and classes it
+    defines, or None if it can not be summarized."""
+    summary_tokens: int = 0
+
+
+def get_defined_names(statement: ast.stmt) -> set[str]:
+    if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return {statement.name}
+    if isinstance(statement, (ast.Import, ast.ImportFrom)):
+        return {
+            alias.asname or alias.name.split('.')[0]
+            for alias in statement.names
+        }
+    return {
+        node.id
+        for node in ast.walk(statement)
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)
+    }
+
+
+def get_summary(statement: ast.stmt, lines: list[str], start: int) -> Optional[str]:
+    """Summarize a function or class definition as its header. `lines` are
+    the lines of the block of the statement, which starts at line `start`
+    of the parsed code."""
+    if not isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return None
+    body_start = statement.body[0].lineno-start
+    if body_start <= 0:
+        # The body is on the same line as the header
+        return None
+    indentation = ' '*statement.body[0].col_offset
+    return "\n".join([*lines[:body_start], indentation+'...'])
+
+
+def split_blocks(lines: list[str]) -> list[ContextBlock]:
+    """Split session code into blocks of top-level statements. Code that does
+    not parse is kept as a single block."""
+    text = "\n".join(lines)
+    try:
+        statements = ast.parse(text).body
+    except (SyntaxError, ValueError):
+        statements = []
+    blocks = list()
+    block_start = 0
+    i = 0
+    while i < len(statements):
+        # Statements that share lines (e.g. separated by ';') go together
+        group = [statements[i]]
+        end = statements[i].end_lineno or statements[i].lineno
+        while i+1 < len(statements) and statements[i+1].lineno <= end:
+            i += 1
+            group.append(statements[i])
+            end = max(end, statements[i].end_lineno or statements[i].lineno)
+        i += 1
+        block_lines = lines[block_start:end]
+        block_text = "\n".join(block_lines)
+        summary = get_summary(group[0], block_lines, block_start+1) if len(group) == 1 else None
+        blocks.append(ContextBlock(
+            text=block_text,
+            tokens=estimate_tokens(block_text),
+            is_import=all(isinstance(s, (ast.Import, ast.ImportFrom)) for s in group),
+            defined=set().union(*[get_defined_names(s) for s in group]),
+            referenced={
+                node.id
+                for s in group
+                for node in ast.walk(s)
+                if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)
+            },
+            summary=summary,
+            summary_tokens=estimate_tokens(summary) if summary is not None else 0,
+        ))
+        block_start = end
+
+    # Trailing comments, or code that does not parse
+    if block_start < len(lines):
+        block_text = "\n".join(lines[block_start:])
+        blocks.append(ContextBlock(
+            text=block_text,
+            tokens=estimate_tokens(block_text),
+            is_import=False,
+            defined=set(),
+            referenced=set(),
+        ))
+    return blocks
+
+
+class PromptContext:
+    """Renders the code of a session for prompts, keeping it within a budget
+    of `max_tokens` estimated tokens, or without limit if None.
+
+    When the session does not fit, the prompt keeps the imports, the
+    definitions of the names referenced by the instruction (and the names
+    they reference), and the most recent code. Function and class definitions
+    that do not fit are summarized by their header, and the rest of the code
+    is elided.
+
+    Session code is assumed to only grow: blocks are split once, as the code
+    is appended, and the rendered code is reused until the selection of
+    blocks changes."""
+    def __init__(self, max_tokens: Optional[int] = None):
+        self.max_tokens = max_tokens
+        self.line_n = 0
+        """Lines of the session code split into blocks."""
+        self.first_line: Optional[str] = None
+        self.last_line: Optional[str] = None
+        self.blocks: list[ContextBlock] = list()
+        self.tokens = 0
+        """Estimated tokens of the whole session code."""
+        self.imports: list[int] = list()
+        """Indices of the blocks that only import modules."""
+        self.definitions: dict[str, int] = dict()
+        """Index of the last block that binds each name."""
+        self.selection: list[tuple[int, bool]] = list()
+        """Blocks of the last rendered code, and whether they are
+        summarized."""
+        self.rendered = ""
+
+    def reset(self):
+        self.__init__(self.max_tokens)  # type: ignore
+
+    def update(self, current_code: list[str]):
+        """Split the code appended to the session since the last call."""
+        if (
+                len(current_code) < self.line_n
+                or (self.line_n > 0 and (
+                    current_code[0] != self.first_line
+                    or current_code[self.line_n-1] != self.last_line
+                ))
+                ):
+            self.reset()
+        if len(current_code) == self.line_n:
+            return
+        for block in split_blocks(current_code[self.line_n:]):
+            i = len(self.blocks)
+            self.blocks.append(block)
+            # Blocks are joined by a line break
+            self.tokens += block.tokens+1
+            if block.is_import:
+                self.imports.append(i)
+            for name in block.defined:
+                self.definitions[name] = i
+        self.line_n = len(current_code)
+        self.first_line = current_code[0]
+        self.last_line = current_code[-1]
+
+    def select(self, budget: int, referenced: set[str]) -> list[tuple[int, bool]]:
+        """Choose the blocks to render within `budget` tokens, and whether
+        each of them is summarized."""
+        if self.tokens <= budget:
+            return [(i, False) for i in range(len(self.blocks))]
+
+        selection: dict[int, bool] = dict()
+        marker_tokens = estimate_tokens(elision_marker)+1
+        # Leave room for an elision marker before the first block
+        remaining = budget-marker_tokens
+
+        def add(i: int, allow_summary: bool) -> bool:
+            nonlocal remaining
+            block = self.blocks[i]
+            # Leave room for an elision marker after the block, unless the
+            # next block is selected already
+            cost = 1 if i+1 in selection else 1+marker_tokens
+            if block.tokens+cost <= remaining:
+                selection[i] = False
+                remaining -= block.tokens+cost
+                return True
+            if allow_summary and block.summary is not None and block.summary_tokens+cost <= remaining:
+                selection[i] = True
+                remaining -= block.summary_tokens+cost
+                return True
+            return False
+
+        for i in self.imports:
+            add(i, allow_summary=False)
+
+        # Definitions of the names the instruction refers to, and of the
+        # names they refer to
+        pending = [name for name in sorted(referenced) if name in self.definitions]
+        while len(pending) > 0 and remaining > 0:
+            i = self.definitions[pending.pop(0)]
+            if i in selection or not add(i, allow_summary=True):
+                continue
+            if not selection[i]:
+                pending.extend(
+                    name
+                    for name in sorted(self.blocks[i].referenced)
+                    if name in self.definitions and self.definitions[name] not in selection
+                )
+
+        # Most recent code, until a block does not fit
+        for i in reversed(range(len(self.blocks))):
+            if i not in selection and not add(i, allow_summary=True):
+                break
+        return sorted(selection.items())
+
+    def render(self, current_code: list[str], reserved_tokens: int, referenced: set[str]) -> str:
+        """Render the session code for a prompt that has `reserved_tokens`
+        tokens besides the code, and whose instruction refers to the names in
+        `referenced`."""
+        self.update(current_code)
+        if self.max_tokens is None:
+            budget = self.tokens
+        else:
+            budget = max(self.max_tokens-reserved_tokens, 0)
+        selection = self.select(budget, referenced)
+        if selection != self.selection:
+            self.rendered = self.render_selection(selection)
+            self.selection = selection
+        if len(self.blocks) > 0 and (len(selection) == 0 or selection[-1][0] != len(self.blocks)-1):
+            return "\n".join([self.rendered, elision_marker]).lstrip("\n")
+        return self.rendered
+
+    def render_selection(self, selection: list[tuple[int, bool]]) -> str:
+        # Blocks appended to the previous selection only need the new blocks
+        # to be rendered
+        previous_n = len(self.selection)
+        if previous_n > 0 and selection[:previous_n] == self.selection and (
+                previous_n < len(selection)
+                and selection[previous_n][0] == self.selection[-1][0]+1):
+            parts = [self.rendered]
+            previous_i = self.selection[-1][0]
+            new_selection = selection[previous_n:]
+        else:
+            parts = list()
+            previous_i = -1
+            new_selection = selection
+        for i, summarized in new_selection:
+            if i != previous_i+1:
+                parts.append(elision_marker)
+            block = self.blocks[i]
+            parts.append(block.summary if summarized and block.summary is not None else block.text)
+            previous_i = i
+        return "\n".join(parts)
@@ -1,10 +1,39 @@
 """Natural Python semantics."""
+from typing import Any
+from typing import Callable
+from typing import Generator
+from typing import Iterable
 from typing import Optional
+from dataclasses import asdict
 from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import replace
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import queue
+from natural_python.language_model_api import Backend
+from natural_python.language_model_api import Completion
+from natural_python.language_model_api import get_batched_completions
 from natural_python.language_model_api import get_completions
-import tempfile
-import subprocess
-import shlex
+from natural_python.language_model_api import stop_sequences
+from natural_python.cache import CompletionCache
+from natural_python.cache import get_cached_completions
+from natural_python.cache import ValidationCache
+from natural_python.cache import ValidationFailure
+from natural_python.context import PromptContext
+from natural_python.context import estimate_tokens
+from natural_python.context import get_identifiers
+from natural_python.search import SearchStatistics
+from natural_python.search import prefilter_completions
+from natural_python.search import rank_completions
+from natural_python.search import normalize_code
+from natural_python.profiling import InstructionTrace
+from natural_python.profiling import timed
+from natural_python.worker import Execution
+from natural_python.worker import Worker
+from natural_python.worker import PythonInterpreterError
+from natural_python.worker import get_code_key
 
 
 @dataclass
@@ -29,17 +58,20 @@ class NaturalInterpreterError(Exception):
         self.first_code = first_code
 
 
-class PythonInterpreterError(Exception):
-    """Raised when a Python interpreter exits with error status."""
-    pass
+def get_commented_instruction(program: NaturalProgram) -> list[str]:
+    """Get the instruction of the program as Python comments, as it is
+    written in the session script."""
+    return ['# '+l for l in program.instruction]
 
 
 def get_prompt(
         current_code: list[str],
         program: NaturalProgram,
+        context: Optional[PromptContext] = None,
         ) -> str:
     """Get a prompt for sampling implementations of the given program, assuming
-    we have executed some Python `current_code`."""
+    we have executed some Python `current_code`. With a `context`, the
+    code is kept within its token budget."""
     # If this is the first code we will execute, inject a short prefix
     # to increase likelihood of Python programs in the language model
     if len(current_code) == 0:
@@ -51,100 +83,663 @@ def get_prompt(
     else:
         injected_prompt = list()
 
-    instructions = ['# '+l for l in program.instruction]
+    instructions = get_commented_instruction(program)
+    if context is None:
+        code = current_code
+    else:
+        rendered_code = context.render(
+            current_code,
+            reserved_tokens=estimate_tokens("\n".join([*injected_prompt, *instructions]))+1,
+            referenced=get_identifiers(program.instruction),
+        )
+        code = [rendered_code] if len(rendered_code) > 0 else []
     lm_prompt = "\n".join([
         *injected_prompt,
-        *current_code,
+        *code,
         *instructions,
     ])
     return lm_prompt
 
 
+def get_batch_key(
+        backend: Backend,
+        prompt: str,
+        batch_n: int,
+        temperature: float,
+        max_sample_tokens: int,
+        logprobs: bool,
+        ) -> tuple:
+    """Get what identifies a batch of completions: batches with the same key
+    are interchangeable."""
+    return (backend.engine_id, prompt, batch_n, temperature, max_sample_tokens, logprobs)
 
-def get_code_output(
-        python_code: str,
-        python_shell: str,
-        ) -> str:
-    """Return the stdout of executing `python_code` with the Python interpreter.
-    `python_shell` is the command used to spawn a Python shell."""
-    # Create a temporary Python source file
-    with tempfile.NamedTemporaryFile("wt", prefix="natural-python", suffix='.py', delete=False) as python_src_file:
-        python_src_file.write(python_code)
-        python_src_file.close()
-        args = [
-            *shlex.split(python_shell),
-            python_src_file.name,
-        ]
-        process = subprocess.run(args, check=False, capture_output=True, text=True)
-        if process.returncode != 0:
-            raise PythonInterpreterError()
-        stdout = process.stdout
-    return stdout
 
+def sample_batch(
+        backend: Backend,
+        completion_cache: Optional[CompletionCache],
+        prompt: str,
+        batch_n: int,
+        temperature: float,
+        max_sample_tokens: int,
+        stream: bool,
+        sample_concurrency: int,
+        logprobs: bool,
+        on_usage: Callable[[Any], None],
+        cancelled: Optional[threading.Event] = None,
+        ) -> Iterable[Completion]:
+    """Sample a batch of `batch_n` completions for the prompt, reusing the
+    ones in the completion cache. Streamed completions stop arriving as soon
+    as `cancelled` is set."""
+    def sample(n: int) -> Iterable[Completion]:
+        return get_completions(
+            backend=backend,
+            prompt=prompt,
+            sample_n=n,
+            max_tokens=max_sample_tokens,
+            temperature=temperature,
+            stream=stream,
+            concurrency=sample_concurrency,
+            logprobs=logprobs,
+            on_usage=on_usage,
+            cancelled=cancelled,
+        )
+    return get_cached_completions(
+        cache=completion_cache,
+        key=CompletionCache.get_key(
+            endpoint=backend.get_endpoint(),
+            engine_id=backend.engine_id,
+            prompt=prompt,
+            temperature=temperature,
+            max_tokens=max_sample_tokens,
+            stop_sequences=stop_sequences,
+            logprobs=logprobs,
+        ),
+        sample_n=batch_n,
+        temperature=temperature,
+        get_completions=sample,
+    )
 
-def get_new_code_output(
-        new_code: list[str],
-        current_code: list[str],
-        python_shell: str,
-        ) -> str:
-    """Execute the given prefix (current_code), then execute given suffix
-    (new_code) in a Python interpreter. Return the output.
-    `python_shell` is the command used to spawn a Python shell."""
-    current_code_python = "\n".join(current_code)
-    new_code_python = "\n".join([*current_code, *new_code])
 
-    # Execute both copies
-    current_stdout = get_code_output(current_code_python, python_shell)
-    new_stdout = get_code_output(new_code_python, python_shell)
+class SpeculativeBatch:
+    """The first batch of completions of an instruction, sampled in the
+    background before the instruction is executed (e.g. while the user types
+    its constraint, which is not part of the prompt). Completions are
+    buffered as they arrive, and read by `read` as if they were sampled
+    then.
+
+    `sample` is called with the function the token usage is reported to, and
+    the event that is set once the batch is cancelled."""
+    def __init__(
+            self,
+            key: tuple,
+            sample: Callable[[Callable[[Any], None], threading.Event], Iterable[Completion]],
+            ):
+        self.key = key
+        """Key of the batch, see `get_batch_key`."""
+        self.completions: list[Completion] = list()
+        self.usages: list[Any] = list()
+        """Token usage reported by the API."""
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.condition = threading.Condition()
+        self.cancelled = threading.Event()
+        threading.Thread(target=self.run, args=(sample,), daemon=True).start()
 
-    # Get code diff
-    new_diff = new_stdout[len(current_stdout):]
-    return new_diff
+    def run(self, sample: Callable[[Callable[[Any], None], threading.Event], Iterable[Completion]]):
+        completions = iter(sample(self.add_usage, self.cancelled))
+        try:
+            for completion in completions:
+                with self.condition:
+                    self.completions.append(completion)
+                    self.condition.notify_all()
+                if self.cancelled.is_set():
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            # Closing the completions stores the ones read in the cache
+            close = getattr(completions, 'close', None)
+            if close is not None:
+                close()
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def add_usage(self, usage: Any):
+        with self.condition:
+            self.usages.append(usage)
+
+    def cancel(self):
+        """Stop sampling as soon as possible. Completions that arrived are
+        still in the completion cache, if any."""
+        self.cancelled.set()
+
+    def read(self, on_usage: Callable[[Any], None]) -> Generator[Completion, None, None]:
+        """Return the completions, waiting for the ones that did not arrive
+        yet. The token usage is reported to `on_usage` once they are read."""
+        read_n = 0
+        try:
+            while True:
+                with self.condition:
+                    while read_n == len(self.completions) and not self.done:
+                        self.condition.wait()
+                    if read_n == len(self.completions):
+                        if self.error is not None:
+                            raise self.error
+                        return
+                    completion = self.completions[read_n]
+                read_n += 1
+                yield completion
+        finally:
+            # Nothing else will read the completions
+            self.cancel()
+            with self.condition:
+                usages = self.usages
+                self.usages = list()
+            for usage in usages:
+                on_usage(usage)
+
+
+def speculate_natural_program(
+        instruction: list[str],
+        current_python_code: list[str],
+        sample_n: (int|list[int]),
+        backend: Backend,
+        max_sample_tokens: int,
+        sample_temperature: (float|list[float]),
+        stream: bool = False,
+        sample_concurrency: int = 4,
+        completion_cache: Optional[CompletionCache] = None,
+        ranking: str = 'none',
+        prompt_context: Optional[PromptContext] = None,
+        ) -> SpeculativeBatch:
+    """Start sampling the first batch of completions of an instruction whose
+    constraint is not known yet, see `execute_natural_program`."""
+    program = NaturalProgram(instruction=instruction, constraint=list())
+    prompt = get_prompt(
+        current_code=current_python_code,
+        program=program,
+        context=prompt_context,
+    )
+    batch_n = sample_n[0] if isinstance(sample_n, list) else sample_n
+    temperature = sample_temperature[0] if isinstance(sample_temperature, list) else sample_temperature
+    logprobs = ranking == 'likelihood'
+    return SpeculativeBatch(
+        key=get_batch_key(backend, prompt, batch_n, temperature, max_sample_tokens, logprobs),
+        sample=lambda on_usage, cancelled: sample_batch(
+            backend=backend,
+            completion_cache=completion_cache,
+            prompt=prompt,
+            batch_n=batch_n,
+            temperature=temperature,
+            max_sample_tokens=max_sample_tokens,
+            stream=stream,
+            sample_concurrency=sample_concurrency,
+            logprobs=logprobs,
+            on_usage=on_usage,
+            cancelled=cancelled,
+        ),
+    )
 
 
 def execute_natural_program(
         program: NaturalProgram,
         current_python_code: list[str],
-        sample_n: int,
-        python_shell: str,
-        engine_id: str,
-        api_key: str,
-        api_base: str,
+        sample_n: (int|list[int]),
+        python_worker: Worker,
+        backend: Backend,
         max_sample_tokens: int,
-        sample_temperature: float,
+        sample_temperature: (float|list[float]),
+        stream: bool = False,
+        sample_concurrency: int = 4,
+        completion_cache: Optional[CompletionCache] = None,
+        statistics: Optional[SearchStatistics] = None,
+        ranking: str = 'none',
+        trace: Optional[InstructionTrace] = None,
+        prompt_context: Optional[PromptContext] = None,
+        speculation: Optional[SpeculativeBatch] = None,
+        validation_cache: Optional[ValidationCache] = None,
         ) -> tuple[list[str], str]:
-    """Returns the new Python code that was executed, and the output of that code to stdout."""
-    # Construct prompt
-    lm_prompt = get_prompt(current_code=current_python_code, program=program)
-
-    # Sample language model for completions
-    completions = get_completions(
-        prompt=lm_prompt,
-        sample_n=sample_n,
-        api_key=api_key,
-        api_base=api_base,
-        engine_id=engine_id,
+    """Returns the new Python code that was executed, and the output of that code to stdout.
+
+    `sample_n` can be a schedule of batch sizes: a batch is only sampled if
+    every completion of the previous batches failed. The batch with index `i`
+    is sampled with temperature `sample_temperature[i]`, or the last
+    temperature of the schedule if there are less temperatures than batches.
+    With a completion cache, batches sampled with the same temperature reuse
+    the completions of the previous ones.
+
+    `python_worker` is synchronized with `current_python_code` and, on success,
+    ends up in the state of executing the instruction (as comments) followed by
+    the new code. The counters of the search are added to `statistics`, and
+    the profile of the execution to `trace`.
+    Candidates are validated in the order given by `ranking`, see
+    `natural_python.search.rankings`. With a `prompt_context`, the prompt only
+    includes the session code that fits its budget. A `speculation` started
+    for the instruction is used as its first batch if it was sampled with the
+    same parameters, and cancelled otherwise. Candidates that a
+    `validation_cache` knows to fail on top of the session are skipped."""
+    if statistics is None:
+        statistics = SearchStatistics()
+    if trace is None:
+        trace = InstructionTrace()
+    trace.instruction = list(program.instruction)
+    initial_statistics = replace(statistics)
+    try:
+        with trace.phase('total'):
+            new_code, output = search_natural_program(
+                program=program,
+                current_python_code=current_python_code,
+                sample_n=sample_n,
+                python_worker=python_worker,
+                backend=backend,
+                max_sample_tokens=max_sample_tokens,
+                sample_temperature=sample_temperature,
+                stream=stream,
+                sample_concurrency=sample_concurrency,
+                completion_cache=completion_cache,
+                statistics=statistics,
+                ranking=ranking,
+                trace=trace,
+                prompt_context=prompt_context,
+                speculation=speculation,
+                validation_cache=validation_cache,
+            )
+        trace.winner = statistics.tried_before_success - initial_statistics.tried_before_success
+        trace.stdout_bytes = len(output.encode('utf-8'))
+        return new_code, output
+    finally:
+        trace.sampled = statistics.sampled - initial_statistics.sampled
+        trace.pruned = (
+            statistics.duplicates - initial_statistics.duplicates
+            + statistics.syntax_errors - initial_statistics.syntax_errors
+        )
+        trace.validated = statistics.validated - initial_statistics.validated
+
+
+@dataclass
+class NaturalJob:
+    """An instruction executed by `execute_natural_programs`, on top of the
+    code of its own session."""
+    program: NaturalProgram
+    current_python_code: list[str]
+    python_worker: Worker
+    prompt_context: Optional[PromptContext] = None
+    statistics: SearchStatistics = field(default_factory=SearchStatistics)
+    trace: InstructionTrace = field(default_factory=InstructionTrace)
+
+
+def execute_natural_programs(
+        jobs: list[NaturalJob],
+        sample_n: (int|list[int]),
+        backend: Backend,
+        max_sample_tokens: int,
+        sample_temperature: (float|list[float]),
+        sample_concurrency: int = 4,
+        completion_cache: Optional[CompletionCache] = None,
+        ranking: str = 'none',
+        validation_cache: Optional[ValidationCache] = None,
+        job_concurrency: int = 8,
+        ) -> list[(tuple[list[str], str]|Exception)]:
+    """Execute independent instructions, e.g. of different sessions, like
+    `execute_natural_program` does, up to `job_concurrency` at the same time.
+    Returns the new code and its output for each job, or the error of the jobs
+    that failed, e.g. a `NaturalInterpreterError`, or a
+    `LanguageModelAPIError` if their completions could not be sampled.
+
+    The first batch of completions of every instruction is sampled with as
+    few requests as possible, packing many prompts into each request, and
+    the completions of each prompt are validated as soon as its request
+    returns. The rest of the batches, which are only needed if every
+    completion of the first one fails, are sampled one instruction at a time.
+    Instructions whose completions are in the completion cache are not
+    packed, so the cache serves them."""
+    if len(jobs) == 0:
+        return list()
+    batch_n = sample_n[0] if isinstance(sample_n, list) else sample_n
+    temperature = sample_temperature[0] if isinstance(sample_temperature, list) else sample_temperature
+    logprobs = ranking == 'likelihood'
+
+    # Sample the first batch of the instructions that are not cached
+    prompts = [
+        get_prompt(
+            current_code=job.current_python_code,
+            program=job.program,
+            context=job.prompt_context,
+        )
+        for job in jobs
+    ]
+    cache_keys = [
+        CompletionCache.get_key(
+            endpoint=backend.get_endpoint(),
+            engine_id=backend.engine_id,
+            prompt=prompt,
+            temperature=temperature,
+            max_tokens=max_sample_tokens,
+            stop_sequences=stop_sequences,
+            logprobs=logprobs,
+        )
+        for prompt in prompts
+    ]
+    packed = [
+        i
+        for i, key in enumerate(cache_keys)
+        if completion_cache is None or len(completion_cache.get(key)) == 0
+    ]
+    futures = get_batched_completions(
+        backend=backend,
+        jobs=[(prompts[i], batch_n) for i in packed],
         max_tokens=max_sample_tokens,
-        temperature=sample_temperature,
+        temperature=temperature,
+        concurrency=sample_concurrency,
+        logprobs=logprobs,
     )
+    speculations: list[Optional[SpeculativeBatch]] = [None for _ in jobs]
+    for i, future in zip(packed, futures):
+        speculations[i] = SpeculativeBatch(
+            key=get_batch_key(backend, prompts[i], batch_n, temperature, max_sample_tokens, logprobs),
+            # The completions are still added to the cache
+            sample=lambda _, __, key=cache_keys[i], future=future: get_cached_completions(
+                cache=completion_cache,
+                key=key,
+                sample_n=batch_n,
+                temperature=temperature,
+                get_completions=lambda _: future.result(),
+            ),
+        )
 
-    # Find a completion that does not crash the program
-    first_code = None
-    for completion in completions:
-        if first_code is None:
-            first_code = completion
-        new_code = [
-            *completion,
-            *program.constraint,
-        ]
+    def execute(job: NaturalJob, speculation: Optional[SpeculativeBatch]) -> (tuple[list[str], str]|Exception):
         try:
-            output = get_new_code_output(
-                new_code=new_code,
-                current_code=current_python_code,
-                python_shell=python_shell,
+            return execute_natural_program(
+                program=job.program,
+                current_python_code=job.current_python_code,
+                sample_n=sample_n,
+                python_worker=job.python_worker,
+                backend=backend,
+                max_sample_tokens=max_sample_tokens,
+                sample_temperature=sample_temperature,
+                sample_concurrency=sample_concurrency,
+                completion_cache=completion_cache,
+                statistics=job.statistics,
+                ranking=ranking,
+                trace=job.trace,
+                prompt_context=job.prompt_context,
+                speculation=speculation,
+                validation_cache=validation_cache,
             )
+        except Exception as e:
+            # A request packing the prompts of many jobs fails all of them,
+            # but must not lose the results of the other jobs
+            return e
+
+    with ThreadPoolExecutor(max_workers=min(len(jobs), job_concurrency)) as pool:
+        results = pool.map(execute, jobs, speculations)
+        return list(results)
+
+
+def search_natural_program(
+        program: NaturalProgram,
+        current_python_code: list[str],
+        sample_n: (int|list[int]),
+        python_worker: Worker,
+        backend: Backend,
+        max_sample_tokens: int,
+        sample_temperature: (float|list[float]),
+        stream: bool,
+        sample_concurrency: int,
+        completion_cache: Optional[CompletionCache],
+        statistics: SearchStatistics,
+        ranking: str,
+        trace: InstructionTrace,
+        prompt_context: Optional[PromptContext] = None,
+        speculation: Optional[SpeculativeBatch] = None,
+        validation_cache: Optional[ValidationCache] = None,
+        ) -> tuple[list[str], str]:
+    """Search for code that implements the program, see
+    `execute_natural_program`."""
+    # Make sure the worker executed the whole session. If it failed, no
+    # candidate can possibly succeed
+    try:
+        with trace.phase('sync'):
+            python_worker.sync(current_python_code)
+    except PythonInterpreterError:
+        if speculation is not None:
+            speculation.cancel()
+        raise NaturalInterpreterError(None)
+
+    # Outcomes of validations are only known for the same session code
+    committed_key = get_code_key(current_python_code) if validation_cache is not None else ''
+
+    # Construct prompt
+    with trace.phase('prompt'):
+        lm_prompt = get_prompt(
+            current_code=current_python_code,
+            program=program,
+            context=prompt_context,
+        )
+    logprobs = ranking == 'likelihood'
+
+    # Token usage is reported by the threads sampling the language model
+    usage_lock = threading.Lock()
+
+    def add_usage(usage):
+        with usage_lock:
+            trace.add_usage(usage)
+
+    # Sample batches of completions until one of them succeeds. Code pruned in
+    # a batch is also pruned in the next ones
+    sample_schedule = sample_n if isinstance(sample_n, list) else [sample_n]
+    temperature_schedule = sample_temperature if isinstance(sample_temperature, list) else [sample_temperature]
+    seen_code: set[str] = set()
+    first_code = None
+    validated_n = statistics.validated
+    for batch_i, batch_n in enumerate(sample_schedule):
+        temperature = temperature_schedule[min(batch_i, len(temperature_schedule)-1)]
+        statistics.batches += 1
+
+        # Sample language model for completions, reusing the ones sampled for
+        # the same prompt in the past. The first batch may be sampled already
+        key = get_batch_key(backend, lm_prompt, batch_n, temperature, max_sample_tokens, logprobs)
+        # `cancelled` is set once no more completions of the batch are needed
+        if speculation is not None and batch_i == 0 and speculation.key == key:
+            completions = speculation.read(on_usage=add_usage)
+            cancelled = speculation.cancelled
+            trace.speculative = True
+        else:
+            if speculation is not None and batch_i == 0:
+                speculation.cancel()
+            cancelled = threading.Event()
+            completions = sample_batch(
+                backend=backend,
+                completion_cache=completion_cache,
+                prompt=lm_prompt,
+                batch_n=batch_n,
+                temperature=temperature,
+                max_sample_tokens=max_sample_tokens,
+                stream=stream,
+                sample_concurrency=sample_concurrency,
+                logprobs=logprobs,
+                on_usage=add_usage,
+                cancelled=cancelled,
+            )
+        completions = timed(completions, trace, 'sampling')
+
+        # Validate the completions that are most likely to succeed first
+        completions = rank_completions(completions, ranking)
+
+        # Rule out completions without executing them
+        completions = prefilter_completions(
+            completions=completions,
+            constraint=program.constraint,
+            statistics=statistics,
+            seen_code=seen_code,
+        )
+
+        # Find a completion that does not crash the program
+        batch_validated_n = statistics.validated
+        try:
+            with trace.phase('validation'):
+                new_code, output = validate_completions(
+                    completions=completions,
+                    program=program,
+                    python_worker=python_worker,
+                    statistics=statistics,
+                    validation_cache=validation_cache,
+                    committed_key=committed_key,
+                    stop=cancelled,
+                )
+            # Count the candidates of previous batches as tried too
+            statistics.tried_before_success += batch_validated_n - validated_n
             return new_code, output
-        except PythonInterpreterError:
-            pass
+        except NaturalInterpreterError as e:
+            if first_code is None:
+                first_code = e.first_code
 
     raise NaturalInterpreterError(first_code)
+
+
+def feed_completions(
+        completions: Iterable[Completion],
+        events: queue.Queue,
+        stop: threading.Event,
+        ):
+    """Put the completions in the event queue of `validate_completions` as
+    they arrive, until the completions are exhausted or `stop` is set."""
+    completions = iter(completions)
+    try:
+        for completion in completions:
+            if stop.is_set():
+                break
+            events.put(('completion', completion))
+    except Exception as e:
+        events.put(('error', e))
+    finally:
+        close = getattr(completions, 'close', None)
+        if close is not None:
+            close()
+        events.put(('exhausted', None))
+
+
+def validate_completions(
+        completions: Iterable[Completion],
+        program: NaturalProgram,
+        python_worker: Worker,
+        statistics: SearchStatistics,
+        validation_cache: Optional[ValidationCache] = None,
+        committed_key: str = '',
+        stop: Optional[threading.Event] = None,
+        ) -> tuple[list[str], str]:
+    """Find the first completion, in sample order, that runs without crashing
+    the program that is synchronized in `python_worker`. Returns the new Python
+    code that was executed, and the output of that code to stdout.
+
+    Completions are validated as soon as they arrive, up to
+    `python_worker.parallel` at the same time. Once the winner is known, the
+    remaining validations are discarded and no more completions are read:
+    `stop` is set, which the sampling of `completions` can watch to abandon
+    the responses it is reading.
+
+    With a `validation_cache`, the validations that fail on top of the
+    committed code (whose key is `committed_key`) in a way that does not
+    depend on timing are recorded, and candidates known to fail are skipped
+    without executing them."""
+    limits = asdict(python_worker.limits)
+    events: queue.Queue = queue.Queue()
+    if stop is None:
+        stop = threading.Event()
+    threading.Thread(
+        target=feed_completions,
+        args=(completions, events, stop),
+        daemon=True,
+    ).start()
+
+    first_code = None
+    exhausted = False
+    # Completions that arrived but are not being validated yet
+    waiting_completions: deque[Completion] = deque()
+    # Validations that were not settled, in sample order, with their key in
+    # the validation cache
+    executions: list[tuple[list[str], Execution, Optional[str]]] = list()
+    validated_n = 0
+    try:
+        while True:
+            # Handle the events that happened since the last iteration. An
+            # event is either a completion or the end of the completions; the
+            # validations put None to wake this loop when they finish
+            event = events.get()
+            while True:
+                if event is not None:
+                    kind, value = event
+                    if kind == 'completion':
+                        waiting_completions.append(value)
+                        if first_code is None:
+                            first_code = value.code
+                    elif kind == 'error':
+                        raise value
+                    else:
+                        exhausted = True
+                try:
+                    event = events.get_nowait()
+                except queue.Empty:
+                    break
+
+            # Settle validations in sample order
+            while len(executions) > 0 and executions[0][1].future.done():
+                new_code, execution, outcome_key = executions.pop(0)
+                try:
+                    output = execution.future.result()
+                except PythonInterpreterError as e:
+                    statistics.failed += 1
+                    python_worker.discard(execution)
+                    if validation_cache is not None and outcome_key is not None and e.deterministic:
+                        reason = str(e).strip().splitlines()
+                        validation_cache.put(outcome_key, ValidationFailure(reason=reason[-1] if len(reason) > 0 else ""))
+                    continue
+                tried_n = validated_n - len(executions) - 1
+                for _, other_execution, _ in executions:
+                    python_worker.discard(other_execution)
+                executions = list()
+                try:
+                    python_worker.accept(execution)
+                except PythonInterpreterError:
+                    raise NaturalInterpreterError(first_code)
+                statistics.successes += 1
+                statistics.tried_before_success += tried_n
+                return new_code, output
+
+            # Start new validations. Completions after one that succeeded can
+            # not win, so there is no need to validate them
+            running_n = sum(not e.future.done() for _, e, _ in executions)
+            succeeded = any(
+                e.future.done() and e.future.exception() is None
+                for _, e, _ in executions
+            )
+            while len(waiting_completions) > 0 and not succeeded and running_n < python_worker.parallel:
+                completion = waiting_completions.popleft()
+                outcome_key = None
+                if validation_cache is not None:
+                    candidate = normalize_code(completion.code) or "\n".join(completion.code)
+                    if validation_cache.get_known_failure(committed_key, candidate, program.constraint, limits) is not None:
+                        validation_cache.skipped += 1
+                        continue
+                    outcome_key = ValidationCache.get_key(committed_key, candidate, program.constraint, limits)
+                new_code = [
+                    *completion.code,
+                    *program.constraint,
+                ]
+                execution = python_worker.submit([
+                    *get_commented_instruction(program),
+                    *new_code,
+                ])
+                statistics.validated += 1
+                validated_n += 1
+                execution.future.add_done_callback(lambda _: events.put(None))
+                executions.append((new_code, execution, outcome_key))
+                running_n += 1
+
+            if exhausted and len(executions) == 0 and len(waiting_completions) == 0:
+                raise NaturalInterpreterError(first_code)
+    finally:
+        stop.set()
+        for _, execution, _ in executions:
+            python_worker.discard(execution)
@@ -1,72 +1,380 @@
-"""Language model API facade."""
-import openai
+"""Language model API facade.
+
+Language models are accessed through a `Backend`, see `natural_python.backends`
+for the implementations."""
 from typing import Any
+from typing import Callable
 from typing import Generator
+from typing import Iterable
+from typing import Optional
+from abc import ABC
+from abc import abstractmethod
+from dataclasses import dataclass
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import queue
 
 
-def get_engines(api_key: str, api_base: str) -> Any:
-    openai.api_key = api_key
-    openai.api_base = api_base
-    engines = openai.Engine.list()
-    return engines
+max_samples_per_request = 128
+"""OpenAI API limits to 128 samples per request."""
 
+stop_sequences = ['#']
+"""Sequences that end a completion."""
+
+
+class LanguageModelAPIError(Exception):
+    """Raised when the language model API returns an error."""
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+@dataclass
+class Completion:
+    """A completion sampled from the language model."""
+    code: list[str]
+    """Lines of code of the completion."""
+    mean_logprob: Optional[float] = None
+    """Mean log-probability of the tokens of the completion, if it was
+    requested."""
+
+
+class Backend(ABC):
+    """A language model that samples completions of prompts."""
+    def __init__(self, engine_id: str):
+        self.engine_id = engine_id
+        """Language model engine used for sampling."""
+
+    @abstractmethod
+    def complete(
+            self,
+            prompt: str,
+            n: int,
+            max_tokens: int,
+            temperature: float,
+            stop: list[str],
+            stream: bool = False,
+            logprobs: bool = False,
+            on_usage: Optional[Callable[[Any], None]] = None,
+            cancelled: Optional[threading.Event] = None,
+            ) -> Iterable[Completion]:
+        """Sample `n` completions of the prompt with a single request. With
+        `stream`, each completion is returned as soon as it is finished, and
+        the response is abandoned as soon as `cancelled` is set. With
+        `logprobs`, the mean log-probability of each completion is returned too.
+        `on_usage` is called with the token usage of the request, if it is
+        known."""
+
+    def complete_many(
+            self,
+            prompts: list[str],
+            n: int,
+            max_tokens: int,
+            temperature: float,
+            stop: list[str],
+            logprobs: bool = False,
+            on_usage: Optional[Callable[[Any], None]] = None,
+            ) -> list[list[Completion]]:
+        """Sample `n` completions of each prompt, with a single request if
+        the backend supports it. Unless a backend overrides it, each prompt
+        is completed with its own request."""
+        return [
+            list(self.complete(
+                prompt=prompt,
+                n=n,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop=stop,
+                logprobs=logprobs,
+                on_usage=on_usage,
+            ))
+            for prompt in prompts
+        ]
+
+    async def complete_async(
+            self,
+            prompt: str,
+            n: int,
+            max_tokens: int,
+            temperature: float,
+            stop: list[str],
+            logprobs: bool = False,
+            on_usage: Optional[Callable[[Any], None]] = None,
+            ) -> list[Completion]:
+        """Asynchronous version of `complete`. Unless a backend overrides it,
+        `complete` is run in a thread."""
+        # Importing asyncio is slow, and only asynchronous callers need it
+        import asyncio
+        return await asyncio.to_thread(lambda: list(self.complete(
+            prompt=prompt,
+            n=n,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stop=stop,
+            logprobs=logprobs,
+            on_usage=on_usage,
+        )))
+
+    @abstractmethod
+    def get_engines(self) -> Any:
+        """Return the description of the available engines."""
+
+    @abstractmethod
+    def get_engine_ids(self) -> list[str]:
+        """Return the IDs of the available engines."""
+
+    @abstractmethod
+    def copy(self) -> 'Backend':
+        """Return a backend whose engine can be changed on its own, but that
+        shares the resources (e.g. connections) of this one."""
+
+    def get_endpoint(self) -> str:
+        """Return what identifies where completions come from, besides the
+        engine, so completions of different endpoints are not mixed up."""
+        return type(self).__name__
+
+    def close(self):
+        """Release the resources held by the backend."""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def parse_candidate(text: str, stop_sequences: list[str]) -> list[str]:
+    """Parse the lines of code of a completion."""
+    return [l for l in text.split('\n') if len(l) > 0 and l not in stop_sequences]
 
-def get_engine_ids(api_key: str, api_base: str) -> list[str]:
-    openai.api_key = api_key
-    openai.api_base = api_base
-    engines = openai.Engine.list()
-    engine_ids = [
-        str(engine['id'])
-        for engine in engines['data']
-    ]
-    return engine_ids
+
+def get_token_logprobs(choice: Any) -> list[float]:
+    """Return the log-probabilities of the tokens of a choice, if the API
+    returned them."""
+    logprobs = choice.get("logprobs")
+    if logprobs is None:
+        return list()
+    return [l for l in logprobs["token_logprobs"] if l is not None]
+
+
+def get_mean(values: list[float]) -> Optional[float]:
+    if len(values) == 0:
+        return None
+    return sum(values)/len(values)
+
+
+def stream_candidates(
+        chunks: Iterable[Any],
+        stop_sequences: list[str],
+        ) -> Generator[Completion, None, None]:
+    """Assemble the choices of a streamed completion by their index, and yield
+    each one as soon as it is finished, either because it hit a stop sequence
+    or because the API reported a finish reason."""
+    texts: dict[int, str] = dict()
+    logprobs: dict[int, list[float]] = dict()
+    finished: set[int] = set()
+    try:
+        for chunk in chunks:
+            for choice in chunk["choices"]:
+                index = choice["index"]
+                if index in finished:
+                    continue
+                text = texts.get(index, '') + choice["text"]
+                token_logprobs = logprobs.get(index, list()) + get_token_logprobs(choice)
+                stop_positions = [
+                    text.find(stop_sequence)
+                    for stop_sequence in stop_sequences
+                    if stop_sequence in text
+                ]
+                if len(stop_positions) > 0:
+                    text = text[:min(stop_positions)]
+                if len(stop_positions) > 0 or choice["finish_reason"] is not None:
+                    finished.add(index)
+                    texts.pop(index, None)
+                    logprobs.pop(index, None)
+                    yield Completion(
+                        code=parse_candidate(text, stop_sequences),
+                        mean_logprob=get_mean(token_logprobs),
+                    )
+                else:
+                    texts[index] = text
+                    logprobs[index] = token_logprobs
+    finally:
+        # Abandon the rest of the stream
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+    # Choices the API did not finish
+    for index, text in texts.items():
+        yield Completion(
+            code=parse_candidate(text, stop_sequences),
+            mean_logprob=get_mean(logprobs[index]),
+        )
 
 
 def get_completions(
+        backend: Backend,
         prompt: str,
         sample_n: int,
-        api_key: str,
-        engine_id: str,
         max_tokens: int,
-        api_base: str,
         temperature: float,
-        ) -> Generator[list[str], None, None]:
-    """Return completions for the given prompt."""
-    stop_sequences = ['#']
-    openai.api_key = api_key
-    openai.api_base = api_base
-    # OpenAI API limits to 128 samples per request
-    if sample_n > 128:
-        current_sample = 128
-    else:
-        current_sample = sample_n
-    completions = openai.Completion.create(
-        engine=engine_id,
-        prompt=prompt,
-        max_tokens=max_tokens,
-        stream=False,
-        n=current_sample,
-        stop=stop_sequences,
-        temperature=temperature,
-    )
-    candidates = [
-        [l for l in c.text.split('\n') if len(l) > 0 and l not in stop_sequences]
-        for c in completions["choices"]
-    ]
-    for candidate in candidates:
-        yield candidate
+        stream: bool = False,
+        concurrency: int = 4,
+        logprobs: bool = False,
+        on_usage: Optional[Callable[[Any], None]] = None,
+        cancelled: Optional[threading.Event] = None,
+        ) -> Generator[Completion, None, None]:
+    """Return completions for the given prompt sampled with `backend`. With
+    `stream`, each completion is returned as soon as it is finished instead of
+    waiting for the whole batch, and streams stop as soon as `cancelled` is
+    set. With `logprobs`, the mean log-probability of each completion is
+    requested too. `on_usage` is called with the token usage reported for each
+    request.
 
-    # Check if we need to ask for more samples
-    remaining_samples = sample_n - current_sample
-    if remaining_samples > 0:
-        new_completions = get_completions(
+    If more samples than an API request allows are needed, up to `concurrency`
+    requests are sent at the same time, and completions are returned as soon
+    as any of them returns them."""
+    shard_sizes = [
+        min(max_samples_per_request, sample_n-i)
+        for i in range(0, sample_n, max_samples_per_request)
+    ]
+    shards = [
+        functools.partial(
+            backend.complete,
             prompt=prompt,
-            sample_n=remaining_samples,
-            api_key=api_key,
-            engine_id=engine_id,
+            n=shard_size,
             max_tokens=max_tokens,
-            api_base=api_base,
             temperature=temperature,
+            stop=stop_sequences,
+            stream=stream,
+            logprobs=logprobs,
+            on_usage=on_usage,
+            cancelled=cancelled,
         )
-        for candidate in new_completions:
-            yield candidate
+        for shard_size in shard_sizes
+    ]
+    if len(shards) == 1:
+        yield from shards[0]()
+        return
+
+    # Merge the completions of the shards as they arrive
+    candidates: queue.Queue = queue.Queue()
+    stop = threading.Event()
+
+    def sample_shard(shard: Callable[[], Iterable[Completion]]):
+        try:
+            for candidate in shard():
+                if stop.is_set():
+                    break
+                candidates.put(('candidate', candidate))
+        except Exception as e:
+            candidates.put(('error', e))
+        finally:
+            candidates.put(('done', None))
+
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for shard in shards:
+            pool.submit(sample_shard, shard)
+        done_n = 0
+        while done_n < len(shards):
+            kind, value = candidates.get()
+            if kind == 'candidate':
+                yield value
+            elif kind == 'error':
+                raise value
+            else:
+                done_n += 1
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def pack_prompts(jobs: list[tuple[str, int]]) -> list[tuple[int, list[tuple[int, str]]]]:
+    """Pack jobs that sample `n` completions of a prompt, given as
+    `(prompt, n)`, into as few requests as possible. A request samples the
+    same number of completions of each of its prompts, and up to
+    `max_samples_per_request` completions in total, so jobs that need more
+    are split into shards.
+
+    Returns the number of completions of each prompt of a request, and the
+    index of the job of each prompt."""
+    shards: dict[int, list[tuple[int, str]]] = dict()
+    for job_i, (prompt, n) in enumerate(jobs):
+        for i in range(0, n, max_samples_per_request):
+            shard_n = min(max_samples_per_request, n-i)
+            shards.setdefault(shard_n, list()).append((job_i, prompt))
+    requests = list()
+    for n, prompts in shards.items():
+        prompts_per_request = max_samples_per_request//n
+        for i in range(0, len(prompts), prompts_per_request):
+            requests.append((n, prompts[i:i+prompts_per_request]))
+    return requests
+
+
+def get_batched_completions(
+        backend: Backend,
+        jobs: list[tuple[str, int]],
+        max_tokens: int,
+        temperature: float,
+        concurrency: int = 4,
+        logprobs: bool = False,
+        on_usage: Optional[Callable[[Any], None]] = None,
+        ) -> list[Future]:
+    """Sample `n` completions of the prompt of each job, given as
+    `(prompt, n)`, packing many prompts into each request (see
+    `pack_prompts`). Up to `concurrency` requests are sent at the same time.
+
+    Returns a future of the completions of each job, which resolves once
+    they all arrived, or fails if any request of the job failed."""
+    futures: list[Future] = [Future() for _ in jobs]
+    completions: list[list[Completion]] = [list() for _ in jobs]
+    requests = pack_prompts(jobs)
+    # Requests each job is waiting for
+    pending = [0 for _ in jobs]
+    for _, prompts in requests:
+        for job_i, _ in prompts:
+            pending[job_i] += 1
+    for job_i, job_pending in enumerate(pending):
+        if job_pending == 0:
+            futures[job_i].set_result(list())
+    lock = threading.Lock()
+
+    def send(n: int, prompts: list[tuple[int, str]]):
+        try:
+            prompt_completions = backend.complete_many(
+                prompts=[prompt for _, prompt in prompts],
+                n=n,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop=stop_sequences,
+                logprobs=logprobs,
+                on_usage=on_usage,
+            )
+        except Exception as e:
+            for job_i, _ in prompts:
+                with lock:
+                    if futures[job_i].done():
+                        continue
+                    futures[job_i].set_exception(e)
+            return
+        finished = list()
+        with lock:
+            for (job_i, _), job_completions in zip(prompts, prompt_completions):
+                completions[job_i].extend(job_completions)
+                pending[job_i] -= 1
+                if pending[job_i] == 0 and not futures[job_i].done():
+                    finished.append(job_i)
+        for job_i in finished:
+            futures[job_i].set_result(completions[job_i])
+
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    for n, prompts in requests:
+        pool.submit(send, n, prompts)
+    # The requests that were submitted are still sent
+    pool.shutdown(wait=False)
+    return futures
@@ -0,0 +1,140 @@
+"""Profiling of the execution of instructions."""
+from typing import Any
+from typing import Generator
+from typing import Iterable
+from typing import Optional
+from pathlib import Path
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import field
+from collections import deque
+import contextlib
+import threading
+import json
+import time
+
+
+phases = [
+    'sync',
+    'prompt',
+    'sampling',
+    'validation',
+]
+"""Phases of the execution of an instruction. `sync` executes the code of the
+session the worker did not execute yet, `prompt` builds the prompt, `sampling`
+waits for completions (including their parsing and the cache) and
+`validation` executes candidates until one succeeds. When completions are
+streamed, sampling and validation overlap."""
+
+
+@dataclass
+class InstructionTrace:
+    """Profile of the execution of an instruction."""
+    instruction: list[str] = field(default_factory=list)
+    seconds: dict[str, float] = field(default_factory=dict)
+    """Wall-clock seconds spent in each phase, and in total."""
+    sampled: int = 0
+    """Completions received from the language model or the cache."""
+    pruned: int = 0
+    """Completions pruned without executing them."""
+    validated: int = 0
+    """Candidates that were executed."""
+    winner: Optional[int] = None
+    """Index of the successful candidate among the executed ones, if any."""
+    prompt_tokens: int = 0
+    """Tokens of the prompts sent to the language model."""
+    completion_tokens: int = 0
+    """Tokens sampled from the language model. Only counted when the API
+    reports usage, which it does not when streaming."""
+    stdout_bytes: int = 0
+    """Bytes of the output of the successful candidate."""
+    speculative: bool = False
+    """Whether the first batch of completions was sampled before the
+    instruction was executed."""
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Add the time spent in the context to the phase `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_seconds(name, time.perf_counter()-start)
+
+    def add_seconds(self, name: str, seconds: float):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def add_usage(self, usage: Any):
+        """Count the tokens of the usage reported by the API."""
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+
+
+def timed(
+        iterable: Iterable[Any],
+        trace: InstructionTrace,
+        phase: str,
+        ) -> Generator[Any, None, None]:
+    """Add the time spent waiting for each item of `iterable` to the phase
+    `phase` of `trace`."""
+    iterator = iter(iterable)
+    try:
+        while True:
+            with trace.phase(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+class Profiler:
+    """Collects the traces of the instructions of one or many sessions,
+    optionally appending them to a JSON-lines file. Only the last
+    `max_traces` traces are kept in memory."""
+    def __init__(self, trace_file: Optional[Path] = None, max_traces: int = 1000):
+        self.trace_file = trace_file
+        self.traces: deque[InstructionTrace] = deque(maxlen=max_traces)
+        self.lock = threading.Lock()
+        """Held while traces are recorded, so instructions executed at the
+        same time do not interleave their lines in the trace file."""
+
+    def record(self, trace: InstructionTrace):
+        with self.lock:
+            self.traces.append(trace)
+            if self.trace_file is not None:
+                with open(self.trace_file, "at") as fp:
+                    fp.write(json.dumps(asdict(trace))+'\n')
+
+    def get_summary(self) -> list[str]:
+        """Get a short summary of the last instruction and the recent ones."""
+        with self.lock:
+            traces = list(self.traces)
+        if len(traces) == 0:
+            return ["No instructions were profiled yet."]
+        last = traces[-1]
+        summary = [
+            "Last instruction: " + get_seconds_message(last.seconds) + ".",
+            f"Last instruction: {last.sampled} sampled, {last.pruned} pruned, {last.validated} validated, winner {last.winner}, {last.prompt_tokens} prompt tokens, {last.completion_tokens} completion tokens, {last.stdout_bytes} stdout bytes.",
+        ]
+        if len(traces) > 1:
+            mean_seconds = dict()
+            for trace in traces:
+                for name, seconds in trace.seconds.items():
+                    mean_seconds[name] = mean_seconds.get(name, 0.0) + seconds/len(traces)
+            summary.append(
+                f"Mean over {len(traces)} instructions: " + get_seconds_message(mean_seconds) + ".",
+            )
+        return summary
+
+
+def get_seconds_message(seconds: dict[str, float]) -> str:
+    return ", ".join(
+        f"{name} {seconds[name]:.3f}s"
+        for name in [*phases, 'total']
+        if name in seconds
+    )
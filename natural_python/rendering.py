@@ -0,0 +1,79 @@
+"""Terminal rendering of the REPL."""
+from typing import Callable
+from typing import Iterable
+from typing import TextIO
+import contextlib
+import threading
+import signal
+import sys
+import os
+
+
+def clear_screen(stream: TextIO):
+    if os.name == 'nt':
+        # https://stackoverflow.com/a/2084628
+        os.system('cls')
+    else:
+        # Clear the screen and move the cursor home without spawning a shell
+        stream.write('\033[2J\033[H')
+
+
+class Renderer:
+    """Renders the log of a session. New lines are appended to the screen, and
+    the whole log is only redrawn when the terminal is resized or on
+    request, so the cost of rendering does not grow with the session."""
+    def __init__(self, stream: TextIO = sys.stdout):
+        self.stream = stream
+        self.lines: list[str] = list()
+        """Every line of the log, in order."""
+        self.resized = False
+        if hasattr(signal, 'SIGWINCH') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGWINCH, self.handle_resize)
+
+    def handle_resize(self, *_):
+        # Lines wrapped for the old size would be garbled, redraw them later
+        self.resized = True
+
+    def add(self, lines: Iterable[object], shown: bool = False):
+        """Add lines to the log and display them, unless they are already
+        `shown` on the screen (e.g. the user typed them)."""
+        new_lines = [str(l) for l in lines]
+        self.lines.extend(new_lines)
+        if not shown and len(new_lines) > 0:
+            self.stream.write("\n".join(new_lines)+"\n")
+            self.stream.flush()
+
+    def redraw(self):
+        """Clear the screen and display the whole log."""
+        self.resized = False
+        clear_screen(self.stream)
+        if len(self.lines) > 0:
+            self.stream.write("\n".join(self.lines)+"\n")
+        self.stream.flush()
+
+    def refresh(self):
+        """Redraw the log if the terminal was resized."""
+        if self.resized:
+            self.redraw()
+
+    @contextlib.contextmanager
+    def progress(self, get_message: Callable[[], str], interval: float = 0.1):
+        """Display `get_message()` in a status line that is updated every
+        `interval` seconds while in the context, and erased afterwards."""
+        stop = threading.Event()
+
+        def update():
+            while True:
+                self.stream.write('\r\033[K'+get_message())
+                self.stream.flush()
+                if stop.wait(interval):
+                    break
+        updater = threading.Thread(target=update, daemon=True)
+        updater.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            updater.join()
+            self.stream.write('\r\033[K')
+            self.stream.flush()
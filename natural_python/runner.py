@@ -0,0 +1,584 @@
+"""Resident Python process that executes code on behalf of
+`natural_python.worker.PythonWorker`.
+
+This script is executed with the user's Python shell, so it must only depend
+on the standard library. Requests and responses are JSON objects, one per
+line, on the standard input and output of the process.
+
+Code can be executed in two ways:
+
+- `run`: executed in the session namespace. If the code raises, the namespace
+  bindings are restored.
+- `fork`: executed in a copy-on-write child process. The child reports its
+  result and waits until it is either discarded, or promoted to replace this
+  process as the holder of the session state. Many children can be running at
+  the same time.
+
+Every request has an `id`, which is included in its response. Requests to
+`promote` or `discard` a child refer to it by the `id` of its `fork` request,
+and discarding has no response.
+
+The session namespace can be serialized (`snapshot`) and replaced by a
+serialized one (`restore`), with dill if it is installed, so the functions
+and classes defined in the session are serialized too, or with pickle
+otherwise.
+
+Requests to execute code can set `limits` on its wall-clock time (`timeout`),
+CPU time (`cpu_time`) and address space (`memory`). Code that exceeds them
+fails. Failures report whether they are `deterministic`: the code fails
+every time it is executed, unlike when it runs out of wall-clock time or its
+process dies. Stdout and stderr are captured at the file descriptor level, so the
+output of subprocesses is included. The bytes sent back are limited too
+(`output`), by leaving out the middle of longer outputs.
+"""
+import collections
+import base64
+import contextlib
+import importlib
+import io
+import json
+import math
+import os
+import pickle
+import select
+import signal
+import sys
+import tempfile
+import time
+import traceback
+import types
+
+try:
+    import resource
+except ImportError:
+    # Resource limits are not supported on this platform
+    resource = None
+
+
+timeout_grace = 1.0
+"""Seconds a forked child is given past its timeout before it is killed."""
+
+
+class Promoted(Exception):
+    """Raised in a forked child when it becomes the holder of the session
+    state."""
+    pass
+
+
+class LimitExceeded(BaseException):
+    """Raised in code that exceeded its limits. It is not an `Exception`, so
+    that code catching every exception does not hide it."""
+    def __init__(self, message, deterministic):
+        super().__init__(message)
+        self.deterministic = deterministic
+        """Whether the code exceeds the limit every time it is executed, which
+        does not hold for the wall-clock time limit."""
+
+
+class BoundedOutput(io.TextIOBase):
+    """Text stream that keeps the first and the last bytes written to it, up
+    to `limit` bytes in total, or every byte if None. The first `skip` bytes
+    are dropped, e.g. the output of code that was executed before."""
+    def __init__(self, limit=None, skip=0):
+        self.limit = limit
+        self.skip = skip
+        self.size = 0
+        """Bytes written, including the skipped and left out ones."""
+        self.skipped = 0
+        self.head = bytearray()
+        self.tail = collections.deque()
+        """Chunks of the last bytes written. The first one may hold bytes
+        that are left out."""
+        self.tail_size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.write_bytes(text.encode('utf-8', 'surrogateescape'))
+        return len(text)
+
+    def write_bytes(self, data):
+        self.size += len(data)
+        if self.skipped < self.skip:
+            skipped = min(self.skip-self.skipped, len(data))
+            data = data[skipped:]
+            self.skipped += skipped
+        if self.limit is None:
+            self.head.extend(data)
+            return
+        head_room = self.limit-self.limit//2-len(self.head)
+        if head_room > 0:
+            self.head.extend(data[:head_room])
+            data = data[head_room:]
+        tail_limit = self.limit//2
+        if len(data) == 0 or tail_limit == 0:
+            return
+        self.tail.append(bytes(data))
+        self.tail_size += len(data)
+        while self.tail_size-len(self.tail[0]) >= tail_limit:
+            self.tail_size -= len(self.tail.popleft())
+
+    def getvalue(self):
+        tail = b''.join(self.tail)
+        if self.limit is not None:
+            tail = tail[len(tail)-min(len(tail), self.limit//2):]
+        left_out = self.size-self.skipped-len(self.head)-len(tail)
+        parts = [bytes(self.head)]
+        if left_out > 0:
+            parts.append(f"\n[... {left_out} bytes left out ...]\n".encode('utf-8'))
+        parts.append(tail)
+        return b''.join(parts).decode('utf-8', 'replace')
+
+
+def truncate(text, limit):
+    """Keep the first and the last bytes of a text, up to `limit`."""
+    output = BoundedOutput(limit)
+    output.write(text)
+    return output.getvalue()
+
+
+class SnapshotPickler(pickle.Pickler):
+    """Pickles modules by importing them again when they are loaded."""
+    def reducer_override(self, obj):
+        if isinstance(obj, types.ModuleType):
+            return importlib.import_module, (obj.__name__,)
+        return NotImplemented
+
+
+def snapshot(namespace):
+    """Serialize a namespace as base64 text."""
+    try:
+        import dill
+        data = dill.dumps(namespace)
+    except ImportError:
+        buffer = io.BytesIO()
+        SnapshotPickler(buffer).dump(namespace)
+        data = buffer.getvalue()
+    return base64.b64encode(data).decode('ascii')
+
+
+def load_snapshot(data):
+    try:
+        import dill
+        loads = dill.loads
+    except ImportError:
+        loads = pickle.loads
+    namespace = loads(base64.b64decode(data))
+    namespace['__builtins__'] = __builtins__
+    return namespace
+
+
+def raise_limit_exceeded(signum, _):
+    if signum == signal.SIGALRM:
+        raise LimitExceeded("Wall-clock time limit exceeded", deterministic=False)
+    raise LimitExceeded("CPU time limit exceeded", deterministic=True)
+
+
+@contextlib.contextmanager
+def limited(limits):
+    """Enforce the `limits` of a request while executing code in this
+    process. Only soft resource limits are changed, so they can be restored
+    afterwards."""
+    previous_limits = dict()
+    timeout = limits.get('timeout')
+    cpu_time = limits.get('cpu_time')
+    memory = limits.get('memory')
+    if resource is not None and cpu_time is not None:
+        # The CPU time limit counts the time already used by this process
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = usage.ru_utime + usage.ru_stime
+        previous_limits[resource.RLIMIT_CPU] = resource.getrlimit(resource.RLIMIT_CPU)
+        set_soft_limit(resource.RLIMIT_CPU, math.ceil(used + cpu_time))
+    if resource is not None and memory is not None:
+        previous_limits[resource.RLIMIT_AS] = resource.getrlimit(resource.RLIMIT_AS)
+        set_soft_limit(resource.RLIMIT_AS, int(memory))
+    if timeout is not None and hasattr(signal, 'setitimer'):
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        yield
+    finally:
+        if timeout is not None and hasattr(signal, 'setitimer'):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        for limit, values in previous_limits.items():
+            resource.setrlimit(limit, values)
+
+
+def set_soft_limit(limit, value):
+    _, hard = resource.getrlimit(limit)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    resource.setrlimit(limit, (value, hard))
+
+
+class LineReader:
+    """Reads newline-terminated messages from a file descriptor."""
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = bytearray()
+
+    def read(self):
+        """Read available data. Returns the complete lines that were read, or
+        None if the file descriptor reached EOF."""
+        data = os.read(self.fd, 65536)
+        if len(data) == 0:
+            return None
+        self.buffer.extend(data)
+        *lines, rest = self.buffer.split(b'\n')
+        self.buffer = bytearray(rest)
+        return lines
+
+
+class Child:
+    """A forked child executing a candidate."""
+    def __init__(self, pid, results, control_fd, deadline):
+        self.pid = pid
+        self.results = results
+        self.control_fd = control_fd
+        self.deadline = deadline
+        """Time after which the child is killed, if any."""
+        self.reported = False
+
+    def close(self):
+        os.close(self.results.fd)
+        os.close(self.control_fd)
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        os.waitpid(self.pid, 0)
+        self.close()
+
+
+def write_message(fd, message):
+    data = (json.dumps(message)+'\n').encode('utf-8')
+    while len(data) > 0:
+        data = data[os.write(fd, data):]
+
+
+streams = dict()
+"""Text streams writing to the output file descriptors, by descriptor. They
+are kept, as creating them in every forked child is slow."""
+
+
+def get_stream(fd):
+    """Text stream writing to the output file descriptor `fd`, line buffered
+    for stderr like the stream of a script."""
+    if fd not in streams or streams[fd].closed:
+        streams[fd] = open(fd, 'w', encoding='utf-8', errors='surrogateescape', buffering=1 if fd == 2 else -1, closefd=False)
+    return streams[fd]
+
+
+def open_capture_file():
+    """Open an anonymous file for captured output and return its descriptor."""
+    try:
+        return os.open(tempfile.gettempdir(), os.O_TMPFILE | os.O_RDWR, 0o600)
+    except (AttributeError, OSError):
+        # O_TMPFILE is specific to Linux and some file systems
+        with tempfile.TemporaryFile() as capture:
+            return os.dup(capture.fileno())
+
+
+@contextlib.contextmanager
+def captured(fd, output):
+    """Capture what is written to the file descriptor `fd` into `output`,
+    whether by Python code or by subprocesses. Yields a text stream writing
+    to `fd`, to replace the matching `sys` stream."""
+    saved_fd = os.dup(fd)
+    capture_fd = open_capture_file()
+    os.dup2(capture_fd, fd)
+    stream = get_stream(fd)
+    try:
+        yield stream
+    finally:
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+        # Later writes of leftover subprocesses are discarded
+        os.dup2(saved_fd, fd)
+        os.close(saved_fd)
+        os.lseek(capture_fd, 0, os.SEEK_SET)
+        # Read in chunks, so only the bytes `output` keeps are in memory
+        for data in iter(lambda: os.read(capture_fd, 1 << 16), b''):
+            output.write_bytes(data)
+        os.close(capture_fd)
+
+
+def execute(code, namespace, limits, rollback=True):
+    """Execute `code` in `namespace` within `limits` and return the response
+    for the host.
+
+    If the code raises and `rollback` is set, the namespace is rolled back to
+    the bindings it had before the execution. In-place mutations of existing
+    objects are not undone."""
+    snapshot = dict(namespace) if rollback else None
+    output_limit = limits.get('output')
+    stdout = BoundedOutput(output_limit)
+    stderr = BoundedOutput(output_limit)
+    error = None
+    deterministic = True
+    try:
+        with captured(1, stdout) as stdout_stream, \
+                captured(2, stderr) as stderr_stream, \
+                contextlib.redirect_stdout(stdout_stream), contextlib.redirect_stderr(stderr_stream), \
+                limited(limits):
+            exec(compile(code, '<natural-python>', 'exec'), namespace)
+    except SystemExit as e:
+        # Mimic the exit status of a script calling sys.exit()
+        if e.code not in (None, 0):
+            error = f"SystemExit: {e.code}"
+    except LimitExceeded as e:
+        error = traceback.format_exc()
+        deterministic = e.deterministic
+    except BaseException:
+        error = traceback.format_exc()
+
+    if error is not None and output_limit is not None:
+        error = truncate(error, output_limit)
+    if error is not None and snapshot is not None:
+        namespace.clear()
+        namespace.update(snapshot)
+    return dict(
+        ok=error is None,
+        stdout=stdout.getvalue(),
+        stderr=stderr.getvalue(),
+        error=error,
+        deterministic=error is not None and deterministic,
+    )
+
+
+class Runner:
+    """Serves requests of the host over the protocol file descriptors."""
+    def __init__(self, requests_fd, responses_fd):
+        self.requests = LineReader(requests_fd)
+        self.responses_fd = responses_fd
+        self.namespace = dict(__name__='__main__', __builtins__=__builtins__)
+        self.children = dict()
+
+    def serve(self):
+        """Serve requests until the host exits. Raises `Promoted` in a forked
+        child that replaced this process."""
+        while True:
+            self.kill_expired_children()
+            children_fds = {
+                child.results.fd: request_id
+                for request_id, child in self.children.items()
+                if not child.reported
+            }
+            deadlines = [
+                self.children[request_id].deadline
+                for request_id in children_fds.values()
+                if self.children[request_id].deadline is not None
+            ]
+            if len(deadlines) > 0:
+                timeout = max(0.0, min(deadlines) - time.monotonic())
+            else:
+                timeout = None
+            if len(children_fds) > 0:
+                readable, _, _ = select.select(
+                    [self.requests.fd, *children_fds.keys()], [], [], timeout,
+                )
+            else:
+                # Only wait on the host (select does not support pipes on
+                # every platform)
+                readable = [self.requests.fd]
+            for fd in readable:
+                if fd == self.requests.fd:
+                    lines = self.requests.read()
+                    if lines is None:
+                        self.shutdown()
+                        return
+                    for line in lines:
+                        if not self.handle(json.loads(line)):
+                            self.shutdown()
+                            return
+                else:
+                    self.collect(children_fds[fd])
+
+    def handle(self, request):
+        """Handle a request of the host. Returns False if the runner should
+        exit."""
+        op = request['op']
+        if op == 'exit':
+            return False
+        elif op == 'run':
+            response = execute(
+                request['code'],
+                self.namespace,
+                request.get('limits', dict()),
+            )
+            response['id'] = request['id']
+            write_message(self.responses_fd, response)
+        elif op == 'fork':
+            self.fork(
+                request['id'],
+                request['code'],
+                request.get('limits', dict()),
+            )
+        elif op == 'snapshot':
+            try:
+                response = dict(ok=True, data=snapshot(self.namespace))
+            except Exception:
+                response = dict(ok=False, error=traceback.format_exc())
+            response['id'] = request['id']
+            write_message(self.responses_fd, response)
+        elif op == 'restore':
+            # Functions keep referring to the namespace they were loaded
+            # with, so it replaces the current one
+            try:
+                self.namespace = load_snapshot(request['data'])
+                response = dict(ok=True)
+            except Exception:
+                response = dict(ok=False, error=traceback.format_exc())
+            response['id'] = request['id']
+            write_message(self.responses_fd, response)
+        elif op == 'promote':
+            self.promote(request['fork_id'], request['id'])
+        elif op == 'discard':
+            # Children that crashed were already collected
+            child = self.children.pop(request['fork_id'], None)
+            if child is not None:
+                child.kill()
+        else:
+            write_message(self.responses_fd, dict(
+                id=request.get('id'),
+                ok=False,
+                error=f"Unknown operation {op}",
+            ))
+        return True
+
+    def fork(self, request_id, code, limits):
+        """Execute `code` in a forked child."""
+        results_r, results_w = os.pipe()
+        control_r, control_w = os.pipe()
+        pid = os.fork()
+        if pid != 0:
+            os.close(results_w)
+            os.close(control_r)
+            # The child interrupts itself on timeout, but it is killed if
+            # it does not report back
+            timeout = limits.get('timeout')
+            if timeout is not None:
+                deadline = time.monotonic() + timeout + timeout_grace
+            else:
+                deadline = None
+            self.children[request_id] = Child(
+                pid,
+                LineReader(results_r),
+                control_w,
+                deadline,
+            )
+            return
+
+        # Child process: the siblings belong to the parent
+        os.close(results_r)
+        os.close(control_w)
+        for child in self.children.values():
+            child.close()
+        self.children = dict()
+        response = execute(code, self.namespace, limits, rollback=False)
+        write_message(results_w, response)
+        os.close(results_w)
+
+        # Wait until the parent decides on the fate of this child: it either
+        # sends the ID of the promotion request or closes the pipe
+        control = LineReader(control_r)
+        lines = list()
+        while lines is not None and len(lines) == 0:
+            lines = control.read()
+        if lines is None:
+            os._exit(0)
+        os.close(control_r)
+        # The parent consumed every request up to the promotion
+        self.requests.buffer = bytearray()
+        promotion = json.loads(lines[0])
+        write_message(self.responses_fd, dict(id=promotion['id'], ok=True))
+        raise Promoted()
+
+    def collect(self, request_id):
+        """Forward the result of a child to the host."""
+        child = self.children[request_id]
+        lines = child.results.read()
+        if lines is None:
+            # The child exited before reporting (e.g. it called os._exit)
+            write_message(self.responses_fd, dict(
+                id=request_id,
+                ok=False,
+                stdout='',
+                stderr='',
+                error="Python process exited unexpectedly",
+                deterministic=False,
+            ))
+            self.children.pop(request_id).kill()
+        elif len(lines) > 0:
+            child.reported = True
+            response = json.loads(lines[0])
+            response['id'] = request_id
+            write_message(self.responses_fd, response)
+
+    def kill_expired_children(self):
+        """Kill the children that exceeded their deadline."""
+        now = time.monotonic()
+        for request_id, child in list(self.children.items()):
+            if child.reported or child.deadline is None or child.deadline > now:
+                continue
+            write_message(self.responses_fd, dict(
+                id=request_id,
+                ok=False,
+                stdout='',
+                stderr='',
+                error="Wall-clock time limit exceeded",
+                deterministic=False,
+            ))
+            self.children.pop(request_id).kill()
+
+    def promote(self, fork_id, request_id):
+        """Let a child replace this process, and exit."""
+        child = self.children.pop(fork_id)
+        write_message(child.control_fd, dict(id=request_id))
+        child.close()
+        self.shutdown()
+        os._exit(0)
+
+    def shutdown(self):
+        for child in self.children.values():
+            child.kill()
+        self.children = dict()
+
+
+def main():
+    # Keep the protocol streams private, so executed code can neither consume
+    # requests nor corrupt responses by using the standard streams. The output
+    # file descriptors are captured during each execution.
+    requests_fd = os.dup(0)
+    responses_fd = os.dup(1)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    sys.argv = ['']
+    # Do not let the package directory shadow modules of the session
+    sys.path[0] = ''
+    # Prepare the captures once, rather than in every forked child
+    tempfile.gettempdir()
+    get_stream(1)
+    get_stream(2)
+
+    signal.signal(signal.SIGALRM, raise_limit_exceeded)
+    if hasattr(signal, 'SIGXCPU'):
+        signal.signal(signal.SIGXCPU, raise_limit_exceeded)
+
+    runner = Runner(requests_fd, responses_fd)
+    while True:
+        try:
+            runner.serve()
+            break
+        except Promoted:
+            # This is a forked child that now holds the session state
+            continue
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""Fair sharing of execution and sampling capacity between sessions."""
+from typing import Any
+from typing import Callable
+from typing import Generator
+from typing import Optional
+from collections import deque
+from natural_python.language_model_api import Backend
+from natural_python.language_model_api import Completion
+from natural_python.worker import Execution
+from natural_python.worker import Worker
+import threading
+
+
+class FairScheduler:
+    """Grants up to `slots` concurrent uses of a resource. When sessions wait
+    for a slot, slots are granted to them in turns (round robin), so a session
+    that asks for many slots at once can not starve the others."""
+    def __init__(self, slots: int):
+        if slots <= 0:
+            raise ValueError(f"Invalid number of slots {slots}")
+        self.slots = slots
+        self.condition = threading.Condition()
+        self.waiting: dict[str, deque[list[bool]]] = dict()
+        """Tickets of the requests of each session waiting for a slot, in
+        order. A ticket is a list with a flag that is set when the slot is
+        granted."""
+        self.turns: deque[str] = deque()
+        """Sessions with waiting requests, in the order of their turns."""
+        self.running: dict[str, int] = dict()
+        """Slots held by each session."""
+
+    def dispatch(self):
+        """Grant the free slots in turns. The condition has to be held."""
+        while sum(self.running.values()) < self.slots and len(self.turns) > 0:
+            session_id = self.turns.popleft()
+            tickets = self.waiting[session_id]
+            tickets.popleft()[0] = True
+            self.running[session_id] = self.running.get(session_id, 0) + 1
+            if len(tickets) > 0:
+                self.turns.append(session_id)
+            else:
+                del self.waiting[session_id]
+        self.condition.notify_all()
+
+    def acquire(self, session_id: str):
+        """Wait for a slot for the session."""
+        ticket = [False]
+        with self.condition:
+            if session_id not in self.waiting:
+                self.waiting[session_id] = deque()
+                self.turns.append(session_id)
+            self.waiting[session_id].append(ticket)
+            self.dispatch()
+            while not ticket[0]:
+                self.condition.wait()
+
+    def release(self, session_id: str):
+        """Return a slot of the session."""
+        with self.condition:
+            self.running[session_id] -= 1
+            if self.running[session_id] == 0:
+                del self.running[session_id]
+            self.dispatch()
+
+    def get_metrics(self, session_id: Optional[str] = None) -> dict:
+        """Get the requests waiting for a slot and the slots in use, of a
+        session or of every session."""
+        with self.condition:
+            if session_id is None:
+                return dict(
+                    slots=self.slots,
+                    waiting=sum(len(t) for t in self.waiting.values()),
+                    running=sum(self.running.values()),
+                )
+            return dict(
+                waiting=len(self.waiting.get(session_id, ())),
+                running=self.running.get(session_id, 0),
+            )
+
+
+class ScheduledWorker(Worker):
+    """Worker of a session whose executions take a slot of a scheduler shared
+    with other sessions. `submit` waits for the slot, which is returned once
+    the execution is settled."""
+    def __init__(self, worker: Worker, scheduler: FairScheduler, session_id: str):
+        super().__init__(worker.python_shell, min(worker.parallel, scheduler.slots))
+        self.worker = worker
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.limits = worker.limits
+        self.releases: dict[int, Callable[[], None]] = dict()
+        """Returns the slot of each execution that is not settled, by the ID
+        of the execution object."""
+        self.lock = threading.Lock()
+
+    def sync(self, current_code: list[str]):
+        self.scheduler.acquire(self.session_id)
+        try:
+            self.worker.sync(current_code)
+        finally:
+            self.scheduler.release(self.session_id)
+
+    def submit(self, code: list[str]) -> Execution:
+        self.scheduler.acquire(self.session_id)
+        released = threading.Event()
+
+        def release(*_):
+            # Executions are settled once, but their future may also finish
+            if not released.is_set():
+                released.set()
+                self.scheduler.release(self.session_id)
+        try:
+            execution = self.worker.submit(code)
+        except BaseException:
+            release()
+            raise
+        with self.lock:
+            self.releases[id(execution)] = release
+        execution.future.add_done_callback(release)
+        return execution
+
+    def settle(self, execution: Execution):
+        with self.lock:
+            release = self.releases.pop(id(execution), None)
+        if release is not None:
+            release()
+
+    def accept(self, execution: Execution):
+        try:
+            self.worker.accept(execution)
+        finally:
+            self.settle(execution)
+
+    def discard(self, execution: Execution):
+        try:
+            self.worker.discard(execution)
+        finally:
+            self.settle(execution)
+
+    def close(self):
+        self.worker.close()
+
+
+class ScheduledBackend(Backend):
+    """Backend of a session whose requests take a slot of a scheduler shared
+    with other sessions. A slot is held while a response is received, so
+    completions that are not streamed are read before it is returned."""
+    def __init__(self, backend: Backend, scheduler: FairScheduler, session_id: str):
+        self.backend = backend
+        super().__init__(backend.engine_id)
+        self.scheduler = scheduler
+        self.session_id = session_id
+
+    @property
+    def engine_id(self) -> str:  # type: ignore
+        return self.backend.engine_id
+
+    @engine_id.setter
+    def engine_id(self, engine_id: str):
+        self.backend.engine_id = engine_id
+
+    def complete(
+            self,
+            prompt: str,
+            n: int,
+            max_tokens: int,
+            temperature: float,
+            stop: list[str],
+            stream: bool = False,
+            logprobs: bool = False,
+            on_usage: Optional[Callable[[Any], None]] = None,
+            cancelled: Optional[threading.Event] = None,
+            ) -> Generator[Completion, None, None]:
+        self.scheduler.acquire(self.session_id)
+        try:
+            completions = self.backend.complete(
+                prompt=prompt,
+                n=n,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop=stop,
+                stream=stream,
+                logprobs=logprobs,
+                on_usage=on_usage,
+                cancelled=cancelled,
+            )
+            if stream:
+                yield from completions
+                return
+            completions = list(completions)
+        finally:
+            self.scheduler.release(self.session_id)
+        yield from completions
+
+    def complete_many(
+            self,
+            prompts: list[str],
+            n: int,
+            max_tokens: int,
+            temperature: float,
+            stop: list[str],
+            logprobs: bool = False,
+            on_usage: Optional[Callable[[Any], None]] = None,
+            ) -> list[list[Completion]]:
+        self.scheduler.acquire(self.session_id)
+        try:
+            return self.backend.complete_many(
+                prompts=prompts,
+                n=n,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop=stop,
+                logprobs=logprobs,
+                on_usage=on_usage,
+            )
+        finally:
+            self.scheduler.release(self.session_id)
+
+    def get_engines(self) -> Any:
+        return self.backend.get_engines()
+
+    def get_engine_ids(self) -> list[str]:
+        return self.backend.get_engine_ids()
+
+    def get_endpoint(self) -> str:
+        return self.backend.get_endpoint()
+
+    def copy(self) -> 'ScheduledBackend':
+        return ScheduledBackend(self.backend.copy(), self.scheduler, self.session_id)
+
+    def close(self):
+        self.backend.close()
@@ -0,0 +1,129 @@
+"""Stages of the search for code that implements an instruction."""
+from typing import Generator
+from typing import Iterable
+from typing import Optional
+from dataclasses import dataclass
+from collections import Counter
+from natural_python.language_model_api import Completion
+import ast
+
+
+rankings = [
+    'none',
+    'likelihood',
+    'consensus',
+]
+"""Orders in which candidates can be validated. `none` keeps the order of the
+language model, `likelihood` validates first the candidates with the highest
+mean token log-probability, and `consensus` the candidates whose code was
+sampled the most times."""
+
+
+@dataclass
+class SearchStatistics:
+    """Counters of the search for candidates that implement instructions."""
+    batches: int = 0
+    """Batches of completions requested from the language model."""
+    sampled: int = 0
+    """Completions received from the language model."""
+    duplicates: int = 0
+    """Completions pruned because the same code was already considered."""
+    syntax_errors: int = 0
+    """Completions pruned because, with the constraint, they do not
+    compile."""
+    validated: int = 0
+    """Candidates that were executed."""
+    failed: int = 0
+    """Candidates whose execution failed."""
+    successes: int = 0
+    """Searches that found a candidate."""
+    tried_before_success: int = 0
+    """Candidates validated before the winner, in searches that found one."""
+
+
+def parse_sample_schedule(text: str) -> list[int]:
+    """Parse a schedule of batch sizes, e.g. `2,8,32`."""
+    schedule = [int(n) for n in text.split(',')]
+    if any(n <= 0 for n in schedule):
+        raise ValueError(f"Invalid sample schedule {text}")
+    return schedule
+
+
+def parse_temperature_schedule(text: str) -> list[float]:
+    """Parse a schedule of sampling temperatures, e.g. `0.2,0.5,0.8`."""
+    return [float(t) for t in text.split(',')]
+
+
+def normalize_code(code: list[str]) -> Optional[str]:
+    """Get a representation of the code that ignores whitespace, comments
+    and quote styles. Returns None if the code does not compile."""
+    try:
+        tree = ast.parse("\n".join(code))
+        compile(tree, '<candidate>', 'exec')
+    except (SyntaxError, ValueError):
+        return None
+    return ast.dump(tree)
+
+
+def rank_completions(
+        completions: Iterable[Completion],
+        ranking: str,
+        ) -> Iterable[Completion]:
+    """Order the completions so the ones most likely to succeed are validated
+    first, see `rankings`. Ranking needs every completion, so they are read
+    before any is returned."""
+    if ranking == 'none':
+        return completions
+    completions = list(completions)
+    if ranking == 'likelihood':
+        # Completions without log-probabilities go last
+        return sorted(
+            completions,
+            key=lambda c: -c.mean_logprob if c.mean_logprob is not None else float('inf'),
+        )
+    if ranking == 'consensus':
+        codes = [
+            normalize_code(c.code) or "\n".join(c.code)
+            for c in completions
+        ]
+        votes = Counter(codes)
+        ranked = sorted(
+            range(len(completions)),
+            key=lambda i: -votes[codes[i]],
+        )
+        return [completions[i] for i in ranked]
+    raise ValueError(f"Unknown ranking {ranking}")
+
+
+def prefilter_completions(
+        completions: Iterable[Completion],
+        constraint: list[str],
+        statistics: SearchStatistics,
+        seen_code: Optional[set[str]] = None,
+        ) -> Generator[Completion, None, None]:
+    """Drop the completions that can be ruled out without executing them:
+    completions that do not compile together with the `constraint`, and
+    completions whose code is the same as the one of a previous completion up
+    to formatting and comments. The normalized code of the completions that
+    are returned is added to `seen_code`.
+
+    Code is compiled by the Python interpreter running this function, which
+    may be a different version than the one executing the session."""
+    if seen_code is None:
+        seen_code = set()
+    try:
+        for completion in completions:
+            statistics.sampled += 1
+            code = normalize_code([*completion.code, *constraint])
+            if code is None:
+                statistics.syntax_errors += 1
+                continue
+            if code in seen_code:
+                statistics.duplicates += 1
+                continue
+            seen_code.add(code)
+            yield completion
+    finally:
+        close = getattr(completions, 'close', None)
+        if close is not None:
+            close()
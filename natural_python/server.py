@@ -0,0 +1,320 @@
+"""HTTP/JSON API that hosts many sessions in a single process.
+
+Sessions share the language model client, and take turns to use a bounded
+number of candidate executions and language model requests.
+
+- `POST /sessions` creates a session and returns its ID.
+- `GET /sessions/ID` returns the code and the metrics of a session.
+- `POST /sessions/ID/instructions` executes an instruction, given as
+  `{"instruction": [...], "constraint": [...], "parameters": [...]}` with the
+  lines of each part of an instruction block of a natural script.
+- `POST /sessions/ID/code` appends raw Python code, given as `{"code": [...]}`.
+- `DELETE /sessions/ID` closes a session, once its running instruction
+  finishes.
+- `GET /metrics` returns the metrics of every session and of the shared
+  execution and sampling slots.
+
+Instructions return `{"error": ...}` with status 502 if the language model API
+failed, or 500 if anything else did.
+"""
+from typing import Any
+from typing import Callable
+from typing import Optional
+from collections import deque
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from natural_python import console
+from natural_python import profiling
+from natural_python import search
+from natural_python.backends import LanguageModelAPIError
+from natural_python.scheduling import FairScheduler
+import threading
+import json
+import time
+import re
+
+
+latency_window = 100
+"""Number of recent instructions the latency metrics of a session cover."""
+
+
+def get_percentile(values: list[float], q: float) -> Optional[float]:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(int(q*len(values)), len(values)-1)]
+
+
+class SessionClosedError(Exception):
+    """Raised when a session is used after it was closed."""
+
+
+class Session:
+    """A session hosted by the server. Its instructions are executed one at a
+    time, in the order they are received."""
+    def __init__(self, session_id: str, parameters: console.SessionParameters):
+        self.id = session_id
+        self.parameters = parameters
+        self.current_python_code: list[str] = list()
+        self.search_statistics = search.SearchStatistics()
+        self.lock = threading.Lock()
+        """Held while the code or the worker of the session are used."""
+        self.closed = False
+        self.metrics_lock = threading.Lock()
+        self.queued = 0
+        """Instructions waiting for the previous ones to finish."""
+        self.executed = 0
+        self.failed = 0
+        self.latencies: deque[float] = deque(maxlen=latency_window)
+        """Seconds from receiving each recent instruction to finishing it."""
+
+    def execute(self, block: console.ScriptBlock, profiler: Optional[profiling.Profiler]) -> dict:
+        start = time.perf_counter()
+        with self.metrics_lock:
+            self.queued += 1
+        with self.lock:
+            with self.metrics_lock:
+                self.queued -= 1
+            if self.closed:
+                raise SessionClosedError(self.id)
+            ok = False
+            try:
+                result = console.execute_block(
+                    block=block,
+                    current_python_code=self.current_python_code,
+                    parameters=self.parameters,
+                    search_statistics=self.search_statistics,
+                    profiler=profiler,
+                )
+                ok = result['ok']
+            finally:
+                # Errors of the backend or the worker also count as failures
+                with self.metrics_lock:
+                    self.executed += 1
+                    if not ok:
+                        self.failed += 1
+                    self.latencies.append(time.perf_counter()-start)
+        return result
+
+    def add_code(self, code: list[str]):
+        with self.lock:
+            if self.closed:
+                raise SessionClosedError(self.id)
+            self.current_python_code.extend(code)
+
+    def get_metrics(self, execution: FairScheduler, sampling: FairScheduler) -> dict:
+        """Get the latency of the recent instructions and the queue depths of
+        the session."""
+        with self.metrics_lock:
+            latencies = list(self.latencies)
+            executed, failed, queued = self.executed, self.failed, self.queued
+        return dict(
+            executed=executed,
+            failed=failed,
+            queued=queued,
+            latency=dict(
+                last=latencies[-1] if len(latencies) > 0 else None,
+                mean=sum(latencies)/len(latencies) if len(latencies) > 0 else None,
+                p50=get_percentile(latencies, 0.5),
+                p95=get_percentile(latencies, 0.95),
+            ),
+            execution=execution.get_metrics(self.id),
+            sampling=sampling.get_metrics(self.id),
+            sampled=self.search_statistics.sampled,
+            validated=self.search_statistics.validated,
+        )
+
+    def close(self):
+        """Close the session once its running instruction finishes. The
+        instructions still waiting are not executed."""
+        with self.lock:
+            self.closed = True
+            self.parameters.python_worker.close()
+            self.parameters.backend.close()
+
+
+class SessionServer(ThreadingHTTPServer):
+    """Hosts sessions whose parameters are created by `create_parameters`,
+    given the ID of the session. The workers and backends of the sessions are
+    expected to take their slots from the `execution` and `sampling`
+    schedulers."""
+    daemon_threads = True
+
+    def __init__(
+            self,
+            address: tuple[str, int],
+            create_parameters: Callable[[str], console.SessionParameters],
+            execution: FairScheduler,
+            sampling: FairScheduler,
+            profiler: Optional[profiling.Profiler] = None,
+            ):
+        super().__init__(address, SessionRequestHandler)
+        self.create_parameters = create_parameters
+        self.execution = execution
+        self.sampling = sampling
+        self.profiler = profiler
+        self.sessions: dict[str, Session] = dict()
+        self.lock = threading.Lock()
+        self.session_n = 0
+
+    def create_session(self) -> Session:
+        with self.lock:
+            self.session_n += 1
+            session_id = str(self.session_n)
+        session = Session(session_id, self.create_parameters(session_id))
+        with self.lock:
+            self.sessions[session_id] = session
+        return session
+
+    def get_session(self, session_id: str) -> Optional[Session]:
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    def close_session(self, session_id: str) -> bool:
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return dict(
+            sessions={
+                session.id: session.get_metrics(self.execution, self.sampling)
+                for session in sessions
+            },
+            execution=self.execution.get_metrics(),
+            sampling=self.sampling.get_metrics(),
+        )
+
+    def server_close(self):
+        super().server_close()
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = dict()
+        for session in sessions:
+            session.close()
+
+
+def get_lines(body: dict, name: str) -> list[str]:
+    """Get a list of lines of the request body, which can also be given as a
+    single string."""
+    value = body.get(name, list())
+    if isinstance(value, str):
+        return value.splitlines()
+    if not isinstance(value, list) or not all(isinstance(l, str) for l in value):
+        raise ValueError(f"'{name}' has to be a list of strings")
+    return value
+
+
+class SessionRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: SessionServer
+
+    def log_message(self, *_):
+        pass
+
+    def send_json(self, status: int, data: Any):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return dict()
+        body = json.loads(self.rfile.read(length))
+        if not isinstance(body, dict):
+            raise ValueError("The request body has to be a JSON object")
+        return body
+
+    def get_session(self, session_id: str) -> Optional[Session]:
+        session = self.server.get_session(session_id)
+        if session is None:
+            self.send_json(404, dict(error=f"Unknown session {session_id}"))
+        return session
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.server.get_metrics())
+            return
+        match = re.fullmatch(r'/sessions/(\w+)', self.path)
+        if match is None:
+            self.send_json(404, dict(error="Not found"))
+            return
+        session = self.get_session(match.group(1))
+        if session is not None:
+            with session.lock:
+                code = list(session.current_python_code)
+            self.send_json(200, dict(
+                id=session.id,
+                code=code,
+                metrics=session.get_metrics(self.server.execution, self.server.sampling),
+            ))
+
+    def do_POST(self):
+        try:
+            body = self.read_json()
+        except ValueError as e:
+            self.send_json(400, dict(error=str(e)))
+            return
+        if self.path == '/sessions':
+            session = self.server.create_session()
+            self.send_json(201, dict(id=session.id))
+            return
+        match = re.fullmatch(r'/sessions/(\w+)/(instructions|code)', self.path)
+        if match is None:
+            self.send_json(404, dict(error="Not found"))
+            return
+        session = self.get_session(match.group(1))
+        if session is None:
+            return
+        try:
+            if match.group(2) == 'code':
+                session.add_code(get_lines(body, 'code'))
+                self.send_json(200, dict(ok=True))
+                return
+            block = console.ScriptBlock(
+                line_n=0,
+                instruction=get_lines(body, 'instruction'),
+                constraint=get_lines(body, 'constraint'),
+                parameters=get_lines(body, 'parameters'),
+                python_code=list(),
+            )
+        except ValueError as e:
+            self.send_json(400, dict(error=str(e)))
+            return
+        except SessionClosedError:
+            self.send_json(404, dict(error=f"Session {session.id} was closed"))
+            return
+        if len(block.instruction) == 0 and len(block.constraint) == 0:
+            self.send_json(400, dict(error="Empty instruction"))
+            return
+        try:
+            result = session.execute(block, self.server.profiler)
+        except SessionClosedError:
+            self.send_json(404, dict(error=f"Session {session.id} was closed"))
+            return
+        except LanguageModelAPIError as e:
+            self.send_json(502, dict(error=str(e)))
+            return
+        except Exception as e:
+            self.send_json(500, dict(error=f"{type(e).__name__}: {e}"))
+            return
+        self.send_json(200, result)
+
+    def do_DELETE(self):
+        match = re.fullmatch(r'/sessions/(\w+)', self.path)
+        if match is None:
+            self.send_json(404, dict(error="Not found"))
+            return
+        if self.server.close_session(match.group(1)):
+            self.send_json(200, dict(ok=True))
+        else:
+            self.send_json(404, dict(error=f"Unknown session {match.group(1)}"))
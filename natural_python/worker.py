@@ -0,0 +1,718 @@
+"""Python interpreters used to execute candidate code."""
+from typing import BinaryIO
+from typing import Callable
+from typing import Optional
+from typing import TextIO
+from abc import ABC
+from abc import abstractmethod
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import replace
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from natural_python.runner import BoundedOutput
+import tempfile
+import subprocess
+import threading
+import shlex
+import functools
+import hashlib
+import json
+import os
+import signal
+
+try:
+    import resource
+except ImportError:
+    # Resource limits are not supported on this platform
+    resource = None
+
+
+runner_file = Path(__file__).parent/'runner.py'
+"""Script executed by the Python shell of a `PythonWorker`."""
+
+fork_available = hasattr(os, 'fork')
+"""Whether candidates can be executed in forked copies of an interpreter."""
+
+
+timeout_grace = 1.0
+"""Seconds an interpreter is given past the timeout of an execution to
+interrupt it by itself before it is killed."""
+
+
+class PythonInterpreterError(Exception):
+    """Raised when a Python interpreter exits with error status."""
+    def __init__(self, message: str = "", deterministic: bool = False):
+        super().__init__(message)
+        self.deterministic = deterministic
+        """Whether the code fails every time it is executed: it raised, or
+        exceeded its CPU time or memory. Running out of wall-clock time or
+        losing the interpreter may not happen again."""
+
+
+@dataclass
+class ExecutionLimits:
+    """Limits of the resources code can use before it is considered a
+    failure. None disables a limit."""
+    timeout: Optional[float] = None
+    """Wall-clock seconds."""
+    cpu_time: Optional[float] = None
+    """CPU seconds. Not enforced on platforms without `resource`."""
+    memory: Optional[int] = None
+    """Bytes of address space. Not enforced on platforms without
+    `resource`."""
+    output: Optional[int] = None
+    """Bytes of stdout, and of stderr, kept of each execution. Longer outputs
+    are not a failure: their middle is left out."""
+
+
+prlimit_available = hasattr(resource, 'prlimit')
+"""Whether the resources of interpreters can be limited once they are
+spawned, without running code in the child before it executes the
+interpreter (which is not safe in a multi-threaded process)."""
+
+
+def get_resource_limits(limits: ExecutionLimits) -> list[tuple[int, tuple[int, int]]]:
+    """Get the resource limits of `limits` as arguments of `setrlimit`."""
+    if resource is None:
+        return list()
+    resource_limits = list()
+    if limits.cpu_time is not None:
+        cpu_time = int(max(1, round(limits.cpu_time)))
+        # The soft limit sends SIGXCPU, which tells the failure apart from a
+        # kill by the system. The hard limit kills interpreters that ignore it
+        resource_limits.append((resource.RLIMIT_CPU, (cpu_time, cpu_time+1)))
+    if limits.memory is not None:
+        resource_limits.append((resource.RLIMIT_AS, (limits.memory, limits.memory)))
+    return resource_limits
+
+
+def set_resource_limits(limits: ExecutionLimits):
+    """Limit the CPU time and memory of the current process."""
+    for limit, values in get_resource_limits(limits):
+        resource.setrlimit(limit, values)
+
+
+def limit_process(process: subprocess.Popen, limits: ExecutionLimits):
+    """Limit the CPU time and memory of a spawned process."""
+    for limit, values in get_resource_limits(limits):
+        try:
+            resource.prlimit(process.pid, limit, values)
+        except ProcessLookupError:
+            # The process already exited
+            pass
+
+
+def get_limited_file_args(
+        source_path: str,
+        resource_limits: list[tuple[int, tuple[int, int]]],
+        ) -> list[str]:
+    """Get the arguments of a Python shell that sets `resource_limits` on
+    itself, then runs the program `source_path` like it would be run as a
+    script. Unlike `limit_process`, the limits are set before any of the
+    program runs."""
+    statements = [
+        "import resource, runpy, sys",
+        *[f"resource.setrlimit({limit}, {values})" for limit, values in resource_limits],
+        f"sys.argv[0] = {source_path!r}",
+        f"sys.path[0] = {os.path.dirname(source_path)!r}",
+        f"runpy.run_path({source_path!r}, run_name='__main__')",
+    ]
+    return ['-c', "; ".join(statements)]
+
+
+def read_output(stream: BinaryIO, output: BoundedOutput):
+    """Copy a stream of an interpreter to `output` until it is closed."""
+    while True:
+        data = stream.read1(65536)  # type: ignore
+        if len(data) == 0:
+            break
+        output.write_bytes(data)
+
+
+def write_source(stream: BinaryIO, python_code: str):
+    """Write the code of a program to the stdin of an interpreter."""
+    try:
+        stream.write(python_code.encode('utf-8'))
+        stream.close()
+    except (BrokenPipeError, ValueError):
+        # The interpreter exited without reading the whole program
+        pass
+
+
+def get_code_output(
+        python_code: str,
+        python_shell: str,
+        on_spawn: Optional[Callable[[subprocess.Popen], None]] = None,
+        limits: Optional[ExecutionLimits] = None,
+        skip: int = 0,
+        source_dir: Optional[Path] = None,
+        ) -> tuple[str, int]:
+    """Return the stdout of executing `python_code` with the Python
+    interpreter, without its first `skip` bytes, and the bytes written to
+    stdout in total. `python_shell` is the command used to spawn a Python
+    shell. `on_spawn` is called with the interpreter process once it is
+    spawned. The interpreter is killed if it exceeds `limits`.
+
+    The code is piped to the stdin of the interpreter, which runs it as the
+    program `-`. With `source_dir`, the code is written to a file in that
+    directory instead, for Python shells that can not read programs from
+    stdin, and the file is removed once the interpreter exits. The
+    interpreter would start running the file before it could be limited
+    from outside, so it is run by a `-c` program that limits the interpreter
+    first, see `get_limited_file_args`.
+
+    Stdout and stderr are read as they are written, keeping at most
+    `limits.output` bytes of each. If the interpreter fails, its stderr (e.g.
+    the traceback) is the message of the `PythonInterpreterError`."""
+    if limits is None:
+        limits = ExecutionLimits()
+    source_path = None
+    resource_limits = get_resource_limits(limits)
+    if source_dir is None:
+        args = [*shlex.split(python_shell), '-']
+    else:
+        fd, source_path = tempfile.mkstemp(prefix='natural-python', suffix='.py', dir=source_dir)
+        with os.fdopen(fd, "wt", encoding='utf-8') as python_src_file:
+            python_src_file.write(python_code)
+        if len(resource_limits) > 0 and prlimit_available:
+            args = [*shlex.split(python_shell), *get_limited_file_args(source_path, resource_limits)]
+        else:
+            args = [*shlex.split(python_shell), source_path]
+    try:
+        process = subprocess.Popen(
+            args,
+            # Code can not read the input of the session
+            stdin=subprocess.PIPE if source_path is None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            # Only when the limits can not be set once the process is spawned,
+            # since code that runs before exec is not safe with threads
+            preexec_fn=(
+                functools.partial(set_resource_limits, limits)
+                if len(resource_limits) > 0 and not prlimit_available
+                else None
+            ),
+        )
+        if len(resource_limits) > 0 and prlimit_available and source_path is None:
+            # Piped code is written after this, so it always runs limited
+            limit_process(process, limits)
+        if on_spawn is not None:
+            on_spawn(process)
+        stdout = BoundedOutput(limits.output, skip=skip)
+        stderr = BoundedOutput(limits.output)
+        threads = [
+            threading.Thread(target=read_output, args=(stream, output), daemon=True)
+            for stream, output in [(process.stdout, stdout), (process.stderr, stderr)]
+        ]
+        if source_path is None:
+            # A writer thread, so the time limit holds even if the
+            # interpreter does not read the program
+            threads.append(threading.Thread(target=write_source, args=(process.stdin, python_code), daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            process.wait(timeout=limits.timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            raise PythonInterpreterError("Wall-clock time limit exceeded")
+        finally:
+            for thread in threads:
+                thread.join()
+            assert process.stdout is not None and process.stderr is not None
+            process.stdout.close()
+            process.stderr.close()
+    finally:
+        if source_path is not None:
+            os.unlink(source_path)
+    if process.returncode != 0:
+        raise PythonInterpreterError(
+            stderr.getvalue().rstrip("\n")
+            or f"Python interpreter exited with status {process.returncode}",
+            # Killed by a signal other than the CPU time limit's, e.g. by the
+            # system when it ran out of memory
+            deterministic=process.returncode > 0 or process.returncode == -getattr(signal, 'SIGXCPU', 0),
+        )
+    return stdout.getvalue(), stdout.size
+
+
+def get_new_code_output(
+        new_code: list[str],
+        current_code: list[str],
+        python_shell: str,
+        on_spawn: Optional[Callable[[subprocess.Popen], None]] = None,
+        limits: Optional[ExecutionLimits] = None,
+        current_output_size: Optional[int] = None,
+        source_dir: Optional[Path] = None,
+        ) -> tuple[str, int]:
+    """Execute the given prefix (current_code), then execute given suffix
+    (new_code) in a Python interpreter. Return the output of the suffix, and
+    its size in bytes.
+    `python_shell` is the command used to spawn a Python shell, see
+    `get_code_output` for `on_spawn`, `limits` and `source_dir`. If the bytes
+    the prefix writes to stdout (`current_output_size`) are known, the prefix
+    is not executed on its own.
+
+    Only the output of the suffix is kept: the output of the prefix is
+    skipped as it is read."""
+    if current_output_size is None:
+        _, current_output_size = get_code_output(
+            "\n".join(current_code),
+            python_shell,
+            on_spawn,
+            replace(limits or ExecutionLimits(), output=0),
+            source_dir=source_dir,
+        )
+    new_output, size = get_code_output(
+        "\n".join([*current_code, *new_code]),
+        python_shell,
+        on_spawn,
+        limits,
+        skip=current_output_size,
+        source_dir=source_dir,
+    )
+    return new_output, max(size-current_output_size, 0)
+
+
+def get_code_key(code: list[str]) -> str:
+    """Get a key that identifies some code."""
+    return hashlib.sha256("\n".join(code).encode('utf-8')).hexdigest()
+
+
+@dataclass
+class Execution:
+    """Code submitted to a worker, see `Worker.submit`."""
+    code: list[str]
+    future: Future
+    """Resolves to the output of the code to stdout, or fails with
+    `PythonInterpreterError`."""
+    request_id: int = 0
+
+
+class Worker(ABC):
+    """Executes code on top of the code committed in a session."""
+    def __init__(self, python_shell: str, parallel: int = 1):
+        if parallel <= 0:
+            raise ValueError(f"Invalid number of parallel executions {parallel}")
+        self.python_shell = python_shell
+        """Command used to spawn a Python shell."""
+        self.parallel = parallel
+        """Number of executions that can run at the same time."""
+        self.limits = ExecutionLimits()
+        """Limits of the code submitted to the worker."""
+        self.committed_code: list[str] = list()
+        """Code that has been successfully executed in the session."""
+
+    @abstractmethod
+    def sync(self, current_code: list[str]):
+        """Make sure the worker state is the result of executing
+        `current_code`. Raises `PythonInterpreterError` if the code that was
+        not executed yet fails."""
+
+    @abstractmethod
+    def submit(self, code: list[str]) -> Execution:
+        """Start executing `code` on top of the committed code. Every
+        execution has to be either accepted or discarded."""
+
+    @abstractmethod
+    def accept(self, execution: Execution):
+        """Commit a successful execution."""
+
+    @abstractmethod
+    def discard(self, execution: Execution):
+        """Roll back an execution, killing it if it is still running."""
+
+    def snapshot(self) -> Optional[str]:
+        """Serialize the state of the session after executing the committed
+        code, or return None if it can not be serialized."""
+        return None
+
+    def restore(self, committed_code: list[str], state: str) -> bool:
+        """Replace the state of the session by one serialized by `snapshot`
+        after executing `committed_code`. Returns False if it can not be
+        loaded, leaving the worker without committed code."""
+        return False
+
+    def run(self, code: list[str]) -> str:
+        """Execute `code` on top of the committed code and return its output to
+        stdout. On success the code is committed, otherwise it is rolled back
+        and `PythonInterpreterError` is raised."""
+        execution = self.submit(code)
+        try:
+            output = execution.future.result()
+        except PythonInterpreterError:
+            self.discard(execution)
+            raise
+        self.accept(execution)
+        return output
+
+    def close(self):
+        """Release the resources held by the worker."""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class ReplayWorker(Worker):
+    """Executes every candidate in a fresh Python interpreter by replaying the
+    committed code. Slow, but candidates run exactly like the session script
+    does when executed from scratch. The limits apply to the replay of the
+    committed code too.
+
+    The size of the output of the committed code is memoized, so it is
+    executed on its own at most once per commit instead of once per
+    candidate, and its output is skipped as candidates replay it.
+
+    Code is piped to the interpreters. With `source_files`, it is written to
+    files instead, in a directory of the worker that is removed when it is
+    closed, see `get_code_output`."""
+    def __init__(self, python_shell: str, parallel: int = 1, source_files: bool = False):
+        super().__init__(python_shell, parallel)
+        self.source_dir: Optional[tempfile.TemporaryDirectory] = None
+        if source_files:
+            self.source_dir = tempfile.TemporaryDirectory(prefix='natural-python')
+        self.pool = ThreadPoolExecutor(max_workers=parallel)
+        self.processes: dict[int, list[subprocess.Popen]] = dict()
+        self.submission_n = 0
+        self.committed_key = get_code_key(self.committed_code)
+        """Key of the committed code whose output size is memoized."""
+        self.committed_output_size: Optional[int] = 0
+        """Bytes the committed code writes to stdout, or None if it
+        failed."""
+        self.output_sizes: dict[int, int] = dict()
+        """Bytes written to stdout by each finished execution."""
+
+    def sync(self, current_code: list[str]):
+        key = get_code_key(current_code)
+        if key != self.committed_key:
+            self.committed_code = list(current_code)
+            self.committed_key = key
+            try:
+                _, self.committed_output_size = get_code_output(
+                    "\n".join(current_code),
+                    self.python_shell,
+                    limits=replace(self.limits, output=0),
+                    source_dir=self.get_source_dir(),
+                )
+            except PythonInterpreterError:
+                self.committed_output_size = None
+        if self.committed_output_size is None:
+            raise PythonInterpreterError()
+
+    def submit(self, code: list[str]) -> Execution:
+        self.submission_n += 1
+        processes: list[subprocess.Popen] = list()
+        self.processes[self.submission_n] = processes
+        request_id = self.submission_n
+        current_code = list(self.committed_code)
+        current_output_size = self.committed_output_size
+        limits = replace(self.limits)
+
+        def execute() -> str:
+            output, size = get_new_code_output(
+                new_code=code,
+                current_code=current_code,
+                python_shell=self.python_shell,
+                on_spawn=processes.append,
+                limits=limits,
+                current_output_size=current_output_size,
+                source_dir=self.get_source_dir(),
+            )
+            self.output_sizes[request_id] = size
+            return output
+        future = self.pool.submit(execute)
+        return Execution(code=code, future=future, request_id=request_id)
+
+    def accept(self, execution: Execution):
+        del self.processes[execution.request_id]
+        execution.future.result()
+        self.committed_code.extend(execution.code)
+        # The output of the new committed code is the output of the
+        # execution appended to the previous one
+        self.committed_key = get_code_key(self.committed_code)
+        size = self.output_sizes.pop(execution.request_id)
+        if self.committed_output_size is not None:
+            self.committed_output_size += size
+
+    def discard(self, execution: Execution):
+        execution.future.cancel()
+        self.output_sizes.pop(execution.request_id, None)
+        for process in self.processes.pop(execution.request_id):
+            process.kill()
+
+    def get_source_dir(self) -> Optional[Path]:
+        return Path(self.source_dir.name) if self.source_dir is not None else None
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        if self.source_dir is not None:
+            self.source_dir.cleanup()
+
+
+class PythonWorker(Worker):
+    """Long-lived Python interpreter that keeps the session state alive, so
+    only new code is executed.
+
+    With `fork`, code is executed in copy-on-write children of the
+    interpreter, up to `parallel` at a time. An accepted child replaces the
+    interpreter; discarded ones are killed and leave the session state
+    untouched. Without `fork`, code is executed in the interpreter one piece at
+    a time and code that raises is rolled back by restoring the namespace
+    bindings from before its execution; in-place mutations of existing objects
+    are not undone.
+
+    If the interpreter dies, it is restarted and the committed code is replayed
+    once. Code that exceeds the limits is interrupted by the interpreter, and
+    killed if it does not stop: a forked child is killed by the interpreter,
+    while the interpreter itself is killed and restarted in namespace mode."""
+    def __init__(
+            self,
+            python_shell: str,
+            fork: bool = fork_available,
+            parallel: int = 1,
+            ):
+        super().__init__(python_shell, parallel if fork else 1)
+        self.fork = fork
+        """Whether code is executed in forked children of the interpreter."""
+        self.process: Optional[subprocess.Popen] = None
+        self.reader: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.pending: dict[int, Future] = dict()
+        """Futures of the requests waiting for a response."""
+        self.responses_closed = False
+        self.request_n = 0
+        self.diverged = False
+
+    def start(self):
+        """Spawn the interpreter and replay the committed code."""
+        args = [
+            *shlex.split(self.python_shell),
+            str(runner_file),
+        ]
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding='utf-8',
+            # Keep keyboard interrupts meant for the REPL away from the worker
+            start_new_session=True,
+        )
+        self.responses_closed = False
+        self.diverged = False
+        self.reader = threading.Thread(
+            target=self.read_responses,
+            args=(self.process.stdout,),
+            daemon=True,
+        )
+        self.reader.start()
+        if len(self.committed_code) > 0:
+            # The output of the committed code was already shown
+            response = self.request(dict(
+                op='run',
+                code="\n".join(self.committed_code),
+                limits=dict(output=0),
+            ))
+            if not response['ok']:
+                raise PythonInterpreterError(response['error'])
+
+    def read_responses(self, stdout: TextIO):
+        """Resolve the futures of the requests with the responses of the
+        interpreter."""
+        for line in stdout:
+            response = json.loads(line)
+            with self.lock:
+                future = self.pending.pop(response['id'], None)
+            # Responses to discarded requests are ignored
+            if future is not None:
+                future.set_result(response)
+
+        # The interpreter died (e.g. the code called os._exit), the next
+        # request will restart it
+        with self.lock:
+            self.responses_closed = True
+            pending = self.pending
+            self.pending = dict()
+        for future in pending.values():
+            future.set_exception(PythonInterpreterError("Python worker exited unexpectedly"))
+
+    def ensure_started(self):
+        """Restart the interpreter if it is not usable anymore."""
+        if self.process is None or self.responses_closed or self.diverged:
+            self.close()
+            self.start()
+
+    def send(self, message: dict):
+        """Send a request that has no response to the interpreter."""
+        self.ensure_started()
+        assert self.process is not None
+        assert self.process.stdin is not None
+        self.process.stdin.write(json.dumps(message)+'\n')
+        self.process.stdin.flush()
+
+    def post(self, message: dict) -> tuple[int, Future]:
+        """Send a request to the interpreter. Returns the ID of the request
+        and the future of its response."""
+        # Restart before registering the request, so the reader of a dead
+        # interpreter does not fail it
+        self.ensure_started()
+        future: Future = Future()
+        with self.lock:
+            self.request_n += 1
+            request_id = self.request_n
+            self.pending[request_id] = future
+        try:
+            self.send(dict(id=request_id, **message))
+        except BrokenPipeError:
+            pass
+        with self.lock:
+            if self.responses_closed and request_id in self.pending:
+                del self.pending[request_id]
+                future.set_exception(PythonInterpreterError("Python worker exited unexpectedly"))
+        return request_id, future
+
+    def request(self, message: dict) -> dict:
+        """Send a request to the interpreter and return its response."""
+        _, response = self.post(message)
+        return response.result()
+
+    def sync(self, current_code: list[str]):
+        committed_n = len(self.committed_code)
+        if current_code[:committed_n] != self.committed_code:
+            # The session diverged from the worker, start from scratch
+            self.close()
+            self.committed_code = list()
+            committed_n = 0
+        new_code = current_code[committed_n:]
+        if len(new_code) > 0:
+            self.run(new_code)
+
+    def submit(self, code: list[str]) -> Execution:
+        op = 'fork' if self.fork else 'run'
+        limits = {
+            name: value
+            for name, value in asdict(self.limits).items()
+            if value is not None
+        }
+        request_id, response = self.post(dict(
+            op=op,
+            code="\n".join(code),
+            limits=limits,
+        ))
+        future: Future = Future()
+        if not self.fork and self.limits.timeout is not None:
+            self.watch(request_id, response, self.limits.timeout+timeout_grace)
+
+        def resolve(response: Future):
+            try:
+                result = response.result()
+            except PythonInterpreterError as e:
+                future.set_exception(e)
+                return
+            if result['ok']:
+                future.set_result(result['stdout'])
+            else:
+                # Keep what the code wrote to stderr before failing
+                reason = "\n".join(
+                    r for r in [result.get('stderr', '').rstrip("\n"), result['error']] if r
+                )
+                future.set_exception(PythonInterpreterError(reason, deterministic=result.get('deterministic', False)))
+        response.add_done_callback(resolve)
+        return Execution(code=code, future=future, request_id=request_id)
+
+    def snapshot(self) -> Optional[str]:
+        if len(self.committed_code) == 0 or self.process is None or self.responses_closed or self.diverged:
+            return None
+        try:
+            response = self.request(dict(op='snapshot'))
+        except PythonInterpreterError:
+            return None
+        return response['data'] if response['ok'] else None
+
+    def restore(self, committed_code: list[str], state: str) -> bool:
+        self.close()
+        self.committed_code = list()
+        try:
+            response = self.request(dict(op='restore', data=state))
+        except PythonInterpreterError:
+            return False
+        if not response['ok']:
+            # The interpreter may hold part of the state
+            self.close()
+            return False
+        self.committed_code = list(committed_code)
+        return True
+
+    def watch(self, request_id: int, response: Future, timeout: float):
+        """Kill the interpreter if it did not respond to a request after
+        `timeout` seconds. The next request restarts it."""
+        process = self.process
+
+        def kill():
+            with self.lock:
+                if self.pending.get(request_id) is not response or process is not self.process:
+                    return
+                del self.pending[request_id]
+                # Restart the interpreter on the next request, even if the
+                # reader did not notice it died yet
+                self.diverged = True
+            assert process is not None
+            process.kill()
+            response.set_exception(PythonInterpreterError("Wall-clock time limit exceeded"))
+        watchdog = threading.Timer(timeout, kill)
+        watchdog.daemon = True
+        watchdog.start()
+        response.add_done_callback(lambda _: watchdog.cancel())
+
+    def accept(self, execution: Execution):
+        if self.fork:
+            self.request(dict(op='promote', fork_id=execution.request_id))
+        self.committed_code.extend(execution.code)
+
+    def discard(self, execution: Execution):
+        if self.fork:
+            with self.lock:
+                self.pending.pop(execution.request_id, None)
+            try:
+                self.send(dict(op='discard', fork_id=execution.request_id))
+            except BrokenPipeError:
+                pass
+        elif execution.future.done() and execution.future.exception() is None:
+            # The code already changed the session state
+            self.diverged = True
+
+    def close(self):
+        if self.process is None:
+            return
+        assert self.process.stdin is not None
+        assert self.process.stdout is not None
+        assert self.reader is not None
+        try:
+            self.process.stdin.write(json.dumps(dict(op='exit'))+'\n')
+            self.process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+        # The session state may be held by a forked child of the spawned
+        # process, so wait until every process closed the responses pipe
+        # and then make sure none of them is left behind
+        self.reader.join(timeout=1.0)
+        if self.fork:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        try:
+            self.process.wait(timeout=1.0)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.reader.join()
+        self.process.stdout.close()
+        self.process = None
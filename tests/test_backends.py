@@ -0,0 +1,132 @@
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from natural_python.backends import HTTPBackend
+from natural_python.backends import LanguageModelAPIError
+import threading
+import json
+import time
+import pytest
+
+
+class CompletionHandler(BaseHTTPRequestHandler):
+    """Completes each prompt with `PROMPT:I` for its I-th completion. Choices
+    are returned in reverse order, and streamed choices other than the first
+    one take `token_n` slow tokens. Requests to the `busy` engine are
+    answered with the statuses of `busy_statuses` first."""
+    protocol_version = 'HTTP/1.1'
+    token_n = 100
+    busy_statuses: list[int] = list()
+
+    def log_message(self, *_):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path == '/v1/engines/failing/completions':
+            data = b'{"error": "Bad request"}'
+            self.send_response(400)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if self.path == '/v1/engines/busy/completions' and len(self.busy_statuses) > 0:
+            data = b'{"error": "Busy"}'
+            self.send_response(self.busy_statuses.pop(0))
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        prompts = body['prompt'] if isinstance(body['prompt'], list) else [body['prompt']]
+        n = body['n']
+        if not body.get('stream'):
+            choices = [
+                dict(index=i*n+j, text=f"{prompt}:{j}\n", finish_reason='stop', logprobs=None)
+                for i, prompt in enumerate(prompts)
+                for j in range(n)
+            ]
+            data = json.dumps(dict(choices=list(reversed(choices)))).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.send_event(dict(choices=[dict(index=0, text="x = 1\n", finish_reason='stop', logprobs=None)]))
+        for _ in range(self.token_n):
+            time.sleep(0.05)
+            self.send_event(dict(choices=[dict(index=1, text="1", finish_reason=None, logprobs=None)]))
+        self.send_event('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_event(self, data):
+        event = f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n".encode('utf-8')
+        self.wfile.write(f'{len(event):x}\r\n'.encode('ascii')+event+b'\r\n')
+        self.wfile.flush()
+
+
+@pytest.fixture
+def api_base():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CompletionHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/v1'
+    server.shutdown()
+    server.server_close()
+
+
+def test_complete_many_routes_choices_by_index(api_base):
+    with HTTPBackend(api_base, 'key', 'engine') as backend:
+        completions = backend.complete_many(['a', 'b', 'c'], n=2, max_tokens=10, temperature=0.0, stop=['#'])
+    assert [sorted(c.code[0] for c in prompt_completions) for prompt_completions in completions] == [
+        ['a:0', 'a:1'],
+        ['b:0', 'b:1'],
+        ['c:0', 'c:1'],
+    ]
+
+
+def test_cancelled_stream_is_abandoned(api_base):
+    cancelled = threading.Event()
+    with HTTPBackend(api_base, 'key', 'engine') as backend:
+        completions = backend.complete('a', n=2, max_tokens=10, temperature=0.0, stop=['#'], stream=True, cancelled=cancelled)
+        assert next(completions).code == ['x = 1']
+        start = time.monotonic()
+        cancelled.set()
+        list(completions)
+    # The server takes 5 seconds to finish the stream
+    assert time.monotonic()-start < 1
+
+
+def test_errors_are_not_retried(api_base):
+    with HTTPBackend(api_base, 'key', 'failing') as backend:
+        with pytest.raises(LanguageModelAPIError) as error:
+            list(backend.complete('a', n=1, max_tokens=10, temperature=0.0, stop=['#']))
+    assert error.value.status == 400
+
+
+def test_busy_api_is_retried(api_base, monkeypatch):
+    monkeypatch.setattr(CompletionHandler, 'busy_statuses', [429, 503])
+    with HTTPBackend(api_base, 'key', 'busy') as backend:
+        completions = list(backend.complete('a', n=1, max_tokens=10, temperature=0.0, stop=['#']))
+    assert [c.code for c in completions] == [['a:0']]
+    assert CompletionHandler.busy_statuses == []
+
+
+def test_retries_give_up(api_base, monkeypatch):
+    monkeypatch.setattr(CompletionHandler, 'busy_statuses', [429, 429, 429])
+    with HTTPBackend(api_base, 'key', 'busy', max_retries=1) as backend:
+        with pytest.raises(LanguageModelAPIError) as error:
+            list(backend.complete('a', n=1, max_tokens=10, temperature=0.0, stop=['#']))
+    assert error.value.status == 429
+    assert CompletionHandler.busy_statuses == [429]
@@ -0,0 +1,192 @@
+from natural_python.backends import FakeBackend
+from natural_python.backends import HTTPBackend
+from natural_python.cache import CompletionCache
+from natural_python.cache import EngineCatalogue
+from natural_python.cache import ValidationCache
+from natural_python.cache import ValidationFailure
+from natural_python.cache import get_cached_completions
+from natural_python.cache import get_statement_boundaries
+from natural_python.language_model_api import Completion
+from dataclasses import asdict
+import json
+import time
+
+
+def fail(cache: ValidationCache, candidate: str, constraint: list[str], limits: dict = dict()):
+    key = ValidationCache.get_key('session', candidate, constraint, limits)
+    cache.put(key, ValidationFailure(reason="AssertionError"))
+
+
+def test_failure_with_same_constraint_is_known():
+    cache = ValidationCache(10)
+    fail(cache, "x = 1", ["assert x == 2"])
+    assert cache.get_known_failure('session', "x = 1", ["assert x == 2"], dict())
+    assert not cache.get_known_failure('other session', "x = 1", ["assert x == 2"], dict())
+    assert not cache.get_known_failure('session', "x = 2", ["assert x == 2"], dict())
+    assert not cache.get_known_failure('session', "x = 1", ["assert x == 2"], dict(timeout=1.0))
+
+
+def test_failure_with_fewer_statements_is_known():
+    cache = ValidationCache(10)
+    fail(cache, "x = 1", ["assert x == 2"])
+    assert cache.get_known_failure('session', "x = 1", ["assert x == 2", "assert x > 0"], dict())
+    fail(cache, "y = 1", [])
+    assert cache.get_known_failure('session', "y = 1", ["assert y == 1"], dict())
+
+
+def test_failure_in_open_block_is_not_extended():
+    cache = ValidationCache(10)
+    # Fails by looping forever, but not once the loop breaks
+    fail(cache, "n = 0", ["while True:", "    n += 1"])
+    assert not cache.get_known_failure('session', "n = 0", ["while True:", "    n += 1", "    if n > 3: break"], dict())
+    assert cache.get_known_failure('session', "n = 0", ["while True:", "    n += 1", "assert n > 3"], dict())
+
+
+def test_failure_before_else_clause_is_not_extended():
+    cache = ValidationCache(10)
+    fail(cache, "x = 0", ["if x:", "    pass", "    assert False"])
+    fail(cache, "y = 0", ["try:", "    1/y"])
+    assert not cache.get_known_failure('session', "x = 0", ["if x:", "    pass", "    assert False", "else:", "    pass"], dict())
+    assert not cache.get_known_failure('session', "y = 0", ["try:", "    1/y", "except ZeroDivisionError:", "    pass"], dict())
+
+
+def test_failure_of_unparsable_code_is_not_extended():
+    cache = ValidationCache(10)
+    fail(cache, "x = (1 +", [])
+    assert not cache.get_known_failure('session', "x = (1 +", ["2)"], dict())
+
+
+def test_failure_keeps_its_reason():
+    cache = ValidationCache(10)
+    fail(cache, "x = 1", ["assert x == 2"])
+    assert cache.get_known_failure('session', "x = 1", ["assert x == 2", "print(x)"], dict()) == ValidationFailure(reason="AssertionError")
+
+
+def test_least_recently_used_outcomes_are_evicted():
+    cache = ValidationCache(2)
+    fail(cache, "a", [])
+    fail(cache, "b", [])
+    assert cache.get_known_failure('session', "a", [], dict())
+    fail(cache, "c", [])
+    assert cache.get_known_failure('session', "a", [], dict())
+    assert not cache.get_known_failure('session', "b", [], dict())
+
+
+def test_statement_boundaries():
+    assert get_statement_boundaries("x = 1", ["a = 1", "b = 2"]) == [0, 1, 2]
+    assert get_statement_boundaries("x = 1", ["for i in x:", "    pass", "", "a = 1"]) == [0, 2, 3, 4]
+    assert get_statement_boundaries("x = 1", ["@decorator", "def f():", "    pass"]) == [0, 3]
+    assert get_statement_boundaries("x = 1", ["    a = 1"]) == [1]
+    assert get_statement_boundaries("if x:", ["    pass"]) == [1]
+
+
+def test_engine_catalogue_in_memory():
+    listed = list()
+
+    def get_engine_ids():
+        listed.append(True)
+        return ['a', 'b']
+
+    catalogue = EngineCatalogue(None, api_base='api', ttl=60, get_engine_ids=get_engine_ids)
+    assert catalogue.is_available('a')
+    assert catalogue.is_available('b')
+    assert not catalogue.is_available('c')
+    # The API is only listed again for an unknown engine
+    assert len(listed) == 2
+
+
+def test_engine_catalogue_on_disk(tmp_path):
+    catalogue = EngineCatalogue(tmp_path, api_base='api', ttl=60, get_engine_ids=lambda: ['a'])
+    assert catalogue.is_available('a')
+    other = EngineCatalogue(tmp_path, api_base='api', ttl=60, get_engine_ids=lambda: [])
+    assert other.is_available('a')
+
+
+def get_completion_key(backend) -> str:
+    return CompletionCache.get_key(
+        endpoint=backend.get_endpoint(),
+        engine_id=backend.engine_id,
+        prompt="# Set x",
+        temperature=0.0,
+        max_tokens=10,
+        stop_sequences=['#'],
+        logprobs=False,
+    )
+
+
+def test_completions_of_different_endpoints_have_different_keys():
+    keys = {
+        get_completion_key(HTTPBackend('https://a.example/v1', 'key', 'engine')),
+        get_completion_key(HTTPBackend('https://b.example/v1', 'key', 'engine')),
+        get_completion_key(FakeBackend(["x = 1"], engine_id='engine')),
+    }
+    assert len(keys) == 3
+    assert get_completion_key(HTTPBackend('https://a.example/v1', 'other key', 'engine')) in keys
+
+
+class Sampler:
+    """Samples completions numbered in sampling order, and records how many
+    each call sampled."""
+    def __init__(self):
+        self.sampled = 0
+        self.calls: list[int] = list()
+
+    def __call__(self, n: int) -> list[Completion]:
+        self.calls.append(n)
+        completions = [Completion(code=[f"x = {self.sampled+i}"]) for i in range(n)]
+        self.sampled += n
+        return completions
+
+
+def get_codes(completions) -> list[str]:
+    return [c.code[0] for c in completions]
+
+
+def test_cached_completions_are_reused(tmp_path):
+    cache = CompletionCache(tmp_path, max_bytes=10**6)
+    sampler = Sampler()
+    assert get_codes(get_cached_completions(cache, 'key', 2, 1.0, sampler)) == ["x = 0", "x = 1"]
+    assert get_codes(get_cached_completions(cache, 'key', 2, 1.0, sampler)) == ["x = 0", "x = 1"]
+    assert sampler.calls == [2]
+    assert (cache.misses, cache.hits) == (1, 1)
+
+
+def test_cached_completions_are_topped_up(tmp_path):
+    cache = CompletionCache(tmp_path, max_bytes=10**6)
+    sampler = Sampler()
+    list(get_cached_completions(cache, 'key', 2, 1.0, sampler))
+    assert get_codes(get_cached_completions(cache, 'key', 3, 1.0, sampler)) == ["x = 0", "x = 1", "x = 2"]
+    assert sampler.calls == [2, 1]
+    assert cache.partial_hits == 1
+    assert len(cache.get('key')) == 3
+
+
+def test_completions_read_in_part_are_cached(tmp_path):
+    cache = CompletionCache(tmp_path, max_bytes=10**6)
+    completions = get_cached_completions(cache, 'key', 3, 1.0, lambda n: iter(Sampler()(n)))
+    next(completions)
+    completions.close()
+    assert get_codes(cache.get('key')) == ["x = 0"]
+
+
+def test_any_cached_completion_is_enough_at_temperature_zero(tmp_path):
+    cache = CompletionCache(tmp_path, max_bytes=10**6)
+    sampler = Sampler()
+    list(get_cached_completions(cache, 'key', 1, 0.0, sampler))
+    assert get_codes(get_cached_completions(cache, 'key', 5, 0.0, sampler)) == ["x = 0"]
+    assert sampler.calls == [1]
+
+
+def test_least_recently_used_completions_are_evicted(tmp_path):
+    completions = [Completion(code=["x = 1"])]
+    entry_size = len(json.dumps([asdict(c) for c in completions]))
+    cache = CompletionCache(tmp_path, max_bytes=2*entry_size)
+    cache.put('a', completions)
+    time.sleep(0.01)
+    cache.put('b', completions)
+    time.sleep(0.01)
+    cache.get('a')
+    time.sleep(0.01)
+    cache.put('c', completions)
+    assert cache.get('a') and cache.get('c')
+    assert cache.get('b') == []
@@ -0,0 +1,91 @@
+from natural_python.checkpoint import Checkpoint
+from natural_python.checkpoint import CheckpointEntry
+from natural_python.checkpoint import CheckpointWriter
+from natural_python.checkpoint import load_checkpoint
+from natural_python.checkpoint import restore_checkpoint
+from natural_python.checkpoint import save_checkpoint
+from natural_python.worker import PythonWorker
+import importlib.util
+import json
+import sys
+import pytest
+
+
+python_shell = sys.executable
+
+dill_available = importlib.util.find_spec('dill') is not None
+
+
+def record(writer: CheckpointWriter, code: list[str], current_code: list[str]):
+    writer.python_worker.run(code)
+    current_code.extend(code)
+    writer.record(CheckpointEntry(instruction=list(), constraint=list(), parameters=list(), code=code), current_code)
+
+
+def test_checkpoint_is_saved_and_loaded(tmp_path):
+    path = tmp_path/'session.json'
+    checkpoint = Checkpoint(
+        code=["x = 1"],
+        entries=[CheckpointEntry(instruction=["Set x"], constraint=[], parameters=["sample_n = 2"], code=["x = 1"], output="")],
+        namespace="state",
+        namespace_code_n=1,
+    )
+    save_checkpoint(path, checkpoint)
+    assert load_checkpoint(path) == checkpoint
+
+
+def test_invalid_checkpoint_is_rejected(tmp_path):
+    path = tmp_path/'session.json'
+    path.write_text(json.dumps(dict(version=0, code=[])))
+    with pytest.raises(ValueError):
+        load_checkpoint(path)
+    path.write_text(json.dumps(dict(version=Checkpoint([]).version, code=[])))
+    with pytest.raises(ValueError):
+        load_checkpoint(path)
+
+
+def test_session_is_resumed_from_its_state(tmp_path):
+    path = tmp_path/'session.json'
+    current_code: list[str] = list()
+    with PythonWorker(python_shell) as python_worker:
+        writer = CheckpointWriter(path, python_worker)
+        record(writer, ["import random", "x = random.random()"], current_code)
+        x = python_worker.run(["print(x)"])
+
+    checkpoint = load_checkpoint(path)
+    assert checkpoint.namespace is not None
+    with PythonWorker(python_shell) as python_worker:
+        assert restore_checkpoint(checkpoint, python_worker)
+        # Replaying the code would draw another number
+        python_worker.sync(checkpoint.code)
+        assert python_worker.run(["print(x)"]) == x
+
+
+@pytest.mark.skipif(dill_available, reason="dill serializes functions")
+def test_session_with_functions_is_replayed_without_dill(tmp_path):
+    path = tmp_path/'session.json'
+    current_code: list[str] = list()
+    with PythonWorker(python_shell) as python_worker:
+        writer = CheckpointWriter(path, python_worker)
+        record(writer, ["def f():", "    return 2"], current_code)
+
+    checkpoint = load_checkpoint(path)
+    assert checkpoint.namespace is None
+    with PythonWorker(python_shell) as python_worker:
+        assert not restore_checkpoint(checkpoint, python_worker)
+        python_worker.sync(checkpoint.code)
+        assert python_worker.run(["print(f())"]) == "2\n"
+
+
+@pytest.mark.skipif(not dill_available, reason="dill is not installed")
+def test_session_with_functions_is_restored_with_dill(tmp_path):
+    path = tmp_path/'session.json'
+    current_code: list[str] = list()
+    with PythonWorker(python_shell) as python_worker:
+        writer = CheckpointWriter(path, python_worker)
+        record(writer, ["def f():", "    return 2"], current_code)
+
+    checkpoint = load_checkpoint(path)
+    with PythonWorker(python_shell) as python_worker:
+        assert restore_checkpoint(checkpoint, python_worker)
+        assert python_worker.run(["print(f())"]) == "2\n"
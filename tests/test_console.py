@@ -0,0 +1,176 @@
+from typing import Optional
+from dataclasses import replace
+from natural_python import console
+from natural_python.backends import FakeBackend
+from natural_python.backends import LanguageModelAPIError
+from natural_python.cache import EngineCatalogue
+from natural_python.context import PromptContext
+from natural_python.worker import PythonWorker
+import subprocess
+import json
+import sys
+import pytest
+
+
+class FlakyBackend(FakeBackend):
+    """Fake backend whose first request fails with `error`."""
+    def __init__(self, script: list[str], error: Exception):
+        super().__init__(script)
+        self.error = error
+        self.failed = False
+
+    def complete(self, *args, **kwargs):
+        if not self.failed:
+            self.failed = True
+            raise self.error
+        return super().complete(*args, **kwargs)
+
+
+script = """\
+# Set x to 1
+# finally:
+assert x == 1
+
+# Print x
+
+# python
+y = x + 1
+
+# Set z
+# with:
+sample_n = 2
+# finally:
+assert z == 3
+"""
+
+
+def get_parameters(completions: list[str], python_worker: PythonWorker, backend: Optional[FakeBackend] = None) -> console.SessionParameters:
+    if backend is None:
+        backend = FakeBackend(completions)
+    return console.SessionParameters(
+        backend=backend,
+        max_sample_tokens=10,
+        sample_n=[1],
+        sample_temperature=[0.0],
+        python_worker=python_worker,
+        engine_catalogue=EngineCatalogue(None, 'fake', ttl=60, get_engine_ids=backend.get_engine_ids),
+        stream=False,
+        sample_concurrency=1,
+        completion_cache=None,
+        ranking='none',
+        validation_cache=None,
+        prompt_context=PromptContext(),
+        speculate=False,
+    )
+
+
+def test_parse_natural_script():
+    blocks = console.parse_natural_script(script.splitlines(keepends=True))
+    assert [b.line_n for b in blocks] == [1, 5, 7, 10]
+    assert blocks[0].instruction == ["Set x to 1"]
+    assert blocks[0].constraint == ["assert x == 1"]
+    assert blocks[1].instruction == ["Print x"] and blocks[1].constraint == []
+    assert blocks[2].instruction == [] and blocks[2].python_code == ["y = x + 1"]
+    assert blocks[3].parameters == ["sample_n = 2"]
+    assert blocks[3].constraint == ["assert z == 3"]
+
+
+def test_parse_natural_script_keeps_indentation_and_stops_at_exit():
+    blocks = console.parse_natural_script([
+        "# Define f",
+        "# finally:",
+        "def g():",
+        "    return f()",
+        "# exit",
+        "# Ignored",
+    ])
+    assert len(blocks) == 1
+    assert blocks[0].constraint == ["def g():", "    return f()"]
+
+
+def test_parse_natural_script_rejects_code_as_instruction():
+    with pytest.raises(console.ParseException, match="Line 2"):
+        console.parse_natural_script(["# Set x", "x = 1"])
+
+
+def test_run_script_reports_each_instruction():
+    blocks = console.parse_natural_script(script.splitlines())
+    with PythonWorker(sys.executable) as python_worker:
+        parameters = get_parameters(["x = 1\n", "print(x)\n", "z = 2\n"], python_worker)
+        code, report = console.run_script(blocks, parameters, profiler=None)
+    assert [(result['line'], result['ok']) for result in report] == [(1, True), (5, True), (10, False)]
+    assert report[1]['output'] == "1\n"
+    assert parameters.sample_n == [2]
+    assert "y = x + 1" in code
+    assert "z = 2" not in code
+
+
+def test_run_command_writes_output_and_report(tmp_path):
+    (tmp_path/'script.txt').write_text(script)
+    (tmp_path/'fake.json').write_text(json.dumps(["x = 1\n", "print(x)\n", "z = 3\n"]))
+    process = subprocess.run(
+        [
+            sys.executable, '-m', 'natural_python', 'run', str(tmp_path/'script.txt'),
+            '--fake-script', str(tmp_path/'fake.json'),
+            '--python-shell', sys.executable,
+            '--output', str(tmp_path/'session.py'),
+            '--report', str(tmp_path/'report.json'),
+        ],
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert process.returncode == 0, process.stderr
+    assert "OK line 10" in process.stdout
+    report = json.loads((tmp_path/'report.json').read_text())
+    assert all(result['ok'] for result in report)
+    session = (tmp_path/'session.py').read_text().splitlines()
+    assert session[-2:] == ["z = 3", "assert z == 3"]
+
+
+@pytest.mark.parametrize('error', [LanguageModelAPIError(503, "Overloaded"), ConnectionResetError("Connection reset")])
+def test_run_script_goes_on_after_api_errors(error):
+    blocks = console.parse_natural_script(script.splitlines())
+    with PythonWorker(sys.executable) as python_worker:
+        backend = FlakyBackend(["x = 1\n"], error)
+        parameters = get_parameters([], python_worker, backend)
+        _, report = console.run_script(blocks[:2], parameters, profiler=None)
+    assert [result['ok'] for result in report] == [False, True]
+    assert str(error) in report[0]['error']
+
+
+def test_run_script_stops_at_unexpected_errors():
+    blocks = console.parse_natural_script(script.splitlines())
+    with PythonWorker(sys.executable) as python_worker:
+        backend = FlakyBackend(["x = 1\n"], RuntimeError("Bug"))
+        parameters = get_parameters([], python_worker, backend)
+        _, report = console.run_script(blocks, parameters, profiler=None)
+    assert len(report) == 1
+    assert report[0]['error'] == "RuntimeError: Bug"
+
+
+def test_counts_have_to_be_positive():
+    assert console.parse_count("2") == 2
+    for text in ["0", "-1", "a"]:
+        with pytest.raises(ValueError):
+            console.parse_count(text)
+
+
+def test_instruction_with_parameters_is_speculated(monkeypatch):
+    lines = iter(["Set x", "with:", "sample_n = 2", "finally:", "assert x == 1", "", "exit"])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(lines))
+    monkeypatch.setattr(console, 'get_start_message', lambda engine_id: [])
+    speculated: list[list[int]] = list()
+    speculate_instruction = console.speculate_instruction
+
+    def record_speculation(instruction, current_python_code, parameters):
+        speculated.append(list(parameters.sample_n))
+        return speculate_instruction(instruction, current_python_code, parameters)
+
+    monkeypatch.setattr(console, 'speculate_instruction', record_speculation)
+    with PythonWorker(sys.executable) as python_worker:
+        parameters = replace(get_parameters(["x = 1\n"], python_worker), speculate=True)
+        code = console.repl(parameters, profiler=None)
+    # Sampling starts with the parameters of the instruction
+    assert speculated == [[2]]
+    assert "x = 1" in code
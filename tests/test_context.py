@@ -0,0 +1,53 @@
+from natural_python.context import PromptContext
+from natural_python.context import elision_marker
+from natural_python.context import split_blocks
+
+
+session = [
+    "import math",
+    "# Define the area of a circle",
+    "def area(radius):",
+    "    return math.pi * radius ** 2",
+    *[f"filler_{i} = {i} * 1000" for i in range(50)],
+    "radius = 3",
+]
+
+
+def test_split_blocks_keeps_comments_with_their_statement():
+    blocks = split_blocks(session[:4])
+    assert [b.text for b in blocks] == [
+        "import math",
+        "# Define the area of a circle\ndef area(radius):\n    return math.pi * radius ** 2",
+    ]
+    assert blocks[0].is_import
+    assert blocks[1].defined == {'area'}
+    assert blocks[1].summary == "# Define the area of a circle\ndef area(radius):\n    ..."
+
+
+def test_split_blocks_keeps_unparsable_code():
+    blocks = split_blocks(["x = 1", "def f(:"])
+    assert [b.text for b in blocks] == ["x = 1\ndef f(:"]
+
+
+def test_session_that_fits_is_kept():
+    context = PromptContext(max_tokens=None)
+    assert context.render(session, reserved_tokens=0, referenced=set()) == "\n".join(session)
+
+
+def test_long_session_keeps_imports_definitions_and_recent_code():
+    context = PromptContext(max_tokens=60)
+    rendered = context.render(session, reserved_tokens=0, referenced={'area'})
+    lines = rendered.splitlines()
+    assert lines[0] == "import math"
+    assert "def area(radius):" in lines
+    assert elision_marker in lines
+    assert lines[-1] == "radius = 3"
+    assert "filler_0 = 0 * 1000" not in lines
+
+
+def test_rendered_code_follows_the_session():
+    context = PromptContext(max_tokens=None)
+    context.render(session[:10], reserved_tokens=0, referenced=set())
+    assert context.render(session, reserved_tokens=0, referenced=set()) == "\n".join(session)
+    # A session that is not a continuation of the previous one is split again
+    assert context.render(["y = 2"], reserved_tokens=0, referenced=set()) == "y = 2"
@@ -0,0 +1,188 @@
+from natural_python.backends import FakeBackend
+from natural_python.cache import ValidationCache
+from natural_python.interpreter import NaturalInterpreterError
+from natural_python.interpreter import NaturalJob
+from natural_python.interpreter import NaturalProgram
+from natural_python.interpreter import execute_natural_program
+from natural_python.interpreter import execute_natural_programs
+from natural_python.interpreter import speculate_natural_program
+from natural_python.search import SearchStatistics
+from natural_python.worker import ExecutionLimits
+from natural_python.worker import PythonWorker
+import sys
+import pytest
+
+
+class FailingBatchBackend(FakeBackend):
+    """Fake backend whose requests with many prompts fail."""
+    def complete_many(self, *args, **kwargs):
+        raise RuntimeError("The batched request failed")
+
+
+class RecordingFakeBackend(FakeBackend):
+    """Fake backend that records the number of completions and the
+    temperature of each request."""
+    def __init__(self, script: list[str]):
+        super().__init__(script)
+        self.requests: list[tuple[int, float]] = list()
+
+    def complete(self, prompt, n, max_tokens, temperature, *args, **kwargs):
+        self.requests.append((n, temperature))
+        return super().complete(prompt, n, max_tokens, temperature, *args, **kwargs)
+
+
+@pytest.fixture
+def python_worker():
+    with PythonWorker(sys.executable) as python_worker:
+        yield python_worker
+
+
+def test_first_candidate_that_succeeds_wins(python_worker):
+    backend = FakeBackend(["x = 1\n", "x = 2\n", "x = 3\n"])
+    statistics = SearchStatistics()
+    new_code, output = execute_natural_program(
+        program=NaturalProgram(instruction=["# Set x"], constraint=["assert x > 1"]),
+        current_python_code=[],
+        sample_n=3,
+        python_worker=python_worker,
+        backend=backend,
+        max_sample_tokens=10,
+        sample_temperature=0.0,
+        statistics=statistics,
+    )
+    assert new_code == ["x = 2", "assert x > 1"]
+    assert statistics.successes == 1
+
+
+def test_known_failures_are_skipped(python_worker):
+    backend = FakeBackend(["x = 1\n"])
+    validation_cache = ValidationCache(10)
+
+    def execute(constraint: list[str]):
+        with pytest.raises(NaturalInterpreterError):
+            execute_natural_program(
+                program=NaturalProgram(instruction=["# Set x"], constraint=constraint),
+                current_python_code=[],
+                sample_n=1,
+                python_worker=python_worker,
+                backend=backend,
+                max_sample_tokens=10,
+                sample_temperature=0.0,
+                validation_cache=validation_cache,
+            )
+
+    execute(["assert x == 2"])
+    assert validation_cache.skipped == 0
+    execute(["assert x == 2", "assert x > 0"])
+    assert validation_cache.skipped == 1
+
+
+def test_timeouts_are_not_known_failures(python_worker):
+    python_worker.limits = ExecutionLimits(timeout=0.5)
+    validation_cache = ValidationCache(10)
+    with pytest.raises(NaturalInterpreterError):
+        execute_natural_program(
+            program=NaturalProgram(instruction=["# Loop"], constraint=[]),
+            current_python_code=[],
+            sample_n=1,
+            python_worker=python_worker,
+            backend=FakeBackend(["while True: pass\n"]),
+            max_sample_tokens=10,
+            sample_temperature=0.0,
+            validation_cache=validation_cache,
+        )
+    assert len(validation_cache.failures) == 0
+
+
+def test_failed_batched_request_fails_only_its_jobs():
+    backend = FailingBatchBackend(["x = 1\n"])
+    with PythonWorker(sys.executable) as first, PythonWorker(sys.executable) as second:
+        jobs = [
+            NaturalJob(
+                program=NaturalProgram(instruction=["# Set x"], constraint=[]),
+                current_python_code=[],
+                python_worker=python_worker,
+            )
+            for python_worker in [first, second]
+        ]
+        results = execute_natural_programs(
+            jobs=jobs,
+            sample_n=1,
+            backend=backend,
+            max_sample_tokens=10,
+            sample_temperature=0.0,
+        )
+    assert len(results) == 2
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_batches_are_sampled_until_a_candidate_succeeds(python_worker):
+    backend = RecordingFakeBackend(["x = 1\n", "x = 2\n", "x = 3\n", "x = 4\n"])
+    statistics = SearchStatistics()
+    new_code, _ = execute_natural_program(
+        program=NaturalProgram(instruction=["# Set x"], constraint=["assert x == 3"]),
+        current_python_code=[],
+        sample_n=[1, 2, 4],
+        python_worker=python_worker,
+        backend=backend,
+        max_sample_tokens=10,
+        sample_temperature=[0.2, 0.5],
+        statistics=statistics,
+    )
+    assert new_code == ["x = 3", "assert x == 3"]
+    # The last batch is not needed
+    assert backend.requests == [(1, 0.2), (2, 0.5)]
+    assert statistics.batches == 2
+
+
+def test_every_batch_is_sampled_before_failing(python_worker):
+    backend = RecordingFakeBackend(["x = 1\n"])
+    with pytest.raises(NaturalInterpreterError):
+        execute_natural_program(
+            program=NaturalProgram(instruction=["# Set x"], constraint=["assert x == 2"]),
+            current_python_code=[],
+            sample_n=[1, 2, 3],
+            python_worker=python_worker,
+            backend=backend,
+            max_sample_tokens=10,
+            sample_temperature=[0.2, 0.5],
+        )
+    assert backend.requests == [(1, 0.2), (2, 0.5), (3, 0.5)]
+
+
+def execute_speculated(python_worker: PythonWorker, backend: FakeBackend, sample_temperature: float) -> list[str]:
+    speculation = speculate_natural_program(
+        instruction=["# Set x"],
+        current_python_code=["y = 1"],
+        sample_n=1,
+        backend=backend,
+        max_sample_tokens=10,
+        sample_temperature=0.0,
+    )
+    new_code, _ = execute_natural_program(
+        program=NaturalProgram(instruction=["# Set x"], constraint=["assert x == 1"]),
+        current_python_code=["y = 1"],
+        sample_n=1,
+        python_worker=python_worker,
+        backend=backend,
+        max_sample_tokens=10,
+        sample_temperature=sample_temperature,
+        speculation=speculation,
+    )
+    with speculation.condition:
+        speculation.condition.wait_for(lambda: speculation.done, timeout=5)
+    assert speculation.cancelled.is_set()
+    return new_code
+
+
+def test_speculated_batch_is_used(python_worker):
+    backend = RecordingFakeBackend(["x = 1\n"])
+    assert execute_speculated(python_worker, backend, sample_temperature=0.0) == ["x = 1", "assert x == 1"]
+    # The instruction did not sample a batch of its own
+    assert backend.requests == [(1, 0.0)]
+
+
+def test_speculated_batch_with_other_parameters_is_cancelled(python_worker):
+    backend = RecordingFakeBackend(["x = 1\n"])
+    assert execute_speculated(python_worker, backend, sample_temperature=0.5) == ["x = 1", "assert x == 1"]
+    assert backend.requests == [(1, 0.0), (1, 0.5)]
@@ -0,0 +1,156 @@
+from typing import Any
+from typing import Callable
+from typing import Optional
+from natural_python.language_model_api import Backend
+from natural_python.language_model_api import Completion
+from natural_python.language_model_api import get_batched_completions
+from natural_python.language_model_api import get_completions
+from natural_python.language_model_api import max_samples_per_request
+from natural_python.language_model_api import pack_prompts
+from natural_python.language_model_api import stream_candidates
+import threading
+import pytest
+
+
+class RecordingBackend(Backend):
+    """Completes each prompt with `PROMPT:I` for its I-th completion, and
+    records the prompts and number of completions of each request."""
+    def __init__(self, fail: bool = False, barrier: Optional[threading.Barrier] = None):
+        super().__init__('recording')
+        self.fail = fail
+        self.barrier = barrier
+        """Barrier each request waits at, if any."""
+        self.requests: list[tuple[list[str], int]] = list()
+        self.lock = threading.Lock()
+
+    def complete(self, prompt, n, max_tokens, temperature, stop, stream=False, logprobs=False, on_usage=None, cancelled=None):
+        return self.complete_many([prompt], n, max_tokens, temperature, stop, logprobs, on_usage)[0]
+
+    def complete_many(
+            self,
+            prompts: list[str],
+            n: int,
+            max_tokens: int,
+            temperature: float,
+            stop: list[str],
+            logprobs: bool = False,
+            on_usage: Optional[Callable[[Any], None]] = None,
+            ) -> list[list[Completion]]:
+        with self.lock:
+            self.requests.append((prompts, n))
+        if self.barrier is not None:
+            self.barrier.wait(timeout=5)
+        if self.fail:
+            raise RuntimeError("The request failed")
+        return [
+            [Completion(code=[f"{prompt}:{i}"]) for i in range(n)]
+            for prompt in prompts
+        ]
+
+    def get_engines(self):
+        return dict(data=[dict(id=self.engine_id)])
+
+    def get_engine_ids(self):
+        return [self.engine_id]
+
+    def copy(self):
+        return RecordingBackend(self.fail, self.barrier)
+
+
+def test_completions_are_sharded_into_concurrent_requests():
+    # Both shards have to be requested at the same time to pass the barrier
+    backend = RecordingBackend(barrier=threading.Barrier(2))
+    n = max_samples_per_request+10
+    completions = list(get_completions(backend, 'a', sample_n=n, max_tokens=10, temperature=0.0, concurrency=2))
+    assert len(completions) == n
+    assert sorted(shard_n for _, shard_n in backend.requests) == [10, max_samples_per_request]
+
+
+def test_failed_shard_fails_completions():
+    backend = RecordingBackend(fail=True)
+    with pytest.raises(RuntimeError):
+        list(get_completions(backend, 'a', sample_n=max_samples_per_request+1, max_tokens=10, temperature=0.0))
+
+
+def test_pack_prompts_shares_requests():
+    requests = pack_prompts([('a', 4), ('b', 4), ('c', 2)])
+    assert requests == [
+        (4, [(0, 'a'), (1, 'b')]),
+        (2, [(2, 'c')]),
+    ]
+
+
+def test_pack_prompts_fills_requests():
+    prompts_per_request = max_samples_per_request//4
+    requests = pack_prompts([(str(i), 4) for i in range(prompts_per_request+1)])
+    assert [len(prompts) for _, prompts in requests] == [prompts_per_request, 1]
+    assert all(n*len(prompts) <= max_samples_per_request for n, prompts in requests)
+
+
+def test_pack_prompts_splits_large_jobs():
+    n = max_samples_per_request+10
+    requests = pack_prompts([('a', n)])
+    assert sorted(requests) == sorted([
+        (max_samples_per_request, [(0, 'a')]),
+        (10, [(0, 'a')]),
+    ])
+
+
+def test_batched_completions_are_routed_to_their_job():
+    backend = RecordingBackend()
+    jobs = [('a', 2), ('b', 2), ('c', 3), ('d', 0)]
+    futures = get_batched_completions(backend, jobs, max_tokens=10, temperature=0.0)
+    results = [future.result(timeout=5) for future in futures]
+    assert [[c.code[0] for c in r] for r in results] == [
+        ['a:0', 'a:1'],
+        ['b:0', 'b:1'],
+        ['c:0', 'c:1', 'c:2'],
+        [],
+    ]
+    assert sorted(backend.requests) == [(['a', 'b'], 2), (['c'], 3)]
+
+
+def test_batched_completions_of_large_jobs_are_merged():
+    backend = RecordingBackend()
+    n = max_samples_per_request+1
+    futures = get_batched_completions(backend, [('a', n)], max_tokens=10, temperature=0.0)
+    assert len(futures[0].result(timeout=5)) == n
+    assert len(backend.requests) == 2
+
+
+def test_failed_request_fails_its_jobs():
+    backend = RecordingBackend(fail=True)
+    futures = get_batched_completions(backend, [('a', 2), ('b', 2)], max_tokens=10, temperature=0.0)
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=5)
+
+
+def get_chunk(index: int, text: str, finish_reason: Optional[str] = None) -> dict:
+    return dict(choices=[dict(index=index, text=text, finish_reason=finish_reason, logprobs=None)])
+
+
+def test_stream_candidates_yields_finished_choices_first():
+    chunks = [
+        get_chunk(0, "x = "),
+        get_chunk(1, "y = 2\n#"),
+        get_chunk(0, "1\n", 'stop'),
+    ]
+    completions = list(stream_candidates(chunks, ['#']))
+    assert [c.code for c in completions] == [['y = 2'], ['x = 1']]
+
+
+def test_stream_candidates_closes_abandoned_streams():
+    closed = list()
+
+    def get_chunks():
+        try:
+            yield get_chunk(0, "x = 1\n", 'stop')
+            yield get_chunk(1, "y = 2\n", 'stop')
+        finally:
+            closed.append(True)
+
+    completions = stream_candidates(get_chunks(), ['#'])
+    assert next(completions).code == ['x = 1']
+    completions.close()
+    assert closed == [True]
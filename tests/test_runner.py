@@ -0,0 +1,58 @@
+from natural_python.runner import BoundedOutput
+from natural_python.runner import truncate
+
+
+def test_short_output_is_kept():
+    output = BoundedOutput(10)
+    output.write("hello")
+    assert output.getvalue() == "hello"
+    assert output.size == 5
+
+
+def test_unlimited_output_is_kept():
+    output = BoundedOutput()
+    output.write("a" * 10000)
+    assert output.getvalue() == "a" * 10000
+
+
+def test_long_output_keeps_head_and_tail():
+    output = BoundedOutput(10)
+    for i in range(10):
+        output.write(str(i) * 3)
+    # The head keeps 5 bytes, the tail 5
+    assert output.getvalue() == "00011\n[... 20 bytes left out ...]\n88999"
+    assert output.size == 30
+
+
+def test_tail_spans_many_writes():
+    output = BoundedOutput(6)
+    output.write("abc")
+    for c in "defghij":
+        output.write(c)
+    assert output.getvalue() == "abc\n[... 4 bytes left out ...]\nhij"
+
+
+def test_skipped_bytes_are_dropped():
+    output = BoundedOutput(None, skip=4)
+    output.write("ab")
+    output.write("cdef")
+    assert output.getvalue() == "ef"
+    assert output.size == 6
+
+
+def test_skipped_bytes_are_not_left_out():
+    output = BoundedOutput(4, skip=3)
+    output.write("xyz" + "0123456789")
+    assert output.getvalue() == "01\n[... 6 bytes left out ...]\n89"
+
+
+def test_zero_limit_keeps_nothing():
+    output = BoundedOutput(0)
+    output.write("abc")
+    assert output.getvalue() == "\n[... 3 bytes left out ...]\n"
+    assert output.size == 3
+
+
+def test_truncate():
+    assert truncate("abcdef", 10) == "abcdef"
+    assert truncate("abcdefghij", 4) == "ab\n[... 6 bytes left out ...]\nij"
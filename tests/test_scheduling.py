@@ -0,0 +1,54 @@
+from natural_python.scheduling import FairScheduler
+import threading
+import time
+import pytest
+
+
+def wait_for_waiting(scheduler: FairScheduler, waiting: int):
+    deadline = time.monotonic()+5
+    while scheduler.get_metrics()['waiting'] < waiting:
+        assert time.monotonic() < deadline, "Requests did not start waiting"
+        time.sleep(0.001)
+
+
+def test_invalid_slots():
+    with pytest.raises(ValueError):
+        FairScheduler(0)
+
+
+def test_slots_are_granted_in_turns():
+    scheduler = FairScheduler(1)
+    granted: list[str] = list()
+
+    def use(session_id: str, name: str):
+        scheduler.acquire(session_id)
+        granted.append(name)
+        scheduler.release(session_id)
+
+    # Session a holds the only slot, and asks for three more before session b
+    # asks for one
+    scheduler.acquire('a')
+    threads = list()
+    for i, (session_id, name) in enumerate([('a', 'a1'), ('a', 'a2'), ('a', 'a3'), ('b', 'b1')]):
+        thread = threading.Thread(target=use, args=(session_id, name))
+        thread.start()
+        wait_for_waiting(scheduler, i+1)
+        threads.append(thread)
+    assert scheduler.get_metrics('a') == dict(waiting=3, running=1)
+    assert scheduler.get_metrics('b') == dict(waiting=1, running=0)
+
+    scheduler.release('a')
+    for thread in threads:
+        thread.join(timeout=5)
+    assert granted == ['a1', 'b1', 'a2', 'a3']
+    assert scheduler.get_metrics() == dict(slots=1, waiting=0, running=0)
+
+
+def test_free_slots_are_granted_at_once():
+    scheduler = FairScheduler(2)
+    scheduler.acquire('a')
+    scheduler.acquire('a')
+    assert scheduler.get_metrics('a') == dict(waiting=0, running=2)
+    scheduler.release('a')
+    scheduler.release('a')
+    assert scheduler.get_metrics() == dict(slots=2, waiting=0, running=0)
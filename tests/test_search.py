@@ -0,0 +1,81 @@
+from natural_python.language_model_api import Completion
+from natural_python.search import SearchStatistics
+from natural_python.search import normalize_code
+from natural_python.search import parse_sample_schedule
+from natural_python.search import parse_temperature_schedule
+from natural_python.search import prefilter_completions
+from natural_python.search import rank_completions
+import pytest
+
+
+def test_normalized_code_ignores_formatting():
+    assert normalize_code(["x = 'a'  # Set x"]) == normalize_code(['x = "a"'])
+    assert normalize_code(["x = 'a'"]) != normalize_code(["x = 'b'"])
+    assert normalize_code(["x = (1 +"]) is None
+
+
+def test_duplicate_and_non_compiling_completions_are_dropped():
+    completions = [
+        Completion(code=["x = 1"]),
+        Completion(code=["x = ( 1 )  # One"]),
+        Completion(code=["x = (1 +"]),
+        Completion(code=["  x = 2"]),
+        Completion(code=["x = 2"]),
+    ]
+    statistics = SearchStatistics()
+    kept = list(prefilter_completions(completions, ["assert x > 0"], statistics))
+    assert [c.code for c in kept] == [["x = 1"], ["x = 2"]]
+    assert (statistics.sampled, statistics.duplicates, statistics.syntax_errors) == (5, 1, 2)
+
+
+def test_completions_seen_before_are_dropped():
+    seen_code: set[str] = set()
+    statistics = SearchStatistics()
+    list(prefilter_completions([Completion(code=["x = 1"])], [], statistics, seen_code))
+    kept = list(prefilter_completions([Completion(code=["x = 1"]), Completion(code=["x = 2"])], [], statistics, seen_code))
+    assert [c.code for c in kept] == [["x = 2"]]
+
+
+def test_completions_that_break_the_constraint_are_dropped():
+    # The completion opens a block that the constraint does not continue
+    statistics = SearchStatistics()
+    kept = list(prefilter_completions([Completion(code=["if x:"])], ["assert x"], statistics))
+    assert kept == []
+    assert statistics.syntax_errors == 1
+
+
+def test_likelihood_ranking_validates_likely_completions_first():
+    completions = [
+        Completion(code=["x = 1"], mean_logprob=-2.0),
+        Completion(code=["x = 2"]),
+        Completion(code=["x = 3"], mean_logprob=-0.5),
+    ]
+    ranked = rank_completions(completions, 'likelihood')
+    assert [c.code for c in ranked] == [["x = 3"], ["x = 1"], ["x = 2"]]
+
+
+def test_consensus_ranking_validates_common_code_first():
+    completions = [
+        Completion(code=["x = 1"]),
+        Completion(code=["x = 2"]),
+        Completion(code=["x = (2)  # Two"]),
+        Completion(code=["x = 3"]),
+    ]
+    ranked = rank_completions(completions, 'consensus')
+    assert [c.code for c in ranked] == [["x = 2"], ["x = (2)  # Two"], ["x = 1"], ["x = 3"]]
+
+
+def test_no_ranking_keeps_the_order():
+    completions = [Completion(code=["x = 1"]), Completion(code=["x = 2"])]
+    assert list(rank_completions(iter(completions), 'none')) == completions
+    with pytest.raises(ValueError):
+        rank_completions(completions, 'unknown')
+
+
+def test_schedules_are_parsed():
+    assert parse_sample_schedule("2,8,32") == [2, 8, 32]
+    assert parse_sample_schedule("4") == [4]
+    assert parse_temperature_schedule("0.2,0.5") == [0.2, 0.5]
+    for text in ["2,0", "2,-1", "2,,8", "a"]:
+        with pytest.raises(ValueError):
+            parse_sample_schedule(text)
@@ -0,0 +1,89 @@
+from typing import Optional
+from natural_python import console
+from natural_python.backends import FakeBackend
+from natural_python.backends import LanguageModelAPIError
+from natural_python.cache import EngineCatalogue
+from natural_python.context import PromptContext
+from natural_python.scheduling import FairScheduler
+from natural_python.scheduling import ScheduledBackend
+from natural_python.scheduling import ScheduledWorker
+from natural_python.server import SessionServer
+from natural_python.worker import PythonWorker
+import http.client
+import threading
+import json
+import sys
+import pytest
+
+
+class OverloadedBackend(FakeBackend):
+    def complete(self, *args, **kwargs):
+        raise LanguageModelAPIError(503, "Overloaded")
+
+
+@pytest.fixture
+def server():
+    execution = FairScheduler(2)
+    sampling = FairScheduler(2)
+
+    def create_parameters(session_id: str) -> console.SessionParameters:
+        backend = OverloadedBackend(["x = 1\n"]) if session_id == '2' else FakeBackend(["x = 1\n"])
+        return console.SessionParameters(
+            backend=ScheduledBackend(backend, sampling, session_id),
+            max_sample_tokens=10,
+            sample_n=[1],
+            sample_temperature=[0.0],
+            python_worker=ScheduledWorker(PythonWorker(sys.executable), execution, session_id),
+            engine_catalogue=EngineCatalogue(None, 'fake', ttl=60, get_engine_ids=backend.get_engine_ids),
+            stream=False,
+            sample_concurrency=1,
+            completion_cache=None,
+            ranking='none',
+            validation_cache=None,
+            prompt_context=PromptContext(),
+            speculate=False,
+        )
+
+    server = SessionServer(('127.0.0.1', 0), create_parameters, execution, sampling)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request(server: SessionServer, method: str, path: str, body: Optional[dict] = None) -> tuple[int, dict]:
+    connection = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=30)
+    try:
+        connection.request(method, path, json.dumps(body) if body is not None else None)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_instruction_is_executed(server):
+    assert request(server, 'POST', '/sessions') == (201, dict(id='1'))
+    status, result = request(server, 'POST', '/sessions/1/instructions', dict(instruction=["# Set x"], constraint=["assert x == 1"]))
+    assert status == 200 and result['ok']
+    status, session = request(server, 'GET', '/sessions/1')
+    assert "x = 1" in session['code']
+    assert session['metrics']['executed'] == 1
+
+
+def test_api_errors_are_reported(server):
+    request(server, 'POST', '/sessions')
+    request(server, 'POST', '/sessions')
+    status, result = request(server, 'POST', '/sessions/2/instructions', dict(instruction=["# Set x"]))
+    assert status == 502
+    assert "Overloaded" in result['error']
+    _, session = request(server, 'GET', '/sessions/2')
+    assert session['metrics']['executed'] == 1
+    assert session['metrics']['failed'] == 1
+
+
+def test_closed_session_is_not_used(server):
+    request(server, 'POST', '/sessions')
+    session = server.get_session('1')
+    assert request(server, 'DELETE', '/sessions/1') == (200, dict(ok=True))
+    assert session.closed
+    assert request(server, 'POST', '/sessions/1/code', dict(code=["x = 1"]))[0] == 404
@@ -0,0 +1,146 @@
+from natural_python import worker
+from natural_python.worker import ExecutionLimits
+from natural_python.worker import PythonInterpreterError
+from natural_python.worker import PythonWorker
+from natural_python.worker import ReplayWorker
+from natural_python.worker import Worker
+from natural_python.worker import fork_available
+import sys
+import pytest
+
+
+python_shell = sys.executable
+
+worker_kinds = [
+    pytest.param(dict(fork=True), id='fork', marks=pytest.mark.skipif(not fork_available, reason="fork is not available")),
+    pytest.param(dict(fork=False), id='namespace'),
+]
+
+
+@pytest.fixture(params=worker_kinds)
+def python_worker(request):
+    with PythonWorker(python_shell, **request.param) as python_worker:
+        yield python_worker
+
+
+def test_worker_is_abstract():
+    with pytest.raises(TypeError):
+        Worker(python_shell)  # type: ignore
+
+
+def test_worker_needs_parallel_executions():
+    with pytest.raises(ValueError):
+        ReplayWorker(python_shell, parallel=0)
+
+
+def test_run_commits_code(python_worker):
+    python_worker.sync(["x = 1"])
+    assert python_worker.run(["x += 1", "print(x)"]) == "2\n"
+    assert python_worker.committed_code == ["x = 1", "x += 1", "print(x)"]
+
+
+def test_failed_candidate_is_rolled_back(python_worker):
+    python_worker.sync(["x = 1"])
+    with pytest.raises(PythonInterpreterError, match="AssertionError"):
+        python_worker.run(["x = 2", "y = 3", "assert x == 3"])
+    assert python_worker.committed_code == ["x = 1"]
+    assert python_worker.run(["print(x, 'y' in globals())"]) == "1 False\n"
+
+
+def test_discarded_candidate_is_rolled_back(python_worker):
+    python_worker.sync(["x = 1"])
+    execution = python_worker.submit(["x = 2"])
+    assert execution.future.result() == ""
+    python_worker.discard(execution)
+    assert python_worker.run(["print(x)"]) == "1\n"
+
+
+def test_interpreter_restarts_after_crash(python_worker):
+    python_worker.sync(["x = 1"])
+    with pytest.raises(PythonInterpreterError):
+        python_worker.run(["import os", "os._exit(3)"])
+    # The committed code is replayed in the new interpreter
+    assert python_worker.run(["print(x)"]) == "1\n"
+
+
+def test_timeout_fails_candidate(python_worker):
+    python_worker.limits = ExecutionLimits(timeout=0.5)
+    python_worker.sync(["x = 1"])
+    with pytest.raises(PythonInterpreterError) as error:
+        python_worker.run(["while True: pass"])
+    # The candidate may finish on a less loaded machine
+    assert not error.value.deterministic
+    assert python_worker.run(["print(x)"]) == "1\n"
+
+
+@pytest.mark.parametrize('code, deterministic', [
+    (["assert False"], True),
+    (["import sys", "sys.exit(2)"], True),
+    (["import os", "os._exit(3)"], False),
+], ids=['raise', 'exit', 'crash'])
+def test_failures_tell_whether_they_are_deterministic(python_worker, code, deterministic):
+    with pytest.raises(PythonInterpreterError) as error:
+        python_worker.run(code)
+    assert error.value.deterministic == deterministic
+
+
+@pytest.mark.parametrize('source_files', [False, True], ids=['stdin', 'file'])
+def test_replay_worker_skips_committed_output(source_files):
+    with ReplayWorker(python_shell, source_files=source_files) as python_worker:
+        python_worker.sync(["print('session')", "x = 1"])
+        assert python_worker.run(["print(x)"]) == "1\n"
+        with pytest.raises(PythonInterpreterError, match="NameError"):
+            python_worker.run(["print(y)"])
+        assert python_worker.committed_code == ["print('session')", "x = 1", "print(x)"]
+
+
+@pytest.mark.skipif(not worker.prlimit_available, reason="prlimit is not available")
+def test_source_files_are_limited_before_they_run(monkeypatch):
+    # As if the interpreter ran the file before it could be limited from
+    # outside
+    monkeypatch.setattr(worker, 'limit_process', lambda process, limits: None)
+    with ReplayWorker(python_shell, source_files=True) as python_worker:
+        python_worker.limits = ExecutionLimits(cpu_time=5)
+        output = python_worker.run(["import resource", "print(resource.getrlimit(resource.RLIMIT_CPU), __name__)"])
+    assert output == "(5, 6) __main__\n"
+
+
+def test_output_is_truncated(python_worker):
+    python_worker.limits = ExecutionLimits(output=100)
+    output = python_worker.run(["print('a' * 1000)"])
+    assert output.startswith('a' * 50)
+    assert "bytes left out" in output
+    assert output.endswith('a' * 49 + "\n")
+
+
+def test_output_of_subprocesses_is_captured(python_worker):
+    assert python_worker.run(["import os", "os.system('echo from-shell')", "print('py')"]) == "from-shell\npy\n"
+    with ReplayWorker(python_shell) as replay_worker:
+        assert replay_worker.run(["import os", "os.system('echo from-shell')", "print('py')"]) == "from-shell\npy\n"
+
+
+def test_output_of_failed_candidate_is_captured(python_worker):
+    with pytest.raises(PythonInterpreterError, match="from-stderr"):
+        python_worker.run(["import os", "os.system('echo from-stderr >&2')", "assert False"])
+
+
+def test_cpu_time_limit_is_deterministic(python_worker):
+    python_worker.limits = ExecutionLimits(cpu_time=1)
+    with pytest.raises(PythonInterpreterError, match="CPU time") as error:
+        python_worker.run(["while True: pass"])
+    assert error.value.deterministic
+
+
+def test_replay_worker_failures_tell_whether_they_are_deterministic():
+    with ReplayWorker(python_shell) as python_worker:
+        with pytest.raises(PythonInterpreterError) as error:
+            python_worker.run(["assert False"])
+        assert error.value.deterministic
+        python_worker.limits = ExecutionLimits(cpu_time=1)
+        with pytest.raises(PythonInterpreterError) as error:
+            python_worker.run(["while True: pass"])
+        assert error.value.deterministic
+        python_worker.limits = ExecutionLimits(timeout=0.5)
+        with pytest.raises(PythonInterpreterError) as error:
+            python_worker.run(["while True: pass"])
+        assert not error.value.deterministic